@@ -12,6 +12,10 @@ export const RowData = proto3.makeMessageType(
   "RowData",
   () => [
     { no: 1, name: "values", kind: "scalar", T: 2 /* ScalarType.FLOAT */, repeated: true },
+    { no: 2, name: "float16_values", kind: "scalar", T: 12 /* ScalarType.BYTES */ },
+    { no: 3, name: "uint16_values", kind: "scalar", T: 12 /* ScalarType.BYTES */ },
+    { no: 4, name: "scale", kind: "scalar", T: 1 /* ScalarType.DOUBLE */ },
+    { no: 5, name: "offset", kind: "scalar", T: 1 /* ScalarType.DOUBLE */ },
   ],
 );
 
@@ -26,3 +30,24 @@ export const TableData = proto3.makeMessageType(
   ],
 );
 
+/**
+ * @generated from message NeighbourData
+ */
+export const NeighbourData = proto3.makeMessageType(
+  "NeighbourData",
+  () => [
+    { no: 1, name: "genes", kind: "scalar", T: 13 /* ScalarType.UINT32 */, repeated: true },
+    { no: 2, name: "correlations", kind: "scalar", T: 2 /* ScalarType.FLOAT */, repeated: true },
+  ],
+);
+
+/**
+ * @generated from message SummaryData
+ */
+export const SummaryData = proto3.makeMessageType(
+  "SummaryData",
+  () => [
+    { no: 1, name: "counts", kind: "scalar", T: 13 /* ScalarType.UINT32 */, repeated: true },
+    { no: 2, name: "stats", kind: "scalar", T: 2 /* ScalarType.FLOAT */, repeated: true },
+  ],
+);
@@ -2,6 +2,7 @@ import * as hdf5 from 'jsfive';
 import * as pako from 'pako';
 import { asyncDerived, asyncReadable, writable, derived, get } from "@square/svelte-store";
 import * as protobuf from '../../gen/data_pb'
+import { withoutNulls, shardedFile } from '../utils/hdf5';
 
 /**
  * Get HDF5 async
@@ -24,6 +25,58 @@ async function getHDF5(url, setProgress) {
     return new hdf5.File(buffer.buffer, '');
 }
 
+/**
+ * Decompress a row given the dictionary attribute of its range dataset
+ * @param {Uint8Array} part 
+ * @param {Object} attrs 
+ * @returns {Uint8Array}
+ */
+function decompressRow(part, attrs) {
+    return attrs.dictionary ? pako.inflate(part, {dictionary: Uint8Array.from(attrs.dictionary)}) : pako.inflate(part);
+}
+
+/**
+ * Expand quantized RowData encodings (float16 or log-scaled uint16) into values
+ * @param {Object} unpacked 
+ * @returns {Object}
+ */
+function decodeRowValues(unpacked) {
+    if(unpacked.float16Values?.length) {
+        const view = new DataView(unpacked.float16Values.buffer, unpacked.float16Values.byteOffset, unpacked.float16Values.byteLength);
+        unpacked.values = Array.from({length: view.byteLength / 2}, (_, i) => {
+            const h = view.getUint16(2 * i, true);
+            const sign = h & 0x8000 ? -1 : 1, exponent = (h >> 10) & 0x1f, fraction = h & 0x3ff;
+            if(exponent === 0) return sign * Math.pow(2, -14) * (fraction / 1024);
+            if(exponent === 0x1f) return fraction ? NaN : sign * Infinity;
+            return sign * Math.pow(2, exponent - 15) * (1 + fraction / 1024);
+        });
+    } else if(unpacked.uint16Values?.length) {
+        const view = new DataView(unpacked.uint16Values.buffer, unpacked.uint16Values.byteOffset, unpacked.uint16Values.byteLength);
+        unpacked.values = Array.from({length: view.byteLength / 2}, (_, i) => {
+            const q = view.getUint16(2 * i, true);
+            return q === 0xffff ? NaN : Math.sinh(q * unpacked.scale + unpacked.offset);
+        });
+    }
+    return unpacked;
+}
+
+/**
+ * Decode a compressed row into its stream
+ * @param {Object} rowStream 
+ * @param {Uint8Array} part 
+ * @param {number} row 
+ */
+function setRow(rowStream, part, row) {
+    try {
+        let unpacked = protobuf[rowStream.type].fromBinary(decompressRow(part, rowStream.attrs))
+        if(rowStream.type === 'RowData') decodeRowValues(unpacked)
+        rowStream.current.set({data: unpacked, row: row});
+    } catch(e) {
+        console.log(e)
+        rowStream.current.set({error: e});
+    }
+}
+
 async function getJSON(url) {
     const req = await fetch(url);
     return await req.json();
@@ -51,16 +104,28 @@ function createCore(url) {
         async ($metadata) => {
             try {
                 const rowStreams = {}
-                const obj = await getHDF5($metadata.value.data_url, progress.set);
+                let obj = await getHDF5($metadata.value.data_url, progress.set);
+
+                // Sharded layout: out.hdf5 only holds the tables, the rest of a dataset's metadata is loaded once it is viewed (see loadDatasets)
+                if($metadata.value.manifest_url) obj = shardedFile(obj, await getJSON($metadata.value.manifest_url), (url) => getHDF5(url, () => {}));
                 for(let i=0; i<obj.attrs.remote.length; i+=3) {
-                    rowStreams[obj.attrs.remote[i+0]] = {
-                        attrs: obj.get(obj.attrs.remote[i+0]).attrs, 
+                    const rangesPath = obj.attrs.remote[i+0];
+                    rowStreams[rangesPath] = {
+                        get attrs() { return this._attrs ??= obj.get(rangesPath).attrs; }, 
+                        rangesPath,
                         indexPath: obj.attrs.remote[i+1], 
+                        dataset: obj.attrs.remote[i+1].split('/').pop(),
                         type: obj.attrs.remote[i+2], 
                         current: writable(undefined)
                     }
                 }                
-                return {value: obj, rowStreams: rowStreams};
+
+                // Gene layout: all rows of a gene are a single record, prefixed by (stream, length) of each row
+                const geneRanges = obj.keys.includes('gene_ranges') ? obj.get('gene_ranges') : undefined;
+
+                // Sorted uppercase IDs, symbols and aliases of genes, for binary search (see findIndexRows)
+                const searchIndex = obj.keys.includes('search') ? {keys: withoutNulls(obj.get('search/keys').value), rows: obj.get('search/rows').value} : undefined;
+                return {value: obj, rowStreams: rowStreams, geneRanges: geneRanges && {ranges: geneRanges.value, streams: geneRanges.attrs.streams}, searchIndex: searchIndex};
             } catch (e) {
                 console.log(e)
                 return {error: e};
@@ -68,28 +133,84 @@ function createCore(url) {
         },
     );
 
-    row.subscribe(async ($row) => {
-        // NOTE: could not use asyncDerived([row, data]) since data is not json serializable
-        let $data;
-        let $metadata;
-        if($row === undefined || !($data = get(data)) || !($metadata = get(metadata))) return
-        
+    // Record of the current gene in the gene layout, so datasets loaded later are decoded without another request
+    let geneRecord = {};
+
+    /**
+     * Fetch a gene's record in the gene layout, as a map of range dataset to compressed row
+     * @param {Object} $data 
+     * @param {Object} $metadata 
+     * @param {number} $row 
+     * @returns {Map}
+     */
+    async function fetchGeneRecord($data, $metadata, $row) {
+        const {ranges, streams} = $data.geneRanges;
+        const response = await fetch($metadata.value.bin_url, {
+            headers: {'Range': 'bytes=' + `${ranges[$row*2]}-${ranges[$row*2+1]-1}`},
+        });
+        if(response.status !== 206) throw new Error('Invalid response, 206 expected');
+        const record = new Uint8Array(await response.arrayBuffer());
+        const header = new DataView(record.buffer, record.byteOffset, record.byteLength);
+        const count = header.getUint32(0, true), parts = new Map();
+        let offset = 4 + 8 * count;
+        for(let k=0; k<count; ++k) {
+            const length = header.getUint32(8 + 8*k, true);
+            parts.set(streams[header.getUint32(4 + 8*k, true)], record.subarray(offset, offset + length));
+            offset += length;
+        }
+        return parts;
+    }
+
+    /**
+     * Request a row of the given streams (each once per row), setting their current values
+     * @param {Object} $data 
+     * @param {Object} $metadata 
+     * @param {number} $row 
+     * @param {Object[]} rowStreams 
+     */
+    async function requestRows($data, $metadata, $row, rowStreams) {
+        rowStreams = rowStreams.filter(rowStream => rowStream.requestedRow !== $row);
+        if(!rowStreams.length) return;
+        for(const rowStream of rowStreams) rowStream.requestedRow = $row;
+
+        // Single record request, rows of streams not in the record are empty
+        if($data.geneRanges) {
+            for(const rowStream of rowStreams) rowStream.current.set({loading: true});
+            if(geneRecord.row !== $row) geneRecord = {row: $row, parts: fetchGeneRecord($data, $metadata, $row)};
+            let parts;
+            try {
+                parts = await geneRecord.parts;
+            } catch(e) {
+                console.log(e)
+                geneRecord = {};
+                for(const rowStream of rowStreams) rowStream.current.set({error: e.message});
+                return;
+            }
+            for(const rowStream of rowStreams) {
+                const part = parts.get(rowStream.rangesPath);
+                if(part) setRow(rowStream, part, $row);
+                else rowStream.current.set({emtpy: true});
+            }
+            return;
+        }
+
         // Determine requests
         const requests = []
-        for(const [rangesPath, rowStream] of Object.entries($data.rowStreams)) {
+        for(const rowStream of rowStreams) {
             const index = $data.value.get(rowStream.indexPath).value;
             const indexedRow = index[$row];
             if(indexedRow >= 0) {
                 rowStream.current.set({loading: true})
                 requests.push({
                     rowStream,
-                    byteStart: $data.value.get(rangesPath).value[indexedRow*2],
-                    byteEnd: $data.value.get(rangesPath).value[indexedRow*2+1],
+                    byteStart: $data.value.get(rowStream.rangesPath).value[indexedRow*2],
+                    byteEnd: $data.value.get(rowStream.rangesPath).value[indexedRow*2+1],
                 })
             } else {
                 rowStream.current.set({emtpy: true})
             }
         }
+        if(!requests.length) return;
         requests.sort((a, b) => a.byteStart - b.byteStart)
 
         // Perform single combined request
@@ -102,11 +223,11 @@ function createCore(url) {
         // Attempt to stream outputs
         if(response.status !== 206) {
             controller.abort();
-            for(const rowStream of Object.values($data.rowStreams)) rowStream.current.set({error: 'Invalid response, 206 expected'});
+            for(const rowStream of rowStreams) rowStream.current.set({error: 'Invalid response, 206 expected'});
         } else {
             const responseLen = response.headers.get('content-length');
             if (responseLen != (requests[requests.length-1].byteEnd - requests[0].byteStart)) {
-                for(const rowStream of Object.values($data.rowStreams)) rowStream.current.set({error: 'Unexpected response length'})
+                for(const rowStream of rowStreams) rowStream.current.set({error: 'Unexpected response length'})
             }
             let i=0;
             let o = requests[0].byteStart
@@ -120,21 +241,53 @@ function createCore(url) {
                 receivedBytes += value.length
                 while(i<requests.length && ((requests[i].byteEnd-o) <= receivedBytes)) {
                     const part = chunksAll.subarray(requests[i].byteStart-o, requests[i].byteEnd-o)
-                    const rowStream = requests[i].rowStream
-                    try {
-                        let unpacked = protobuf[rowStream.type].fromBinary(pako.inflate(part))
-                        rowStream.current.set({data: unpacked, row: $row});
-                    } catch(e) {
-                        console.log(e)
-                        rowStream.current.set({error: e});
-                    }
+                    setRow(requests[i].rowStream, part, $row)
                     ++i;
                 }
             }
         }
+    }
+
+    row.subscribe(async ($row) => {
+        // NOTE: could not use asyncDerived([row, data]) since data is not json serializable
+        let $data;
+        let $metadata;
+        if(!($data = get(data)) || !($metadata = get(metadata))) return
+        if($row === undefined) {
+            for(const rowStream of Object.values($data.rowStreams ?? {})) rowStream.requestedRow = undefined;
+            return
+        }
+
+        // Rows of datasets whose metadata is not loaded yet (sharded layout) are requested once it is, see loadDatasets
+        requestRows($data, $metadata, $row, Object.values($data.rowStreams).filter(rowStream => $data.value.isLoaded?.(rowStream.dataset) ?? true));
     });
+
+    /**
+     * Load the metadata of datasets (their shards in the sharded layout), then request their rows of the current gene
+     * @param {string[]} ids 
+     */
+    async function loadDatasets(ids) {
+        const $data = await data.load();
+        if(!$data?.value) return;
+        await $data.value.loadShards?.(ids);
+        const $row = get(row);
+        if($row !== undefined) requestRows($data, get(metadata), $row, Object.values($data.rowStreams).filter(rowStream => ids.includes(rowStream.dataset)));
+    }
+
+    /**
+     * Store following a store of the selected dataset ({id}) once that dataset's metadata is loaded
+     * @param {Object} selected 
+     * @returns {Object}
+     */
+    function loadedDataset(selected) {
+        return derived(selected, ($selected, set) => {
+            let current = true;
+            loadDatasets($selected?.id ? [$selected.id] : []).then(() => current && set($selected), (e) => console.log(e));
+            return () => { current = false; };
+        });
+    }
     
-    return { data, metadata, progress, row, customs: writable({})}
+    return { data, metadata, progress, row, customs: writable({}), loadDatasets, loadedDataset}
 }
 
 export { createCore };
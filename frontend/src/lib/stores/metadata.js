@@ -4,16 +4,18 @@ function createMetadataStore(core) {
     return derived([core.data, core.customs], ([$data, $customs]) => {
         const metadataColumnReaders = {};
         for(const h of $data.value.get('metadata').keys) {
-            metadataColumnReaders[h] = {
+            // Built on first use, as a dataset's metadata is only loaded once it is selected in the sharded layout (see core.loadedDataset)
+            let reader;
+            Object.defineProperty(metadataColumnReaders, h, {enumerable: true, configurable: true, get: () => reader ??= {
                 ...$data.value.get('metadata/' + h + '/samples').attrs, //order, type (optional)
                 sampleNames: $data.value.get('metadata/' + h + '/sample_names').value,
-                matrixNames: $data.value.get('metadata/' + h + '/matrices').keys.filter(m => !m.endsWith('_pvalues')),
+                matrixNames: $data.value.get('metadata/' + h + '/matrices').attrs.order, // excludes _pvalues and _summary
                 getMatrixStore: $data.rowStreams,
                 getColumn: (colHeading) => {
                     const sRoot = $data.value.get('metadata/' + h + '/samples/' + colHeading)
                     return {values: sRoot.value, attrs: sRoot.attrs}
                 },
-            }
+            }});
         }
         for(let cd of Object.values($customs)) {
             metadataColumnReaders[cd.name] = cd.metadataColumnReader;
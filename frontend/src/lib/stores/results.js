@@ -1,4 +1,4 @@
-import { findMatchesSorted } from "../utils/hdf5";
+import { findMatchesSorted, findIndexRows } from "../utils/hdf5";
 import { derived } from "svelte/store";
 
 function createCombinedResultsStore(data, customDatasets) {
@@ -42,7 +42,7 @@ function createCombinedResultsStore(data, customDatasets) {
             groupIndices['_varpart'] = dsKeys.filter(h => $data.value.get('metadata/' + h).keys.includes('variance_partition')).map(h => headings.indexOf(h))
             groupIndices['_transcripts'] = dsKeys.filter(h => $data.value.get('metadata/' + h).keys.includes('transcripts')).map(h => headings.indexOf(h))
             
-            set({headings, headingsDefaultVisible, original, columns, generalIndices, datasetIndices, databaseIndices, groupIndices, columnStringSizes, headingGroups})
+            set({headings, headingsDefaultVisible, original, columns, generalIndices, datasetIndices, databaseIndices, groupIndices, columnStringSizes, headingGroups, searchIndex: $data.searchIndex})
         }
     });
 }
@@ -57,7 +57,19 @@ function createFilteredResultsStore(columnStore, currentSearch, currentVisibleCo
                 const searchTerms = $currentSearch.split(',').map(st => st.trim().toLowerCase())
                 searchTerms.sort()
 
-                if(searchTerms.length == 1) {
+                const searchIndex = $columnStore.searchIndex;
+                if(searchIndex) {
+                    // IDs, symbols and aliases by binary search (prefixes of a single term), other visible text columns (e.g. descriptions) by substring
+                    const matches = findIndexRows(searchIndex, searchTerms, searchTerms.length == 1);
+                    const searchable = searchTerms.length == 1 ? columns.map((_, col_i) => col_i).filter(col_i => col_i > 1 && $columnStore.columnStringSizes[col_i]).filter(col_i => $currentVisibleCombined.includes($columnStore.headings[col_i])) : [];
+                    if(searchable.length) {
+                        const matched = new Set(matches);
+                        results = results.filter(row_i => matched.has(row_i) || searchable.some(col_i => $columnStore.columns[col_i][row_i].toLowerCase().includes(searchTerms[0])))
+                    } else {
+                        const subset = $currentIndexSubset && new Set(results);
+                        results = (subset ? matches.filter(row_i => subset.has(row_i)) : matches).sort((a, b) => a - b)
+                    }
+                } else if(searchTerms.length == 1) {
                     const searchable = columns.map((_, col_i) => col_i).filter(col_i => $columnStore.columnStringSizes[col_i]).filter(col_i => $currentVisibleCombined.includes($columnStore.headings[col_i]))
                     results = results.filter(row_i => searchable.some(col_i => $columnStore.columns[col_i][row_i].toLowerCase().includes(searchTerms[0])))
                 } else {
@@ -21,4 +21,63 @@ function findMatchesSorted(arrays, searches) {
     return ret.filter(v => v !== undefined)
 }
 
-export { withoutNulls, withoutNullsStr, findMatchesSorted}
\ No newline at end of file
+/**
+ * Rows of genes whose Ensembl ID, symbol or alias equals (or starts with) any of the searches, by binary search of the sorted search index
+ * @param {Object} searchIndex {keys, rows} of /search
+ * @param {string[]} searches
+ * @param {boolean} prefix
+ * @returns {number[]}
+ */
+function findIndexRows(searchIndex, searches, prefix=false) {
+    const { keys, rows } = searchIndex;
+    const found = new Set();
+    for(const search of searches.map(s => s.trim().toUpperCase()).filter(s => s.length)) {
+        let lo = 0, hi = keys.length;
+        while(lo < hi) {
+            const mid = (lo + hi) >>> 1;
+            if(keys[mid] < search) lo = mid + 1; else hi = mid;
+        }
+        for(let i=lo; i<keys.length && (prefix ? keys[i].startsWith(search) : keys[i] === search); ++i) found.add(rows[i]);
+    }
+    return Array.from(found);
+}
+
+/**
+ * Single file view of the header of a sharded output and the dataset shards loaded so far (see shard_output in the pipeline)
+ * @param {Object} header jsfive File of out.hdf5
+ * @param {Object} manifest {shards: {id: {url, keys}}} of manifest.json
+ * @param {Function} getFile async url => jsfive File
+ * @returns {Object}
+ */
+function shardedFile(header, manifest, getFile) {
+    const files = {}, loading = {};
+    const view = {
+        attrs: header.attrs,
+        keys: header.keys,
+        get(path) {
+            const parts = path.replace(/^\/+/, '').split('/');
+            const shard = parts[0] === 'metadata' && manifest.shards[parts[1]];
+            if(shard && parts.length === 2) {
+                // Dataset groups list the keys of their shard, loaded or not
+                const group = header.get(path);
+                return {attrs: group.attrs, keys: [...group.keys, ...shard.keys], get: (key) => view.get(path + '/' + key)};
+            }
+            if(shard && shard.keys.includes(parts[2])) {
+                if(!files[parts[1]]) throw new Error(`Metadata of ${parts[1]} is not loaded`);
+                return files[parts[1]].get(path);
+            }
+            return header.get(path);
+        },
+        isLoaded(id) {
+            return !manifest.shards[id] || files[id] !== undefined;
+        },
+        loadShards(ids) {
+            return Promise.all(ids.filter(id => manifest.shards[id]).map(id => loading[id] ??= getFile(manifest.shards[id].url)
+                .then(file => files[id] = file)
+                .catch(e => { delete loading[id]; throw e; })));
+        },
+    };
+    return view;
+}
+
+export { withoutNulls, withoutNullsStr, findMatchesSorted, findIndexRows, shardedFile}
\ No newline at end of file
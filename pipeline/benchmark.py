@@ -0,0 +1,361 @@
+import argparse, random, time, os, sys, re, json, csv, gzip, shutil, subprocess, resource, datetime, tempfile, contextlib, logging
+import numpy as np, h5py, oyaml
+
+import main
+from main import nested_parallel_iterator, get_row_codec, train_row_dictionary
+
+def legacy_parallel_iterator(iterators, sort_key):
+    '''Previous min() based merge, kept as a reference for comparison'''
+    group_create_func = lambda i, v: (i, sort_key(v), v) if v else None
+    latest = [group_create_func(i, next(it, None)) for i, it in enumerate(iterators)]
+    while any(latest):
+        min_group_key = min((g for g in latest if g), key=lambda g: g[1])[1]
+        min_groups = [g if (g and g[1] == min_group_key) else None for g in latest]
+        yield (min_group_key, [g[2] if g else None for g in min_groups])
+        for g in min_groups:
+            if g is not None:
+                latest[g[0]] = group_create_func(g[0], next(iterators[g[0]], None))
+
+def synthetic_streams(datasets: int, matrices: int, transcripts: int, genes: int, coverage: float=0.8, seed: int=0):
+    '''Sorted (gene, value) rows per dataset as [varpart, [matrices], [transcripts]], each covering a random subset of genes'''
+    rng = random.Random(seed)
+    names = [f'ENSG{i:011d}' for i in range(genes)]
+    values = np.zeros(8, dtype='f4')
+    def rows():
+        return [(g, values) for g in names if rng.random() < coverage]
+    return [[rows(), [rows() for _ in range(matrices)], [rows() for _ in range(transcripts)]] for _ in range(datasets)]
+
+def bench_merge(args):
+    '''Throughput of merging all matrices of all datasets by gene'''
+    streams = synthetic_streams(args.datasets, args.matrices, args.transcripts, args.genes)
+    total_rows = sum(len(v) + sum(map(len, m)) + sum(map(len, t)) for v, m, t in streams)
+
+    def nested():
+        return nested_parallel_iterator([[iter(v), [iter(r) for r in m], [iter(r) for r in t]] for v, m, t in streams], lambda kv: kv[0])
+
+    def legacy():
+        key = lambda kv: kv[0]
+        per_dataset = [legacy_parallel_iterator([iter(v), legacy_parallel_iterator([iter(r) for r in m], key), legacy_parallel_iterator([iter(r) for r in t], key)], key) for v, m, t in streams]
+        return legacy_parallel_iterator(per_dataset, key)
+
+    for name, func in [('legacy', legacy), ('heap', nested)]:
+        elapsed = float('inf')
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            count = sum(1 for _ in func())
+            elapsed = min(elapsed, time.perf_counter() - start)
+        print(f'{name:>8}: {count} genes, {total_rows} rows in {elapsed:.2f}s ({total_rows / elapsed:,.0f} rows/s)')
+
+def bench_compression(args):
+    '''Size and per-row decode latency of the rows of a built expression.bin re-compressed with zlib, with and without shared dictionaries'''
+    # Decode rows of every range dataset with the dictionary they were written with
+    streams = {}
+    with h5py.File(os.path.join(args.output, 'out.hdf5'), 'r') as root, open(os.path.join(args.output, 'expression.bin'), 'rb') as f:
+        for name, _, _ in root.attrs['remote']:
+            attrs = root[name].attrs
+            _, decompress = get_row_codec(dictionary=attrs['dictionary'].tobytes() if 'dictionary' in attrs else None)
+            rows = []
+            for start, end in root[name][()][:args.rows]:
+                f.seek(start)
+                rows.append(decompress(f.read(end - start)))
+            streams[name] = rows
+
+    report = []
+    for use_dictionary in [False, True]:
+        total_raw, total_compressed, total_dictionary, decode_time, count = 0, 0, 0, 0, 0
+        for name, rows in streams.items():
+            dictionary = train_row_dictionary(rows[::max(1, len(rows) // 1024)]) if use_dictionary and rows else None
+            compress, decompress = get_row_codec(args.level, dictionary)
+            compressed = [compress(r) for r in rows]
+            start = time.perf_counter()
+            for c in compressed: decompress(c)
+            decode_time += time.perf_counter() - start
+            total_raw += sum(map(len, rows))
+            total_compressed += sum(map(len, compressed))
+            total_dictionary += len(dictionary or b'')
+            count += len(rows)
+        report.append({'dictionary': use_dictionary, 'rows': count, 'raw_bytes': total_raw, 'compressed_bytes': total_compressed, 'dictionary_bytes': total_dictionary, 'decode_us_per_row': 1e6 * decode_time / max(count, 1)})
+        print(f'zlib {"+dict" if use_dictionary else "     "}: {total_compressed:>12,} bytes ({total_compressed / max(total_raw, 1):.1%} of raw, {total_dictionary:,} in dictionaries), {report[-1]["decode_us_per_row"]:.1f}us/row decode')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+def write_synthetic_gtf(path: str, names: list, tx_counts: list, exons: int=1):
+    '''Write a gzipped GTF with a gene row per name, followed by its transcripts and their exons'''
+    with gzip.open(path, 'wt', compresslevel=1) as f:
+        f.write('#!genome-build GRCh38\n')
+        for i, (g, n) in enumerate(zip(names, tx_counts)):
+            chrom = ['1', '2', '3', 'X', 'Y', 'MT'][i % 6]
+            f.write(f'{chrom}\tensembl\tgene\t{i*100+1}\t{i*100+90}\t.\t+\t.\tgene_id "{g}"; gene_version "1"; gene_name "SYM{i}"; gene_biotype "protein_coding";\n')
+            for t in range(n):
+                attrs = f'gene_id "{g}"; gene_version "1"; transcript_id "ENST{i*10+t:011d}"; transcript_version "1"; gene_name "SYM{i}";'
+                f.write(f'{chrom}\tensembl\ttranscript\t{i*100+1}\t{i*100+90}\t.\t+\t.\t{attrs}\n')
+                for e in range(exons):
+                    f.write(f'{chrom}\tensembl\texon\t{i*100+1}\t{i*100+40}\t.\t+\t.\t{attrs} exon_number "{e+1}"; exon_id "ENSE{i*100+t*10+e:011d}";\n')
+
+def legacy_gtf_records(path: str):
+    '''Previous csv reader and per-attribute regex parsing of the GTF, kept as a reference for comparison'''
+    with main.iterate_csv(path, delimiter='\t', strip_numeric=False, comment='#!', file_kwargs=dict(encoding='ascii')) as reader:
+        _, rows = reader
+        for row in rows:
+            if row[2] in ['gene', 'transcript']:
+                found = [re.search(f'{key} "([A-Z0-9]+)"', row[8]) for key in ['gene_id', 'gene_name', 'transcript_id']]
+                yield (row[2], row[0], int(row[3]), int(row[4]), row[6], *(m.group(1) if m else None for m in found))
+
+def bench_gtf(args):
+    '''Throughput of parsing gene/transcript records from a GTF (e.g. the full GRCh38 one) with the previous and the streaming parser'''
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        path = args.path
+        if not path:
+            rng = np.random.default_rng(args.seed)
+            path = os.path.join(tmpdirname, 'synthetic.gtf.gz')
+            write_synthetic_gtf(path, [f'ENSG{i:011d}' for i in range(1, args.genes + 1)], rng.integers(1, 8, args.genes).tolist(), args.exons)
+
+        parsers = [('legacy', lambda: legacy_gtf_records(path))] + [(f'stream x{w}' if w else 'stream', lambda w=w: main.iterate_gtf(path, workers=w)) for w in args.workers]
+        report, results = [], {}
+        for name, func in parsers:
+            elapsed = float('inf')
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                results[name] = list(func())
+                elapsed = min(elapsed, time.perf_counter() - start)
+            report.append({'parser': name, 'records': len(results[name]), 'seconds': elapsed, 'peak_rss_mb': get_peak_rss_mb()})
+            print(f'{name:>10}: {len(results[name]):,} records in {elapsed:.2f}s ({len(results[name]) / elapsed:,.0f} records/s)')
+
+        # The previous reader took the first row after comments as a header
+        for name, records in results.items():
+            if name != 'legacy' and records[1:] != results['legacy'] and records != results['legacy']:
+                print(f'{name} records differ from legacy')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+def write_synthetic_inputs(folder: str, datasets: int, matrices: int, transcripts: int, genes: int, samples: int, seed: int=0):
+    '''Write annotation files, datasets and an input.yaml shaped like test_data (unsorted and versioned IDs, shuffled and partial sample columns), returning the input.yaml path'''
+    rng = np.random.default_rng(seed)
+    annotation, data = os.path.join(folder, 'annotation'), os.path.join(folder, 'test_data')
+    os.makedirs(annotation, exist_ok=True)
+    os.makedirs(data, exist_ok=True)
+
+    names = [f'ENSG{i:011d}' for i in range(1, genes + 1)]
+    tx_counts = rng.integers(0, 4, genes).tolist()
+    write_synthetic_gtf(os.path.join(annotation, 'gtf.gz'), names, tx_counts)
+    with gzip.open(os.path.join(annotation, 'gene_info.gz'), 'wt', compresslevel=1) as f:
+        f.write('#tax_id\tGeneID\tSymbol\tLocusTag\tSynonyms\tdbXrefs\tchromosome\tmap_location\tdescription\n')
+        for i, g in enumerate(names):
+            f.write(f'9606\t{i}\tSYM{i}\t-\t-\tHGNC:HGNC:{i}|Ensembl:{g}\t1\t1p\tsynthetic gene {i}\n')
+    with open(os.path.join(annotation, 'genenames.tsv'), 'w') as f:
+        f.write('HGNC ID\tApproved symbol\tStatus\tPrevious symbols\tAlias symbols\tEnsembl gene ID\n')
+        for i, g in enumerate(names):
+            f.write(f'HGNC:{i}\tSYM{i}\tApproved\tOLD{i}\tALIAS{i}, ALT{i}\t{g}\n')
+
+    regions, ages = ['Cortex', 'Cerebellum', 'Hippocampus', 'Striatum'], ['0-5mos', '6-18mos', '20-29yrs', '60-69yrs']
+    def write_matrix(path, header, ids, width):
+        values = np.round(rng.lognormal(1, 1.5, (len(ids), width)) * (rng.random((len(ids), width)) > 0.1), 4)
+        with open(path, 'w', newline='') as f:
+            w = csv.writer(f)
+            w.writerow(header)
+            w.writerows([row_id] + row for row_id, row in zip(ids, values.tolist()))
+
+    input_datasets = []
+    for d in range(datasets):
+        dataset_id, sample_names = f'Synthetic{d + 1}', [f'D{d}S{i}' for i in range(samples)]
+        with open(os.path.join(data, f'{dataset_id}-meta.csv'), 'w', newline='') as f:
+            w = csv.writer(f)
+            w.writerow(['SampleID', 'Age', 'Sex', 'Regions', 'RIN', 'AgeInterval'])
+            for s in rng.permutation(sample_names).tolist():
+                w.writerow([s, round(float(rng.uniform(0, 90)), 2) if rng.random() > 0.05 else 'NA', rng.choice(['M', 'F']), rng.choice(regions), int(rng.integers(5, 10)), rng.choice(ages)])
+        with open(os.path.join(data, f'{dataset_id}-annot.csv'), 'w', newline='') as f:
+            csv.writer(f).writerows([['', 'Original', 'Column', 'Show', 'Type'], [1, 'age', 'Age', 'Yes', 'Demographic'], [2, 'sex', 'Sex', 'Yes', 'Demographic'], [3, 'rin', 'RIN', 'Yes', 'Technical'], [4, 'region', 'Regions', 'No', '']])
+
+        dataset = {'id': dataset_id, 'dir': './test_data', 'meta': f'{dataset_id}-meta.csv', 'annot': f'{dataset_id}-annot.csv', 'customFilter': {'name': 'Brain Region', 'column': 'Regions'}, 'matrices': []}
+        for m in range(matrices):
+            columns = [s for s in rng.permutation(sample_names).tolist() if rng.random() > 0.05]
+            ids = [g + (f'.{rng.integers(1, 9)}' if rng.random() < 0.3 else '') for g in names if rng.random() > 0.1]
+            write_matrix(os.path.join(data, f'{dataset_id}-exp{m}.csv'), ['EnsemblID'] + columns, rng.permutation(ids).tolist(), len(columns))
+            dataset['matrices'].append({'name': f'M{m}', 'path': f'{dataset_id}-exp{m}.csv'})
+        for t in range(transcripts):
+            ids = [f'ENST{i*10+k:011d}.1' for i, n in enumerate(tx_counts) for k in range(n) if rng.random() > 0.2]
+            write_matrix(os.path.join(data, f'{dataset_id}-tx{t}.csv'), ['TranscriptID'] + ages, rng.permutation(ids).tolist(), len(ages))
+            dataset.setdefault('transcript_matrices', []).append({'name': f'T{t}', 'path': f'{dataset_id}-tx{t}.csv', 'variable': 'AgeInterval'})
+        write_matrix(os.path.join(data, f'{dataset_id}-varpart.csv'), ['', 'Age', 'Sex', 'Residuals'], names[::2], 3)
+        dataset['variancePartition'] = f'{dataset_id}-varpart.csv'
+        input_datasets.append(dataset)
+
+    ids = [d['id'] for d in input_datasets]
+    input_path = os.path.join(folder, 'input.yaml')
+    with open(input_path, 'w') as f:
+        oyaml.safe_dump({
+            'output_resources': './output', 'output_external': './output',
+            'ncbi_gene_info': './annotation/gene_info.gz', 'ncbi_gtf': './annotation/gtf.gz', 'genenames_alias': './annotation/genenames.tsv',
+            'deploy_local': True, 'deploy_only': False, 'deploy_url': '', 'deploy_bucket': '', 'workers': 0,
+            'datasets': input_datasets,
+            'customMetadataCategoryOrders': [{'variable': 'AgeInterval', 'datasets': ids, 'order': ages, 'groups': [{'label': 'postnatal', 'size': len(ages)}]}],
+            'groups': [{'id': 'Gene expression', 'datasets': ids}],
+        }, f, sort_keys=False)
+    return input_path
+
+def get_peak_rss_mb(who=resource.RUSAGE_SELF):
+    '''High-water mark of resident memory so far (ru_maxrss is in KiB on Linux)'''
+    return resource.getrusage(who).ru_maxrss / 1024
+
+def bench_pipeline(args):
+    '''Time each build stage on synthetic inputs (annotate, ingest/sort, merge, stats, encode/compress, HDF5 write, zscores, full runs), with rows/s and peak RSS'''
+    folder = os.path.abspath(args.folder or tempfile.mkdtemp(prefix='bithub-bench-'))
+    print(f'Generating {args.datasets} datasets x {args.matrices} matrices of {args.genes} genes x {args.samples} samples in {folder}')
+    with open(write_synthetic_inputs(folder, args.datasets, args.matrices, args.transcripts, args.genes, args.samples, args.seed)) as f:
+        inputObj = oyaml.safe_load(f)
+    datasets, orders = inputObj['datasets'], inputObj['customMetadataCategoryOrders']
+
+    stages = {}
+    def report(name, elapsed, rows, peak_rss_mb):
+        stages[name] = {'seconds': elapsed, 'rows': rows, 'rows_per_sec': rows / elapsed if elapsed else None, 'peak_rss_mb': peak_rss_mb}
+        print(f'{name:>10}: {elapsed:8.2f}s {rows:>10,} rows ({stages[name]["rows_per_sec"] or 0:>10,.0f} rows/s), peak RSS {peak_rss_mb:,.0f}MB')
+
+    @contextlib.contextmanager
+    def stage(name):
+        # NOTE: peak RSS is the process high-water mark, so it only grows from stage to stage
+        counter = [0]
+        start = time.perf_counter()
+        yield counter
+        report(name, time.perf_counter() - start, counter[0], get_peak_rss_mb())
+
+    # Stages run in-process relative to the generated input.yaml (and its private cache), like run()
+    cwd = os.getcwd()
+    os.chdir(folder)
+    logging.basicConfig(filename='benchmark.log', filemode='w', level=logging.INFO, force=True)
+    try:
+        os.makedirs(main.LOCAL_TMP, exist_ok=True)
+        with stage('annotate') as counter:
+            gene_to_gene, _, transcript_to_gene, fingerprint = main.get_ncbi_annotator(inputObj['ncbi_gene_info'], inputObj['ncbi_gtf'], inputObj['genenames_alias'])
+            counter[0] = args.genes
+
+        with stage('ingest') as counter:
+            # Matrices are parsed and sorted into their cached stores as their contexts are entered
+            for d in datasets:
+                with main.parallel_dataset_context([d], gene_to_gene, transcript_to_gene, fingerprint=fingerprint):
+                    pass
+                for p in [*(m['path'] for m in d['matrices']), *(t['path'] for t in d.get('transcript_matrices', [])), d['variancePartition']]:
+                    with open(os.path.join(d['dir'], p), 'rb') as f:
+                        counter[0] += sum(1 for _ in f) - 1
+
+        with stage('merge') as counter, main.parallel_dataset_context(datasets, gene_to_gene, transcript_to_gene, fingerprint=fingerprint) as (_, iterator):
+            for gene, groups in iterator:
+                counter[0] += 1
+
+        # Blocks of every matrix reordered to their metadata, as write_segment sees them
+        blocks, reordered_matrices = [], {d['id']: [] for d in datasets}
+        for d in datasets:
+            _, side_headers, _, columns = main.parse_metadata(d, orders, main.CATEGORY_LIMIT)
+            columns = [(h, array, [np.where(array == c)[0] for c in set(array)] if array.dtype.type is np.bytes_ else None, attrs, t) for h, array, _, attrs, t in columns]
+            with main.parallel_matrix_context(d, lambda row: None, fingerprint='gene' + fingerprint) as (headers, iterators):
+                for samples, rows in zip(headers, iterators):
+                    reordered = main.apply_reorder_array(np.stack([v for _, v in rows]), main.get_reorder_array(sorted(side_headers), samples), dtype='f8')
+                    reordered_matrices[d['id']].append(reordered)
+                    blocks.extend((reordered[i:i+main.MATRIX_BLOCK_SIZE], columns) for i in range(0, len(reordered), main.MATRIX_BLOCK_SIZE))
+
+        with stage('stats') as counter:
+            pvalue_blocks = []
+            for block, columns in blocks:
+                pvalue_blocks.append(main.calc_pvalues_block(block, columns))
+                counter[0] += len(block)
+
+        with stage('encode') as counter, main.write_compressed_ranges(os.path.join(main.LOCAL_TMP, 'bench.bin')) as (writer, _):
+            ranges = []
+            for (block, _), pvalues_block in zip(blocks, pvalue_blocks):
+                for values, pvalues in zip(block, pvalues_block.tolist()):
+                    pvalue_row = main.data_pb2.RowData()
+                    pvalue_row.values.extend(pvalues)
+                    ranges.append(writer(main.compress_row(pvalue_row.SerializeToString()), compressed=True))
+                    ranges.append(writer(main.compress_row(main.encode_row_values(values, args.encoding).SerializeToString()), compressed=True))
+                counter[0] += len(block)
+
+        with stage('hdf5') as counter, h5py.File(os.path.join(main.LOCAL_TMP, 'bench.hdf5'), 'w') as root:
+            for i, d in enumerate(datasets):
+                d_root = root.create_group(d['id'])
+                main.write_metadata_columns(d_root, main.parse_metadata(d, orders, main.CATEGORY_LIMIT)[3])
+                d_root.create_dataset('ranges', data=ranges[i::len(datasets)], compression='gzip', compression_opts=9)
+                d_root.create_dataset('index', data=np.arange(args.genes), compression='gzip', compression_opts=9)
+            counter[0] = len(ranges)
+
+        with stage('zscores') as counter:
+            # Log means of every matrix (as encode_matrix_block computes them), z-scored and averaged over a dataset's matrices as in run()
+            for matrices in reordered_matrices.values():
+                genes = min(map(len, matrices))
+                logs = np.stack([main.calc_log_means(m[:genes], [])[0] for m in matrices])
+                zscores = main.calc_zscore(logs).mean(axis=0)
+                counter[0] += logs.size
+    finally:
+        os.chdir(cwd)
+
+    # Full builds in a child process, from scratch and then reusing all cached segments
+    for name, clear_cache in [('run_cold', True), ('run_warm', False)]:
+        if clear_cache:
+            for p in [main.CACHE_DIR, 'output']: shutil.rmtree(os.path.join(folder, p), ignore_errors=True)
+        start = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py'), 'input.yaml'], cwd=folder, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        _, status, usage = os.wait4(proc.pid, 0)
+        if status: raise Exception(f'{name} build failed, see the warnings log in {os.path.join(folder, "output")}')
+        report(name, time.perf_counter() - start, len(datasets) * args.matrices * args.genes, usage.ru_maxrss / 1024)
+
+    commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    result = {'commit': commit, 'date': datetime.datetime.now().isoformat(timespec='seconds'), 'params': {k: v for k, v in vars(args).items() if k not in ('func', 'folder', 'baseline', 'json')}, 'stages': stages}
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f'Relative to {baseline["commit"] or "baseline"} ({baseline["date"]}):')
+        for name, s in stages.items():
+            if (b := baseline['stages'].get(name, None)):
+                print(f'{name:>10}: {s["seconds"] / b["seconds"]:6.2f}x time, {s["peak_rss_mb"] / b["peak_rss_mb"]:6.2f}x peak RSS')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for pipeline stages')
+    subparsers = parser.add_subparsers(required=True)
+
+    merge_parser = subparsers.add_parser('merge', help=bench_merge.__doc__)
+    merge_parser.add_argument('--datasets', type=int, default=8)
+    merge_parser.add_argument('--matrices', type=int, default=3)
+    merge_parser.add_argument('--transcripts', type=int, default=2)
+    merge_parser.add_argument('--genes', type=int, default=20000)
+    merge_parser.add_argument('--repeat', type=int, default=3)
+    merge_parser.set_defaults(func=bench_merge)
+
+    compression_parser = subparsers.add_parser('compression', help=bench_compression.__doc__)
+    compression_parser.add_argument('output', help='folder containing out.hdf5 and expression.bin')
+    compression_parser.add_argument('--rows', type=int, default=None, help='limit rows per range dataset')
+    compression_parser.add_argument('--level', type=int, default=None)
+    compression_parser.add_argument('--json', help='also write the report to this path')
+    compression_parser.set_defaults(func=bench_compression)
+
+    gtf_parser = subparsers.add_parser('gtf', help=bench_gtf.__doc__)
+    gtf_parser.add_argument('path', nargs='?', help='GTF to parse, e.g. Homo_sapiens.GRCh38.109.gtf.gz (default is a synthetic one)')
+    gtf_parser.add_argument('--genes', type=int, default=60000)
+    gtf_parser.add_argument('--exons', type=int, default=8, help='exon rows per transcript of the synthetic GTF')
+    gtf_parser.add_argument('--workers', type=int, nargs='+', default=[0, 4], help='worker counts of the streaming parser to compare')
+    gtf_parser.add_argument('--repeat', type=int, default=1)
+    gtf_parser.add_argument('--seed', type=int, default=0)
+    gtf_parser.add_argument('--json', help='also write the report to this path')
+    gtf_parser.set_defaults(func=bench_gtf)
+
+    pipeline_parser = subparsers.add_parser('pipeline', help=bench_pipeline.__doc__)
+    pipeline_parser.add_argument('--folder', help='where to generate inputs and build (default is a new temporary folder)')
+    pipeline_parser.add_argument('--datasets', type=int, default=3)
+    pipeline_parser.add_argument('--matrices', type=int, default=2)
+    pipeline_parser.add_argument('--transcripts', type=int, default=1)
+    pipeline_parser.add_argument('--genes', type=int, default=20000)
+    pipeline_parser.add_argument('--samples', type=int, default=100)
+    pipeline_parser.add_argument('--encoding', default='float32')
+    pipeline_parser.add_argument('--seed', type=int, default=0)
+    pipeline_parser.add_argument('--baseline', help='JSON report of a previous run (e.g. another commit) to compare against')
+    pipeline_parser.add_argument('--json', help='also write the report to this path')
+    pipeline_parser.set_defaults(func=bench_pipeline)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -13,7 +13,7 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\ndata.proto\"\x19\n\x07RowData\x12\x0e\n\x06values\x18\x01 \x03(\x02\"8\n\tTableData\x12\x14\n\x0c\x66loat_values\x18\x01 \x03(\x02\x12\x15\n\rstring_values\x18\x02 \x03(\tb\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\ndata.proto\"g\n\x07RowData\x12\x0e\n\x06values\x18\x01 \x03(\x02\x12\x16\n\x0e\x66loat16_values\x18\x02 \x01(\x0c\x12\x15\n\ruint16_values\x18\x03 \x01(\x0c\x12\r\n\x05scale\x18\x04 \x01(\x01\x12\x0e\n\x06offset\x18\x05 \x01(\x01\"8\n\tTableData\x12\x14\n\x0c\x66loat_values\x18\x01 \x03(\x02\x12\x15\n\rstring_values\x18\x02 \x03(\t\"4\n\rNeighbourData\x12\r\n\x05genes\x18\x01 \x03(\r\x12\x14\n\x0c\x63orrelations\x18\x02 \x03(\x02\",\n\x0bSummaryData\x12\x0e\n\x06\x63ounts\x18\x01 \x03(\r\x12\r\n\x05stats\x18\x02 \x03(\x02\x62\x06proto3')
 
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
 _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'data_pb2', globals())
@@ -21,7 +21,11 @@ if _descriptor._USE_C_DESCRIPTORS == False:
 
   DESCRIPTOR._options = None
   _ROWDATA._serialized_start=14
-  _ROWDATA._serialized_end=39
-  _TABLEDATA._serialized_start=41
-  _TABLEDATA._serialized_end=97
+  _ROWDATA._serialized_end=117
+  _TABLEDATA._serialized_start=119
+  _TABLEDATA._serialized_end=175
+  _NEIGHBOURDATA._serialized_start=177
+  _NEIGHBOURDATA._serialized_end=229
+  _SUMMARYDATA._serialized_start=231
+  _SUMMARYDATA._serialized_end=275
 # @@protoc_insertion_point(module_scope)
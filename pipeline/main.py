@@ -1,53 +1,114 @@
-import tempfile, os, sys, csv, gzip, zlib, contextlib, itertools, re, array, io, shutil, datetime, json, struct, hashlib, math, collections.abc, logging
+import tempfile, os, sys, csv, gzip, zlib, contextlib, itertools, re, array, io, shutil, datetime, json, struct, hashlib, math, collections.abc, logging, warnings, time, resource
+import concurrent.futures, functools, heapq
 import oyaml, h5py, tqdm, boto3, numpy as np
 import data_pb2
 
 from typing import Callable, Iterable, Tuple, Dict, List
 from unittest.mock import patch
-from scipy.stats import f_oneway, spearmanr
+from scipy import special
+from scipy.stats import f_oneway, spearmanr, rankdata
 
 MIN_HITS = 2
 LOG2_OFFSET = 0.05
 GENE_LIMIT = None
 LOCAL_TMP = "tmp"
+CACHE_DIR = "cache"
+CACHE_VERSION = 3
 CATEGORY_LIMIT = None
+MATRIX_BLOCK_SIZE = 1024
+UINT16_NAN = 65535
+SORT_RUN_ROWS = 200000
+SUMMARY_STATS = ['mean', 'median', 'q1', 'q3', 'lowerWhisker', 'upperWhisker']
 
 class AnnotationException(Exception):
     pass
     
-def safe_access_nested(data, indices, default=None):
-    for index in indices:
-        if not isinstance(data, collections.abc.Sequence) or not abs(index) < len(data): return default
-        data = data[index]
-    return data
-
 def manage_deploy_local(asset_paths):
     '''Return local URL mapping - local server MUST support range requests'''
     return {os.path.basename(p): os.path.join('http://localhost:5501', os.path.relpath(p, '../')) for p in asset_paths}
 
-def calc_s3_etag(path, multipart_threshold, multipart_chunksize):
-    '''Calculate hash, used to avoid re-deploying identical files'''
+def calc_s3_etag(path, multipart_threshold, multipart_chunksize, manifest: Dict=None):
+    '''Calculate hash, used to avoid re-deploying identical files (only re-read when size/mtime/part sizes differ from the manifest, which keeps one entry per path)'''
+    stat = os.stat(path)
+    parts = [multipart_threshold, multipart_chunksize]
+    known = (manifest or {}).get('etags', {}).get(os.path.abspath(path), None)
+    if known and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns and known['parts'] == parts:
+        return known['etag']
+
     with open(path, 'rb') as f:
-        if os.stat(path).st_size < multipart_threshold:
-            return hashlib.md5(f.read()).hexdigest()
-        chunks_hashes = []
-        while (chunk := f.read(multipart_chunksize)):
-            chunks_hashes.append(hashlib.md5(chunk).digest())
-        return hashlib.md5(b''.join(chunks_hashes)).hexdigest() + '-' + str(len(chunks_hashes))
-      
-def manage_deploy_cloudfront(asset_paths, cloudfront_url=None, chunk_size=8388608, prefix='bithub'):
-    '''Upload list of files and return URL mapping'''
+        if stat.st_size < multipart_threshold:
+            etag = hashlib.md5(f.read()).hexdigest()
+        else:
+            chunks_hashes = []
+            while (chunk := f.read(multipart_chunksize)):
+                chunks_hashes.append(hashlib.md5(chunk).digest())
+            etag = hashlib.md5(b''.join(chunks_hashes)).hexdigest() + '-' + str(len(chunks_hashes))
+    if manifest is not None:
+        manifest.setdefault('etags', {})[os.path.abspath(path)] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'parts': parts, 'etag': etag}
+    return etag
+
+def get_multipart_upload(s3, bucket: str, key: str, **kwargs):
+    '''Latest unfinished multipart upload of key (or a new one) along with {part number: (etag, size)} of parts already uploaded'''
+    uploads = [u for page in s3.get_paginator('list_multipart_uploads').paginate(Bucket=bucket, Prefix=key) for u in page.get('Uploads', []) if u['Key'] == key]
+    if not uploads:
+        return s3.create_multipart_upload(Bucket=bucket, Key=key, **kwargs)['UploadId'], {}
+    upload_id = max(uploads, key=lambda u: u['Initiated'])['UploadId']
+    parts = {p['PartNumber']: (p['ETag'].strip('"'), p['Size']) for page in s3.get_paginator('list_parts').paginate(Bucket=bucket, Key=key, UploadId=upload_id) for p in page.get('Parts', [])}
+    return upload_id, parts
+
+def upload_s3_part(s3, bucket: str, key: str, upload_id: str, path: str, part_number: int, offset: int, size: int, uploaded: Dict):
+    '''Upload a part of a multipart upload unless an interrupted deploy already uploaded the same bytes, returning (part, bytes uploaded)'''
+    with io.open(path, 'rb') as f:
+        f.seek(offset)
+        chunk = f.read(size)
+    etag = hashlib.md5(chunk).hexdigest()
+    if uploaded.get(part_number, None) == (etag, len(chunk)):
+        return {'PartNumber': part_number, 'ETag': f'"{etag}"'}, 0
+    response = s3.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number, Body=chunk)
+    return {'PartNumber': part_number, 'ETag': response['ETag']}, len(chunk)
+
+def put_s3_object(s3, bucket: str, key: str, path: str, **kwargs):
+    '''Upload a file below the multipart threshold in a single request, returning (None, bytes uploaded)'''
+    with io.open(path, 'rb') as f:
+        body = f.read()
+    s3.put_object(Bucket=bucket, Key=key, Body=body, **kwargs)
+    return None, len(body)
+
+def manage_deploy_cloudfront(asset_paths, cloudfront_url=None, bucket='bithub-bucket', chunk_size=8388608, prefix='bithub', workers=8):
+    '''Upload changed files (concurrently, resuming interrupted multipart uploads) and return URL mapping'''
     s3 = boto3.client('s3')
-    for path, name in zip(asset_paths, map(os.path.basename, asset_paths)):
-        name = prefix + '/' + name
-        s3_hash = None
-        with contextlib.suppress(s3.exceptions.ClientError):
-            s3_head = s3.head_object(Bucket='bithub-bucket', Key=name)
-            s3_hash = s3_head.get('ETag')[1:-1]
-            
-        if not s3_hash or calc_s3_etag(path, chunk_size, chunk_size) != s3_hash:
-            s3.upload_file(path, 'bithub-bucket', name, ExtraArgs={'CacheControl': 'max-age=3600'},
-                           Config=boto3.s3.transfer.TransferConfig(multipart_threshold=chunk_size, multipart_chunksize=chunk_size))
+    keys = {path: prefix + '/' + os.path.basename(path) for path in asset_paths}
+    extra_args = {'CacheControl': 'max-age=3600'}
+
+    # A single listing of remote ETags rather than a head request per file
+    remote = {}
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix + '/'):
+        remote.update((o['Key'], o['ETag'].strip('"')) for o in page.get('Contents', []))
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        with cache_manifest() as manifest:
+            etags = list(executor.map(lambda path: calc_s3_etag(path, chunk_size, chunk_size, manifest), asset_paths))
+        changed = [path for path, etag in zip(asset_paths, etags) if remote.get(keys[path], None) != etag]
+        report_count('deploy', 'unchanged', len(asset_paths) - len(changed))
+
+        # Parts of all files are uploaded by the same pool, each multipart upload is completed once its parts are done
+        pending = []
+        for path in changed:
+            size = os.path.getsize(path)
+            if size < chunk_size:
+                pending.append((keys[path], None, [executor.submit(put_s3_object, s3, bucket, keys[path], path, **extra_args)]))
+                continue
+            upload_id, uploaded = get_multipart_upload(s3, bucket, keys[path], **extra_args)
+            parts = [executor.submit(upload_s3_part, s3, bucket, keys[path], upload_id, path, i + 1, offset, chunk_size, uploaded) for i, offset in enumerate(range(0, size, chunk_size))]
+            pending.append((keys[path], upload_id, parts))
+
+        for key, upload_id, futures in pending:
+            results = [f.result() for f in futures]
+            if upload_id:
+                s3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={'Parts': [part for part, _ in results]})
+                report_count('deploy', 'parts resumed', sum(1 for _, n in results if not n))
+            report_count('deploy', 'uploaded')
+            report_count('deploy', 'bytes uploaded', sum(n for _, n in results))
 
     return {n: f'https://{cloudfront_url}/{prefix}/{n}' for n in map(os.path.basename, asset_paths)}
 
@@ -58,9 +119,181 @@ def pad_elipses(string, length=20):
     return (' ' * (length - len(string))) + string
 
 def calc_zscore(logs):
-    log_mean = np.mean(logs)
-    log_sd = np.std(logs) or 0.0000000001
-    return np.array([((x - log_mean) / log_sd) for x in logs], dtype='f4')
+    '''Z-scores of log means along the last axis, e.g. of a matrices x genes array'''
+    logs = np.asarray(logs, dtype='f8')
+    log_mean = logs.mean(axis=-1, keepdims=True)
+    log_sd = logs.std(axis=-1, keepdims=True)
+    log_sd[log_sd == 0] = 0.0000000001
+    return ((logs - log_mean) / log_sd).astype('f4')
+
+def calc_log_means(block: np.ndarray, filter_indices: List[np.ndarray]):
+    '''Mean log2 expression of each row of a genes x samples block, overall and within each (region) group of sample indices'''
+    logged = np.log2(np.abs(block) + LOG2_OFFSET)
+    with warnings.catch_warnings():
+        # Empty groups have a NaN mean
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return logged.mean(axis=1), np.stack([logged[:, indices].mean(axis=1) for indices in filter_indices], axis=1) if len(filter_indices) else np.empty((len(block), 0))
+
+def calc_neighbours(logged: np.ndarray, k: int, block_size: int=MATRIX_BLOCK_SIZE, max_block_bytes: int=1 << 26):
+    '''Top k Pearson correlated rows of each row of a genes x samples (log) array as (rows, correlations), most correlated first and padded with -1/NaN.
+    Correlations of a block of rows against all rows are a single float32 product, with blocks sized so only the top k of each row is kept beyond them'''
+    n = len(logged)
+    rows, correlations = np.full((n, k), -1, dtype=np.int32), np.full((n, k), np.nan, dtype='f4')
+    if n < 2 or not k:
+        return rows, correlations
+
+    # Centre and scale rows so products are correlations, missing values contribute nothing and constant rows aren't anyone's neighbours
+    with warnings.catch_warnings():
+        # Rows without any values have a NaN mean
+        warnings.simplefilter('ignore', RuntimeWarning)
+        z = np.asarray(logged, dtype='f4') - np.nanmean(logged, axis=1, keepdims=True, dtype='f8').astype('f4')
+    z[np.isnan(z)] = 0
+    norms = np.linalg.norm(z, axis=1)
+    constant = ~(norms > 0)
+    z /= np.where(constant, 1, norms)[:, None]
+
+    k = min(k, n - 1 - int(constant.sum()))
+    block_size = max(1, min(block_size, max_block_bytes // (4 * n)))
+    for start in range(0, n if k > 0 else 0, block_size):
+        block = z[start:start + block_size] @ z.T
+        block[:, constant] = -np.inf
+        block[np.arange(len(block)), np.arange(start, start + len(block))] = -np.inf
+        top = np.argpartition(block, -k, axis=1)[:, -k:]
+        top_values = np.take_along_axis(block, top, axis=1)
+        order = np.argsort(-top_values, axis=1, kind='stable')
+        rows[start:start + len(block), :k] = np.take_along_axis(top, order, axis=1)
+        correlations[start:start + len(block), :k] = np.clip(np.take_along_axis(top_values, order, axis=1), -1, 1)
+    rows[constant], correlations[constant] = -1, np.nan
+    return rows, correlations
+
+def calc_segment_neighbours(rows_path: str, ranges: np.ndarray, k: int):
+    '''Top k co-expressed rows (see calc_neighbours) of a segment matrix, from its encoded rows decoded into a temporary memory map of log2 values'''
+    if not len(ranges):
+        return calc_neighbours(np.empty((0, 0), dtype='f4'), k)
+    with open(rows_path, 'rb') as f, tempfile.TemporaryFile(dir=os.path.dirname(rows_path)) as tmp:
+        logged = None
+        for i, (start, end) in enumerate(ranges):
+            f.seek(start)
+            values = decode_row_values(data_pb2.RowData.FromString(zlib.decompress(f.read(end - start))))
+            if logged is None:
+                logged = np.memmap(tmp, dtype='f4', mode='w+', shape=(len(ranges), len(values)))
+            logged[i] = np.log2(np.abs(values) + LOG2_OFFSET)
+        return calc_neighbours(logged, k)
+
+def calc_spearman_block(block: np.ndarray, valid: np.ndarray, column: np.ndarray, ranks_cache: Dict):
+    '''Spearman (rho, pvalue) of each row against a numeric column, matching spearmanr(row, column, nan_policy='omit')'''
+    result = np.full((len(block), 2), np.nan)
+    column = np.asarray(column, dtype='f8')
+    if not len(column) or (column == column[0]).all():
+        return result
+
+    # NOTE: spearmanr rejects constant inputs before omitting NaNs, and only uses the masked path if any are present
+    row_const = (block == block[:, :1]).all(axis=1)
+    combined = valid & ~np.isnan(column)
+    has_nan = ~combined.all(axis=1)
+    patterns, inverse = np.unique(combined, axis=0, return_inverse=True)
+    for p, mask in enumerate(patterns):
+        rows = np.where(inverse.ravel() == p)[0]
+        n = int(mask.sum())
+        if n < 2: continue
+
+        # Rank each distinct omission pattern once, shared between all columns of the block
+        key = (mask.tobytes(), rows.tobytes())
+        if (rx := ranks_cache.get(key, None)) is None:
+            rx = rankdata(block[np.ix_(rows, mask)], axis=1)
+            rx -= rx.mean(axis=1, keepdims=True)
+            ranks_cache[key] = rx
+        ry = rankdata(column[mask])
+        ry -= ry.mean()
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rs = (rx @ ry) / np.sqrt((rx * rx).sum(axis=1) * (ry @ ry))
+            rs = np.where(has_nan[rows] & ~np.isfinite(rs), 0.0, rs)
+            dof = n - 2
+            t = rs * np.sqrt((dof / ((rs + 1.0) * (1.0 - rs))).clip(0))
+            pvalue = special.stdtr(dof, -np.abs(t)) * 2
+
+        # Masked path treats all-zero pairs as undefined
+        all_zero = ~block[np.ix_(rows, mask)].any(axis=1) & ~column[mask].any()
+        keep = ~row_const[rows] & ~(has_nan[rows] & all_zero)
+        result[rows[keep], 0] = rs[keep]
+        result[rows[keep], 1] = pvalue[keep]
+    return result
+
+def calc_anova_block(block: np.ndarray, valid: np.ndarray, groups: List[np.ndarray]):
+    '''One-way ANOVA (F, pvalue) of each row across column groups, matching f_oneway(*groups, nan_policy='omit')'''
+    membership = np.zeros((block.shape[1], len(groups)))
+    for k, g in enumerate(groups): membership[g, k] = 1.0
+
+    counts = valid @ membership
+    bign = counts.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        offset = np.where(valid, block, 0.0).sum(axis=1) / bign
+        centered = np.where(valid, block - offset[:, None], 0.0)
+        normalized_ss = centered.sum(axis=1)**2 / bign
+        sstot = (centered * centered).sum(axis=1) - normalized_ss
+        ssbn = ((centered @ membership)**2 / counts).sum(axis=1) - normalized_ss
+        dfbn, dfwn = len(groups) - 1, bign - len(groups)
+        f = (ssbn / dfbn) / ((sstot - ssbn) / dfwn)
+
+    lows, highs = np.where(valid, block, np.inf), np.where(valid, block, -np.inf)
+    is_const = np.stack([lows[:, g].min(axis=1) == highs[:, g].max(axis=1) for g in groups], axis=1)
+    f[is_const.all(axis=1)] = np.inf
+    f[lows.min(axis=1) == highs.max(axis=1)] = np.nan
+    f[(counts == 0).any(axis=1) | (counts == 1).all(axis=1)] = np.nan
+    return np.stack([f, special.fdtrc(dfbn, dfwn, f)], axis=1)
+
+def calc_summary_block(block: np.ndarray, columns: List[Tuple[str, np.ndarray, List[np.ndarray], Dict, str]]):
+    '''Box plot statistics (SUMMARY_STATS, quartiles interpolated as np.percentile and whiskers at the furthest values within 1.5 IQR) of each row of a genes x samples block
+    within each group of each categorical column (see summary_layout), ignoring NaNs, as the number of values (genes x groups) and genes x (groups x stats)'''
+    block = np.asarray(block, dtype='f8')
+    counts, stats = [], []
+    for _, _, groups, _, _ in columns:
+        for indices in groups or []:
+            values = np.sort(block[:, indices], axis=1)
+            n = (~np.isnan(values)).sum(axis=1)
+
+            # Linearly interpolate quartiles between sorted values, NaNs being sorted last
+            position = np.maximum(n - 1, 0)[:, None] * np.array([0.25, 0.5, 0.75])
+            below = np.floor(position).astype(np.intp)
+            lower_values = np.take_along_axis(values, below, axis=1) if values.shape[1] else np.full(position.shape, np.nan)
+            upper_values = np.take_along_axis(values, np.minimum(below + 1, np.maximum(n - 1, 0)[:, None]), axis=1) if values.shape[1] else lower_values
+            q1, median, q3 = (lower_values + (upper_values - lower_values) * (position - below)).T
+
+            with warnings.catch_warnings():
+                # Groups without values have NaN statistics
+                warnings.simplefilter('ignore', RuntimeWarning)
+                iqr = q3 - q1
+                lower = np.nanmin(np.where(values >= (q1 - 1.5 * iqr)[:, None], values, np.nan), axis=1, initial=np.inf)
+                upper = np.nanmax(np.where(values <= (q3 + 1.5 * iqr)[:, None], values, np.nan), axis=1, initial=-np.inf)
+                mean = np.nanmean(values, axis=1)
+            summary = np.stack([mean, median, q1, q3, lower, upper], axis=1)
+            summary[n == 0] = np.nan
+            counts.append(n)
+            stats.append(summary)
+    return (np.stack(counts, axis=1), np.concatenate(stats, axis=1)) if stats else (np.empty((len(block), 0), dtype=np.int64), np.empty((len(block), 0)))
+
+def summary_layout(columns: List[Tuple[str, np.ndarray, List[np.ndarray], Dict, str]]):
+    '''Names of the categorical columns summarised by calc_summary_block and labels of their groups, in the order of its output'''
+    names, labels = [], []
+    for header, array, groups, _, _ in columns:
+        if groups:
+            names.append(header)
+            labels.append([array[indices[0]].decode() for indices in groups])
+    return names, labels
+
+def calc_pvalues_block(block: np.ndarray, columns: List[Tuple[str, np.ndarray, List[np.ndarray], Dict, str]]):
+    '''Calculate (statistic, pvalue) pairs of a genes x samples block against every metadata column'''
+    block = np.asarray(block, dtype='f8')
+    valid = ~np.isnan(block)
+    result = np.full((len(block), 2 * len(columns)), np.nan)
+    ranks_cache = {}
+    for i, (header, array, groups, attrs, col_type) in enumerate(columns):
+        if not groups:
+            result[:, 2*i:2*i+2] = calc_spearman_block(block, valid, array, ranks_cache)
+        elif len(groups) > 1:
+            result[:, 2*i:2*i+2] = calc_anova_block(block, valid, groups)
+    return result
 
 def iterate_unique(a: Iterable, cmp_key: Callable=lambda x: x):
     '''Filter out repetitions from a sorted iterable'''
@@ -79,7 +312,7 @@ def open_with_progress(path, *args, **kwargs):
     '''An io.open wrapper that displays a progress bar when opened in read mode'''
     mode = args[0] if len(args) else kwargs.get('mode', 'r')
     iter = io.open(path, *args, **kwargs)
-    if not kwargs.get('show_progress', True) or mode not in ['r', 'rb', 'rt']:
+    if not kwargs.get('show_progress', True) or mode not in ['r', 'rb', 'rt'] or isinstance(path, int):
         return iter
     else:
         avg_bytes = (4 if mode in ['r', 'rt'] else 1)
@@ -144,6 +377,92 @@ def apply_reorder_indices(input, buffer, steps):
             buffer[i] = input[j]
     return buffer
 
+def get_reorder_array(target_order, given_order):
+    '''Determine an index array (and mask of missing elements) to reorder elements in given_order to target_order with apply_reorder_array'''
+    indices = np.array([-1 if j is None else j for j in get_reorder_indices(target_order, given_order)], dtype=np.intp)
+    return indices, indices < 0
+
+def apply_reorder_array(values: np.ndarray, reorder: Tuple[np.ndarray, np.ndarray], dtype='f4', fill=np.nan):
+    '''Reorder the last axis of a row or genes x samples block in one gather, with fill for missing (or out of range) elements'''
+    values = np.asarray(values)
+    indices, missing = reorder
+    missing = missing | (indices >= values.shape[-1])
+    if not values.shape[-1]:
+        return np.full(values.shape[:-1] + indices.shape, fill, dtype=dtype)
+    fixed = values.take(np.where(missing, 0, indices), axis=-1).astype(dtype)
+    fixed[..., missing] = fill
+    return fixed
+
+_run_report = {}
+
+def report_count(group: str, key: str, n: int=1):
+    '''Increment a counter of the run report (a no-op outside of run_report)'''
+    if group in _run_report:
+        _run_report[group][key] = _run_report[group].get(key, 0) + n
+
+def report_time(name: str, seconds: float, calls: int=1):
+    '''Add time spent in a build stage to the run report'''
+    if 'stages' in _run_report:
+        stage = _run_report['stages'].setdefault(name, {'seconds': 0.0, 'calls': 0})
+        stage['seconds'] += seconds
+        stage['calls'] += calls
+
+@contextlib.contextmanager
+def report_stage(name: str):
+    '''Time a build stage for the run report (stages may nest, so their times overlap)'''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        report_time(name, time.perf_counter() - start)
+
+@contextlib.contextmanager
+def run_report(path: str, profiler: str=None):
+    '''Collect stage timings and counters of a build into a JSON report at path, optionally profiling the main process with cProfile (.prof) or pyinstrument (.html) alongside'''
+    _run_report.clear()
+    _run_report.update(started=datetime.datetime.now().isoformat(timespec='seconds'), stages={}, datasets={}, bytes_written={}, cache={}, deploy={}, annotation_failures={}, warnings={})
+
+    # Count warnings as they are logged (or replayed from the cache), e.g. "<path>\tfailed to annotate\tgene\t<id>"
+    class WarningCounter(logging.Handler):
+        def emit(self, record):
+            fields = record.getMessage().split('\t')
+            report_count('warnings', 'other' if len(fields) < 2 else 'below MIN_HITS' if fields[1].startswith('only in') else fields[1])
+            if len(fields) > 2 and fields[1] == 'failed to annotate':
+                report_count('annotation_failures', fields[2])
+    handler = WarningCounter(logging.WARNING)
+    logging.getLogger().addHandler(handler)
+
+    profile = None
+    if profiler == 'cprofile':
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+    elif profiler == 'pyinstrument':
+        import pyinstrument
+        profile = pyinstrument.Profiler()
+        profile.start()
+    elif profiler:
+        raise Exception(f'Unknown profiler {profiler}, expected cprofile or pyinstrument')
+
+    start = time.perf_counter()
+    try:
+        yield _run_report
+    finally:
+        logging.getLogger().removeHandler(handler)
+        if profiler == 'cprofile':
+            profile.disable()
+            profile.dump_stats(os.path.splitext(path)[0] + '.prof')
+        elif profiler == 'pyinstrument':
+            profile.stop()
+            with io.open(os.path.splitext(path)[0] + '.html', 'w') as f:
+                f.write(profile.output_html())
+
+        _run_report['seconds'] = time.perf_counter() - start
+        _run_report['peak_rss_mb'] = {who: resource.getrusage(r).ru_maxrss / 1024 for who, r in [('main', resource.RUSAGE_SELF), ('workers', resource.RUSAGE_CHILDREN)]}
+        with io.open(path, 'w') as f:
+            json.dump(_run_report, f, indent=2)
+        _run_report.clear()
+
 @contextlib.contextmanager
 def context_closer():
     contexts = []
@@ -153,30 +472,191 @@ def context_closer():
         for c in contexts: 
             c.__exit__(None, None, None)
 
+def compress_row(binary):
+    '''Compress a serialized row so it can be written as an independently retrievable range'''
+    return zlib.compress(binary, level=-1)
+
+def encode_row_values(values: np.ndarray, encoding: str='float32'):
+    '''RowData of values, optionally quantized to float16 or log-scaled uint16 (rows that can't be represented stay float32)'''
+    row = data_pb2.RowData()
+    values = np.asarray(values, dtype='f4')
+    finite = np.isfinite(values)
+    if encoding == 'float16' and not np.any(np.abs(values[finite]) > np.finfo(np.float16).max):
+        row.float16_values = values.astype('<f2').tobytes()
+    elif encoding == 'uint16' and finite.any() and np.all(finite | np.isnan(values)):
+        scaled = np.arcsinh(values[finite].astype('f8'))
+        row.scale = (scaled.max() - scaled.min()) / (UINT16_NAN - 2) or 1.0
+
+        # Align the grid so zeros (common in expression matrices) are exact
+        row.offset = scaled.min() if scaled.min() > 0 else -np.round(-scaled.min() / row.scale) * row.scale
+        quantized = np.full(len(values), UINT16_NAN, dtype='<u2')
+        quantized[finite] = np.clip(np.round((scaled - row.offset) / row.scale), 0, UINT16_NAN - 1)
+        row.uint16_values = quantized.tobytes()
+    elif encoding not in ['float32', 'float16', 'uint16']:
+        raise ValueError(f'unsupported encoding {encoding}')
+    else:
+        row.values.extend(values.tolist())
+    return row
+
+def decode_row_values(row):
+    '''Values of a RowData as float32, whichever encoding it was written with'''
+    if row.float16_values:
+        return np.frombuffer(row.float16_values, dtype='<f2').astype('f4')
+    if row.uint16_values:
+        quantized = np.frombuffer(row.uint16_values, dtype='<u2')
+        return np.where(quantized == UINT16_NAN, np.nan, np.sinh(quantized * row.scale + row.offset)).astype('f4')
+    return np.array(row.values, dtype='f4')
+
 @contextlib.contextmanager
 def write_compressed_ranges(path: str):
     '''Write independently retrievable gzipped float ranges to a binary file'''
     with open(path, 'wb') as f:
-        def write_row(binary):
+        def write_row(binary, compressed=False):
             start = f.tell()
-            f.write(zlib.compress(binary, level=-1))
+            f.write(binary if compressed else compress_row(binary))
             return start, f.tell()
         yield write_row, f.tell
 
 @contextlib.contextmanager
-def read_compressed_ranges(path: str):
-    '''Read independently retrievable gzipped float ranges from a binary file'''
+def read_compressed_ranges(path: str, dictionary: bytes=None):
+    '''Read independently retrievable compressed float ranges from a binary file, given the dictionary attribute of their range dataset'''
+    _, decompress = get_row_codec(dictionary=dictionary)
     with open_with_progress(path, 'rb') as f:
         def read_row(start, end, row_length):
             f.seek(start)
-            return zlib.decompress(f.read(end - start))
+            return decompress(f.read(end - start))
         yield read_row
 
+def gene_record_header(parts: List[Tuple[int, bytes]]):
+    '''Header of a gene-major record: the number of parts, then the stream (index into the streams attribute of gene_ranges) and length of each, as little-endian uint32'''
+    return np.array([len(parts), *itertools.chain.from_iterable((stream, len(binary)) for stream, binary in parts)], dtype='<u4').tobytes()
+
+def split_gene_record(record: bytes):
+    '''Split a gene-major record (header followed by its compressed rows) into {stream: compressed row}'''
+    n = int(np.frombuffer(record, dtype='<u4', count=1)[0])
+    header = np.frombuffer(record, dtype='<u4', count=2 * n, offset=4).reshape(n, 2).astype(np.int64)
+    ends = 4 + 8 * n + np.cumsum(header[:, 1])
+    return {stream: record[end - length:end] for (stream, length), end in zip(header.tolist(), ends.tolist())}
+
+def get_row_codec(level: int=None, dictionary: bytes=None):
+    '''Return zlib (compress, decompress) functions for independently retrievable rows, optionally sharing a preset dictionary'''
+    level = -1 if level is None else level
+    if not dictionary:
+        return (lambda binary: zlib.compress(binary, level)), zlib.decompress
+    def compress(binary):
+        c = zlib.compressobj(level, zdict=dictionary)
+        return c.compress(binary) + c.flush()
+    def decompress(binary):
+        d = zlib.decompressobj(zdict=dictionary)
+        return d.decompress(binary) + d.flush()
+    return compress, decompress
+
+def train_row_dictionary(samples: List[bytes], size: int=32768):
+    '''Build a shared dictionary from serialized row samples, returning None if there is nothing to learn from'''
+    # zlib has no trainer, but only needs content likely to recur within its 32KB window (sample rows themselves work well)
+    return b''.join(samples)[-min(size, 32768):] or None
+
+_block_metadata = {}
+
+def init_block_worker(all_metadata_columns):
+    '''Share parsed metadata columns with a (worker) process once rather than per block'''
+    _block_metadata.clear()
+    _block_metadata.update(all_metadata_columns)
+
+def encode_matrix_block(dataset_id, block, reorder, filter_indices, encoding='float32', summaries=False):
+    '''Reorder a genes x samples block of matrix rows and return their compressed (pvalue, expression, summary or None) rows, log means (genes, genes x regions), max (absolute, relative) encoding error and stage timings'''
+    start = time.perf_counter()
+    fixed_block = apply_reorder_array(block, reorder, dtype='f8')
+    reordered = time.perf_counter()
+    pvalues_block = calc_pvalues_block(fixed_block, _block_metadata[dataset_id][0])
+    timings = {'reorder': reordered - start, 'pvalues': time.perf_counter() - reordered}
+    summary_rows = [None] * len(fixed_block)
+    if summaries:
+        start = time.perf_counter()
+        counts_block, stats_block = calc_summary_block(fixed_block, _block_metadata[dataset_id][0])
+        summary_rows = [compress_row(data_pb2.SummaryData(counts=counts, stats=stats).SerializeToString()) for counts, stats in zip(counts_block.tolist(), stats_block.tolist())]
+        timings['summaries'] = time.perf_counter() - start
+    start = time.perf_counter()
+
+    rows, errors = [], np.zeros(2)
+    for fixed_array, pvalues, summary_row in zip(fixed_block, pvalues_block.tolist(), summary_rows):
+        pvalue_row = data_pb2.RowData()
+        pvalue_row.values.extend(pvalues)
+        row = encode_row_values(fixed_array, encoding)
+        rows.append((compress_row(pvalue_row.SerializeToString()), compress_row(row.SerializeToString()), summary_row))
+
+        # Compare quantized values to what float32 would have written
+        if encoding != 'float32':
+            exact = fixed_array.astype('f4')
+            error = np.abs(decode_row_values(row) - exact)[np.isfinite(exact)]
+            if len(error):
+                errors = np.fmax(errors, [error.max(), (error / np.maximum(np.abs(exact[np.isfinite(exact)]), np.finfo('f4').tiny)).max()])
+
+    # Get logs for zscore calc, overall and per region subset
+    logs, logs_filter = calc_log_means(fixed_block, filter_indices)
+    timings['encode'] = time.perf_counter() - start
+    return rows, logs, logs_filter, errors, timings
+
+@contextlib.contextmanager
+def ordered_block_writer(workers: int=0, initializer: Callable=None, initargs: Tuple=()):
+    '''Hand results of (optionally process pooled) jobs to their callbacks in submission order, so output does not depend on worker count'''
+    pending, pooled = collections.deque(), [0]
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=initializer, initargs=initargs) if workers else contextlib.nullcontext() as executor:
+        if not executor and initializer: initializer(*initargs)
+        
+        def flush(wait_all=False):
+            # Bound memory by waiting on the oldest job once enough are queued
+            while pending and (wait_all or pending[0][0].done() or pooled[0] > 2 * workers):
+                future, callback, is_pooled = pending.popleft()
+                pooled[0] -= is_pooled
+                callback(future.result())
+
+        def put(callback, result):
+            future = concurrent.futures.Future()
+            future.set_result(result)
+            pending.append((future, callback, False))
+            flush()
+
+        def submit(callback, func, *args):
+            if not executor: return put(callback, func(*args))
+            pending.append((executor.submit(func, *args), callback, True))
+            pooled[0] += 1
+            flush()
+
+        yield submit, put
+        flush(wait_all=True)
+
 @contextlib.contextmanager
-def iterate_csv(path: str, strip_numeric: bool=False, comment=None, skip=0, delimiter=',', csv_kwargs={}, file_kwargs={}):
-    '''Iterate over a CSV file, optional .gz, optional leading numeric column'''
+def open_gzip_tee(path: str, gzip_path: str, chunk_size: int=1048576):
+    '''Open path for reading text, compressing everything read into gzip_path in a background thread'''
+    with open(path, 'rb') as raw, gzip.open(gzip_path, 'wb', compresslevel=6) as gz, concurrent.futures.ThreadPoolExecutor(1) as executor:
+        pending = collections.deque()
+        def write(chunk):
+            # zlib releases the GIL, so compression overlaps with parsing (bounded to a few chunks ahead)
+            pending.append(executor.submit(gz.write, chunk))
+            while len(pending) > 8: pending.popleft().result()
+
+        class TeeReader(io.RawIOBase):
+            def readable(self):
+                return True
+
+            def readinto(self, buffer):
+                chunk = raw.read(len(buffer))
+                buffer[:len(chunk)] = chunk
+                if chunk: write(chunk)
+                return len(chunk)
+
+        yield io.TextIOWrapper(io.BufferedReader(TeeReader(), chunk_size), newline='')
+
+        # Compress anything left unread
+        while (chunk := raw.read(chunk_size)): write(chunk)
+        for p in pending: p.result()
+
+@contextlib.contextmanager
+def iterate_csv(path: str, strip_numeric: bool=False, comment=None, skip=0, delimiter=',', csv_kwargs={}, file_kwargs={}, tee_gzip: str=None):
+    '''Iterate over a CSV file, optional .gz, optional leading numeric column, optionally gzipping the input to tee_gzip while reading'''
     csv_kwargs = {**csv_kwargs, 'delimiter': delimiter}
-    with gzip.open(path, mode='rt', newline='') if path.endswith('.gz') else open(path,  mode='r', newline='', **file_kwargs) as f:
+    with gzip.open(path, mode='rt', newline='') if path.endswith('.gz') else open_gzip_tee(path, tee_gzip) if tee_gzip else open(path,  mode='r', newline='', **file_kwargs) as f:
         rows = csv.reader(f, **csv_kwargs)
         if comment: rows = filter(lambda row: not row or not row[0].startswith(comment), rows)
         if skip: rows = itertools.islice(rows, skip, None)
@@ -195,75 +675,289 @@ def iterate_csv(path: str, strip_numeric: bool=False, comment=None, skip=0, deli
         yield headers, ret
 
 @contextlib.contextmanager
-def iterate_csv_sorted(path: str, strip_numeric: bool=False, comment: str=None, skip: int=0, delimiter: str=',', mutator: Callable=None, csv_kwargs={}, file_kwargs={}, use_cache=True, create_cache=True):
-    '''Iterate over a CSV file, optionally gzipped, annotated by annotator function'''
+def cache_manifest():
+    '''Load and atomically save the manifest describing cache entries and hashed source files'''
+    manifest_path = os.path.join(os.path.abspath(CACHE_DIR), 'manifest.json')
+    manifest = {'sources': {}, 'entries': {}}
+    with contextlib.suppress(FileNotFoundError, json.JSONDecodeError):
+        with io.open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+    yield manifest
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    with io.open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+def hash_file(path: str, manifest: Dict=None, chunk_size: int=8388608):
+    '''Content hash of a file, only re-read when its size/mtime differ from the manifest'''
+    stat = os.stat(path)
+    known = (manifest or {}).get('sources', {}).get(os.path.abspath(path), None)
+    if known and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+        return known['sha256']
+
+    digest = hashlib.sha256()
+    with io.open(path, 'rb') as f:
+        while (chunk := f.read(chunk_size)):
+            digest.update(chunk)
+    if manifest is not None:
+        manifest['sources'][os.path.abspath(path)] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest.hexdigest()}
+    return digest.hexdigest()
+
+def get_cache_path(path: str | List[str], kind: str, fingerprint: str='', name: str=None):
+    '''Content-addressed cache location for a derivative of path(s), keyed on their content, kind and any other inputs (fingerprint)'''
+    paths = [path] if isinstance(path, str) else list(path)
+    with cache_manifest() as manifest:
+        key = hashlib.sha256('\0'.join([str(CACHE_VERSION), *(hash_file(p, manifest) for p in paths), kind, fingerprint]).encode()).hexdigest()[:24]
+        name = f'{name or os.path.basename(paths[0])}.{key}.{kind}'
+        entry = manifest['entries'].setdefault(name, {})
+        entry.update(sources=[os.path.abspath(p) for p in paths], last_used=time.time())
+    cache_path = os.path.join(os.path.abspath(CACHE_DIR), name)
+    report_count('cache', f'{kind} {"hit" if os.path.exists(cache_path) else "miss"}')
+    return cache_path
+
+def store_cache_entry(build_path: str, cache_path: str):
+    '''Move a built file/folder into the cache and record its size for eviction'''
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    shutil.move(build_path, cache_path)
+    with cache_manifest() as manifest:
+        entry = manifest['entries'].setdefault(os.path.basename(cache_path), {'last_used': time.time()})
+        entry['bytes'] = sum(os.path.getsize(os.path.join(r, f)) for r, _, fs in os.walk(cache_path) for f in fs) if os.path.isdir(cache_path) else os.path.getsize(cache_path)
+    return cache_path
+
+def evict_cache(max_bytes: int=None):
+    '''Remove untracked cache entries, then least recently used entries until the cache fits in max_bytes'''
+    cache_dir = os.path.abspath(CACHE_DIR)
+    if not os.path.isdir(cache_dir): return
+    with cache_manifest() as manifest:
+        entries = manifest['entries']
+        for name in os.listdir(cache_dir):
+            if name not in entries and not name.startswith('manifest.json'):
+                logging.info(f'evicting untracked cache entry {name}')
+                shutil.rmtree(os.path.join(cache_dir, name)) if os.path.isdir(os.path.join(cache_dir, name)) else os.remove(os.path.join(cache_dir, name))
+        for name in [n for n in entries if not os.path.exists(os.path.join(cache_dir, n))]:
+            del entries[name]
+
+        total = sum(e.get('bytes', 0) for e in entries.values())
+        for name in sorted(entries, key=lambda n: entries[n].get('last_used', 0)):
+            if max_bytes is None or total <= max_bytes: break
+            logging.info(f'evicting least recently used cache entry {name}')
+            path = os.path.join(cache_dir, name)
+            shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+            total -= entries.pop(name).get('bytes', 0)
+
+        # Forget hashes of sources no longer referenced, and ETags of deployed files that no longer exist
+        used_sources = set(p for e in entries.values() for p in e.get('sources', []))
+        manifest['sources'] = {k: v for k, v in manifest['sources'].items() if k in used_sources}
+        manifest['etags'] = {k: v for k, v in manifest.get('etags', {}).items() if os.path.exists(k)}
+
+@contextlib.contextmanager
+def capture_warnings(path: str):
+    '''Record warnings logged within the context to path, so they can be replayed when cached outputs are reused'''
+    with io.open(path, 'w') as f:
+        handler = logging.StreamHandler(f)
+        handler.setLevel(logging.WARNING)
+        logging.getLogger().addHandler(handler)
+        try:
+            yield
+        finally:
+            logging.getLogger().removeHandler(handler)
+
+def replay_warnings(path: str):
+    '''Log warnings recorded by capture_warnings again, since they would be hidden by the cache'''
+    with io.open(path, 'r') as f:
+        for line in f: logging.warning(line.rstrip('\n'))
+
+@contextlib.contextmanager
+def sort_external(rows: Iterable[List[str]], tmpdirname: str, run_rows: int=SORT_RUN_ROWS):
+    '''Sort CSV rows in bounded memory, spilling sorted runs of run_rows to disk and lazily merging them'''
+    with context_closer() as contexts:
+        runs = []
+        for chunk in iter(lambda: list(itertools.islice(rows, run_rows)), []):
+            chunk.sort()
+            if not runs and len(chunk) < run_rows:
+                runs.append(iter(chunk))
+                break
+
+            run_path = os.path.join(tmpdirname, f'run_{len(runs)}.csv')
+            with io.open(run_path, 'w', newline='') as f:
+                csv.writer(f).writerows(chunk)
+            contexts.append(io.open(run_path, 'r', newline=''))
+            runs.append(csv.reader(contexts[-1]))
+        yield heapq.merge(*runs)
+
+@contextlib.contextmanager
+def iterate_csv_sorted(path: str, strip_numeric: bool=False, comment: str=None, skip: int=0, delimiter: str=',', mutator: Callable=None, csv_kwargs={}, file_kwargs={}, use_cache=True, create_cache=True, fingerprint: str=''):
+    '''Iterate over a CSV file, optionally gzipped, annotated by annotator function (whose inputs should be identified by fingerprint)'''
     with tempfile.TemporaryDirectory(dir=os.path.abspath(LOCAL_TMP)) as tmpdirname:
-        cache_path = os.path.join(os.getcwd(), 'cache', os.path.basename(path) + '.sorted_cache')
-        sort_path = os.path.join(tmpdirname, f'sort_{os.path.basename(path)}')
+        options = json.dumps([strip_numeric, comment, skip, delimiter, csv_kwargs, file_kwargs, mutator is not None])
+        cache_path = get_cache_path(path, 'sorted_cache', options + fingerprint) if use_cache or create_cache else None
+        sort_path = os.path.join(tmpdirname, 'sorted.csv')
         if use_cache and os.path.exists(cache_path):
-            logging.info(f're-run and delete cache folder {cache_path} to see annotation errors in this log')
+            logging.info(f'reusing {cache_path}')
             sort_path = cache_path
         else:
-            # Initial mutation pass if necessary
-            pre_sort_path = path
-            if strip_numeric or skip or comment or mutator:
-                pre_sort_path = os.path.join(tmpdirname, f'annot_{os.path.basename(path)}')
-                with open(os.path.join(tmpdirname, pre_sort_path), 'w') as f:
-                    writer = csv.writer(f, **csv_kwargs)
-                    with iterate_csv(path,  strip_numeric=strip_numeric, delimiter=delimiter, skip=skip, comment=comment, csv_kwargs=csv_kwargs, file_kwargs=file_kwargs) as reader:
-                        headers, rows = reader
-
-                        writer.writerow([''] + headers)
-                        for row in rows:
-                            if not row: continue
-                            if mutator:
-                                try:
-                                    mutator(row)
-                                except AnnotationException as e:
-                                    logging.warning(f'{path}\t{str(e)}')
-                                    continue
-                            writer.writerow(row)
-
-            # Fast out-of-memory sort
-            os.system(f'(head -n 1 {pre_sort_path} && tail -n +2 {pre_sort_path} | sort) | tr -d \'\\r\' > {sort_path}')
-            if (pre_sort_path != path): os.remove(pre_sort_path)
+            # Annotate and sort in a single streaming pass
+            with report_stage('sort'), iterate_csv(path,  strip_numeric=strip_numeric, delimiter=delimiter, skip=skip, comment=comment, csv_kwargs=csv_kwargs, file_kwargs=file_kwargs) as reader:
+                headers, rows = reader
+                def annotated():
+                    for row in rows:
+                        if not row: continue
+                        if mutator:
+                            try:
+                                mutator(row)
+                            except AnnotationException as e:
+                                logging.warning(f'{path}\t{str(e)}')
+                                continue
+                        yield row
+
+                with sort_external(annotated(), tmpdirname) as sorted_rows, io.open(sort_path, 'w', newline='', **file_kwargs) as f:
+                    writer = csv.writer(f, **{**csv_kwargs, 'delimiter': delimiter})
+                    writer.writerow([''] + headers)
+                    writer.writerows(sorted_rows)
 
             if create_cache: 
-                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
-                os.rename(sort_path, cache_path)
-                sort_path = cache_path
+                sort_path = store_cache_entry(sort_path, cache_path)
 
-        with iterate_csv(sort_path, csv_kwargs=csv_kwargs, file_kwargs=file_kwargs) as reader:
+        with iterate_csv(sort_path, delimiter=delimiter, csv_kwargs=csv_kwargs, file_kwargs=file_kwargs) as reader:
             yield reader
 
-def get_ncbi_annotator(gene_info_path: str, gtf_path: str, gene_alias_path: str):
+def write_matrix_store(path: str, store_path: str, key_columns: int=1, strip_numeric: bool=False, delimiter: str=',', mutator: Callable=None, tee_gzip: str=None):
+    '''Parse an annotated matrix once into a sorted binary store of (keys.npy, values.npy float32, headers.npy)'''
+    os.makedirs(store_path, exist_ok=True)
+    keys, width, row_count = [], None, 0
+    unsorted_path = os.path.join(store_path, 'unsorted.f4')
+    with iterate_csv(path, strip_numeric=strip_numeric, delimiter=delimiter, tee_gzip=tee_gzip) as reader, open(unsorted_path, 'wb') as f:
+        headers, rows = reader
+        for row in rows:
+            if not row: continue
+            if mutator:
+                try:
+                    mutator(row)
+                except AnnotationException as e:
+                    logging.warning(f'{path}\t{str(e)}')
+                    continue
+            values = np.array(row[key_columns:], dtype='f4')
+            if width is None:
+                width = len(values)
+            elif len(values) != width:
+                logging.warning(f'{path}\tragged row\t{row[0]}')
+                values = np.concatenate([values, np.full(width - len(values), np.nan, dtype='f4')]) if len(values) < width else values[:width]
+            keys.append(tuple(row[:key_columns]))
+            f.write(values.tobytes())
+            row_count += 1
+
+    # Match headers of the annotated CSV ('' prefixed unless it lines up with the rows)
+    headers = list(headers) if (width or 0) + key_columns == len(headers) + 1 else [''] + list(headers)
+
+    # Stable sort by key, gathering rows out-of-core in chunks
+    order = sorted(range(row_count), key=keys.__getitem__)
+    unsorted = np.memmap(unsorted_path, dtype='f4', mode='r', shape=(row_count, width or 0)) if row_count else np.empty((0, 0), dtype='f4')
+    values = np.lib.format.open_memmap(os.path.join(store_path, 'values.npy'), mode='w+', dtype='f4', shape=(row_count, width or 0))
+    for i in range(0, row_count, 4096):
+        values[i:i+4096] = unsorted[order[i:i+4096]]
+    values.flush()
+    del values, unsorted
+    os.remove(unsorted_path)
+
+    np.save(os.path.join(store_path, 'keys.npy'), np.array([keys[i] for i in order], dtype='U').reshape(row_count, key_columns))
+    np.save(os.path.join(store_path, 'headers.npy'), np.array(headers, dtype='U'))
+
+def load_matrix_store(store_path: str):
+    '''Load headers, sorted keys and memory-mapped float32 values of a matrix store'''
+    headers = np.load(os.path.join(store_path, 'headers.npy')).tolist()
+    keys = np.load(os.path.join(store_path, 'keys.npy'))
+    values = np.load(os.path.join(store_path, 'values.npy'), mmap_mode='r')
+    return headers, keys, values
+
+@contextlib.contextmanager
+def iterate_matrix_sorted(path: str, key_columns: int=1, strip_numeric: bool=False, delimiter: str=',', mutator: Callable=None, use_cache=True, create_cache=True, fingerprint: str='', gzip_asset: bool=False):
+    '''Iterate over a numeric matrix sorted by key columns, yielding (*keys, float32 row view) from a memory-mapped binary store (optionally caching a gzipped copy of the input for publishing)'''
+    with tempfile.TemporaryDirectory(dir=os.path.abspath(LOCAL_TMP)) as tmpdirname:
+        options = json.dumps([key_columns, strip_numeric, delimiter, mutator is not None])
+        cache_path = get_cache_path(path, 'sorted_store', options + fingerprint) if use_cache or create_cache else None
+        store_path = os.path.join(tmpdirname, os.path.basename(path) + '.sorted_store')
+        if use_cache and os.path.exists(cache_path):
+            logging.info(f'reusing {cache_path}')
+            store_path = cache_path
+            replay_warnings(os.path.join(store_path, 'warnings.log'))
+        else:
+            # Compress the published copy while parsing, unless the input is already gzipped
+            asset_path = get_cache_path(path, 'csv.gz') if gzip_asset and not path.endswith('.gz') else None
+            tee_path = os.path.join(tmpdirname, 'asset.csv.gz') if asset_path and not os.path.exists(asset_path) else None
+
+            os.makedirs(store_path)
+            with capture_warnings(os.path.join(store_path, 'warnings.log')), report_stage('ingest'):
+                write_matrix_store(path, store_path, key_columns=key_columns, strip_numeric=strip_numeric, delimiter=delimiter, mutator=mutator, tee_gzip=tee_path)
+            if tee_path:
+                store_cache_entry(tee_path, asset_path)
+            if create_cache:
+                store_path = store_cache_entry(store_path, cache_path)
+
+        headers, keys, values = load_matrix_store(store_path)
+        yield headers, (tuple(k) + (v,) for k, v in zip(keys.tolist(), values))
+
+def publish_gzip_asset(path: str, dst: str):
+    '''Write a gzipped copy of path to dst, reusing the copy compressed during ingestion (or the input itself if already gzipped)'''
+    if path.endswith('.gz'):
+        return shutil.copyfile(path, dst)
+
+    cache_path = get_cache_path(path, 'csv.gz')
+    if not os.path.exists(cache_path):
+        with tempfile.TemporaryDirectory(dir=os.path.abspath(LOCAL_TMP)) as tmpdirname:
+            with open(path, 'rb') as src, gzip.open(os.path.join(tmpdirname, 'asset.csv.gz'), 'wb', compresslevel=6) as dst_gz:
+                shutil.copyfileobj(src, dst_gz, 1048576)
+            store_cache_entry(os.path.join(tmpdirname, 'asset.csv.gz'), cache_path)
+    return shutil.copyfile(cache_path, dst)
+
+GTF_ATTRIBUTES = re.compile(r'(gene_id|gene_name|transcript_id) "([A-Z0-9]+)"')
+
+def parse_gtf_chunk(chunk: bytes, features: Tuple[str]=('gene', 'transcript')):
+    '''Parse whole lines of a GTF into (feature, seqname, start, end, strand, gene_id, gene_name, transcript_id), only scanning attributes of the given features'''
+    # Most rows are exons/CDS etc., so only lines containing a feature column marker are split (and then checked, as the source column could match too)
+    starts = set()
+    for feature in features:
+        marker, i = f'\t{feature}\t'.encode(), -1
+        while (i := chunk.find(marker, i + 1)) >= 0:
+            starts.add(chunk.rfind(b'\n', 0, i) + 1)
+
+    records = []
+    for start in sorted(starts):
+        end = chunk.find(b'\n', start)
+        row = chunk[start:end if end >= 0 else len(chunk)].decode().split('\t', 8)
+        if len(row) < 9 or row[2] not in features or row[0].startswith('#'): continue
+        attributes = dict(GTF_ATTRIBUTES.findall(row[8]))
+        records.append((row[2], row[0], int(row[3]), int(row[4]), row[6], attributes.get('gene_id'), attributes.get('gene_name'), attributes.get('transcript_id')))
+    return records
+
+def iterate_gtf(path: str, features: Tuple[str]=('gene', 'transcript'), workers: int=0, chunk_size: int=16777216):
+    '''Stream gene/transcript records of an (optionally gzipped) GTF, parsing chunks of whole lines in worker processes when workers is set'''
+    with open(path, 'rb') as raw, gzip.GzipFile(fileobj=raw) if path.endswith('.gz') else contextlib.nullcontext(raw) as f, ordered_block_writer(workers) as (submit, _):
+        parsed, tail = collections.deque(), b''
+        while (chunk := f.read(chunk_size)):
+            chunk, _, tail = (tail + chunk).rpartition(b'\n')
+            submit(parsed.append, parse_gtf_chunk, chunk, features)
+            while parsed: yield from parsed.popleft()
+        submit(parsed.append, parse_gtf_chunk, tail, features)
+    while parsed: yield from parsed.popleft()
+
+ANNOTATION_TABLES = ['genes', 'coordinates', 'descriptions', 'gene_keys', 'gene_rows', 'transcript_keys', 'transcript_numbers', 'transcript_rows']
+
+def compile_annotation_index(gene_info_path: str, gtf_path: str, gene_alias_path: str, index_path: str, workers: int=0):
+    '''Parse the annotation files once into a folder of memory-mappable tables: genes (id, name, chr, strand), coordinates, descriptions and sorted keys (IDs and aliases, transcripts) pointing to gene rows'''
     gene_to_gene = {}
-    transcript_to_gene = {}
     transcript_to_transcript = {}
+    transcript_to_gene_id = {}
 
     # Use GTF as primary annotation source
-    with iterate_csv(gtf_path, delimiter='\t', strip_numeric=False, comment='#!', file_kwargs=dict(encoding='ascii')) as reader:
-        transcript_to_gene_id = {}
-        _, rows = reader
-        CHR_WHITELIST = ['X', 'Y', 'MT']
-        for row in rows:
-            if row[2] == 'gene':
-                id = re.search(r'gene_id "([A-Z0-9]+)"', row[8])
-                name = re.search(r'gene_name "([A-Z0-9]+)"', row[8])
-                if id and name and (row[0].isnumeric() or row[0] in CHR_WHITELIST):
-                    id, name = id.group(1), name.group(1)
-                    gene_to_gene[id] = [id, name, row[0], int(row[3]), int(row[4]), row[6], '-']
-            elif row[2] in ['transcript']:
-                id = re.search(r'gene_id "([A-Z0-9]+)"', row[8])
-                transcript_id = re.search(r'transcript_id "([A-Z0-9]+)"', row[8])
-                if id and transcript_id:
-                    transcript_to_transcript[transcript_id.group(1)] = int(transcript_id.group(1)[4:])
-                    transcript_to_gene_id[transcript_id.group(1)] = id.group(1)
-
-        # Add transcripts to main lookup
-        for transcript_id, gene_id in transcript_to_gene_id.items(): 
-            gene_obj = gene_to_gene.get(gene_id, None)
-            if gene_obj: transcript_to_gene[transcript_id] = gene_obj
+    CHR_WHITELIST = ['X', 'Y', 'MT']
+    for feature, seqname, start, end, strand, id, name, transcript_id in iterate_gtf(gtf_path, workers=workers):
+        if feature == 'gene':
+            if id and name and (seqname.isnumeric() or seqname in CHR_WHITELIST):
+                gene_to_gene[id] = [id, name, seqname, start, end, strand, '-']
+        elif id and transcript_id:
+            transcript_to_transcript[transcript_id] = int(transcript_id[4:])
+            transcript_to_gene_id[transcript_id] = id
+    genes = list(gene_to_gene.values())
 
     # Get descriptions
     with iterate_csv(gene_info_path, delimiter='\t', strip_numeric=False, file_kwargs=dict(encoding='ascii')) as reader:
@@ -285,7 +979,76 @@ def get_ncbi_annotator(gene_info_path: str, gtf_path: str, gene_alias_path: str)
                         if alias and (alias := alias.strip()): 
                             gene_to_gene.setdefault(alias, data)
 
-    return gene_to_gene, transcript_to_transcript, transcript_to_gene
+    # Resolve keys to gene rows, sorted for binary search
+    row_of = {g[0]: i for i, g in enumerate(genes)}
+    gene_keys = sorted(gene_to_gene)
+    transcript_keys = sorted(transcript_to_transcript)
+    tables = {
+        'genes': np.array([[g[0], g[1], g[2], g[5]] for g in genes], dtype='U').reshape(len(genes), 4),
+        'coordinates': np.array([[g[3], g[4]] for g in genes], dtype='i8').reshape(len(genes), 2),
+        'descriptions': np.array([g[6].encode() for g in genes], dtype='S'),
+        'gene_keys': np.array(gene_keys, dtype='U'),
+        'gene_rows': np.array([row_of[gene_to_gene[k][0]] for k in gene_keys], dtype='i4'),
+        'transcript_keys': np.array(transcript_keys, dtype='U'),
+        'transcript_numbers': np.array([transcript_to_transcript[k] for k in transcript_keys], dtype='i8'),
+        'transcript_rows': np.array([row_of.get(transcript_to_gene_id[k], -1) for k in transcript_keys], dtype='i4'),
+    }
+    os.makedirs(index_path, exist_ok=True)
+    for name in ANNOTATION_TABLES:
+        np.save(os.path.join(index_path, name + '.npy'), tables[name])
+
+def load_annotation_index(index_path: str):
+    '''Memory-map the tables of a compiled annotation index'''
+    return {name: np.load(os.path.join(index_path, name + '.npy'), mmap_mode='r') for name in ANNOTATION_TABLES}
+
+def find_annotation_rows(keys: np.ndarray, rows: np.ndarray, names: Iterable[str]):
+    '''Binary search sorted keys (e.g. gene_keys) for names, returning their rows or -1 where not found'''
+    names = np.asarray(list(names), dtype='U')
+    if not len(keys): return np.full(len(names), -1, dtype=rows.dtype)
+    i = np.searchsorted(keys, names).clip(max=len(keys) - 1)
+    return np.where(keys[i] == names, rows[i], -1)
+
+def build_search_index(gene_to_gene: Dict[str, List], gene_rows: Dict[str, int]):
+    '''Sorted (uppercase key, row, kind) arrays for exact and prefix search of written genes (rows in gene_rows by Ensembl ID) by Ensembl ID (kind 0), symbol (1) or alias (2)'''
+    entries = {}
+    for key, gene in gene_to_gene.items():
+        if (row := gene_rows.get(gene[0], None)) is None: continue
+        for k, kind in [(gene[0], 0), (gene[1], 1), (key, 2)]:
+            k = k.upper().encode()
+            entries[k, row] = min(entries.get((k, row), kind), kind)
+    ordered = sorted(entries)
+    keys = np.array([k for k, _ in ordered], dtype=bytes)
+    return keys, np.array([r for _, r in ordered], dtype='i4'), np.array([entries[e] for e in ordered], dtype='u1')
+
+def search_index_rows(keys: np.ndarray, rows: np.ndarray, term: str, prefix: bool=False):
+    '''Rows of a sorted search index (see build_search_index) whose key equals, or starts with, a term (case insensitive)'''
+    term = term.strip().upper().encode()
+    start = np.searchsorted(keys, term, side='left')
+    end = np.searchsorted(keys, term + b'\xff', side='left') if prefix else np.searchsorted(keys, term, side='right')
+    return rows[start:end]
+
+def get_ncbi_annotator(gene_info_path: str, gtf_path: str, gene_alias_path: str, workers: int=0):
+    '''Build gene/transcript lookups from the compiled annotation index (compiling it if the files changed), along with a fingerprint of the annotation files used to key derived caches'''
+    paths = [gene_info_path, gtf_path, gene_alias_path]
+    with cache_manifest() as manifest:
+        fingerprint = hashlib.sha256(''.join(hash_file(p, manifest) for p in paths).encode()).hexdigest()
+
+    index_path = get_cache_path(paths, 'annotation_index', name='annotation')
+    if not os.path.exists(index_path):
+        with tempfile.TemporaryDirectory(dir=os.path.abspath(LOCAL_TMP)) as tmpdirname:
+            build_path = os.path.join(tmpdirname, os.path.basename(index_path))
+            compile_annotation_index(gene_info_path, gtf_path, gene_alias_path, build_path, workers)
+            store_cache_entry(build_path, index_path)
+    index = load_annotation_index(index_path)
+
+    # Rows are shared between each gene's ID and aliases, as well as its transcripts
+    genes = [[id, name, chr, start, end, strand, description.decode()] for (id, name, chr, strand), (start, end), description in zip(index['genes'].tolist(), index['coordinates'].tolist(), index['descriptions'].tolist())]
+    gene_to_gene = dict(zip(index['gene_keys'].tolist(), map(genes.__getitem__, index['gene_rows'].tolist())))
+    transcript_keys = index['transcript_keys'].tolist()
+    transcript_to_transcript = dict(zip(transcript_keys, index['transcript_numbers'].tolist()))
+    transcript_to_gene = {k: genes[r] for k, r in zip(transcript_keys, index['transcript_rows'].tolist()) if r >= 0}
+
+    return gene_to_gene, transcript_to_transcript, transcript_to_gene, fingerprint
 
 def accumulate_iterator(iterator, acc_key):
     '''Group consecuative identical keys into a single (group_key, [members])'''
@@ -301,50 +1064,66 @@ def accumulate_iterator(iterator, acc_key):
     yield acc_group_key, acc_group
 
 def parallel_iterator(iterators, sort_key, debug=False):
-    '''Iterate sparsely over multiple sorted iterators in parallel, yielding tuples of shared (group_key, [members])'''    
-    group_sort_func = lambda g: g[1]
-    group_create_func = lambda i, v: (i, sort_key(v), v) if v else None 
-    
-    latest = [group_create_func(i, next(it, None)) for i, it in enumerate(iterators)]
+    '''Iterate sparsely over multiple sorted iterators in parallel, yielding tuples of shared (group_key, [members])'''
+    heap = [(sort_key(v), i, v) for i, v in enumerate(next(it, None) for it in iterators) if v]
+    heapq.heapify(heap)
 
-    while any(latest): 
-        min_group = min((g for g in latest if g), key=group_sort_func)
-        min_group_key = min_group[1]
-        min_groups = [g if (g and ((g[1]) == min_group_key)) else None for g in latest]
-        min_vals = [g[2] if g else None for g in min_groups]
+    while heap:
+        min_group_key, min_vals, min_indices = heap[0][0], [None] * len(iterators), []
+        while heap and heap[0][0] == min_group_key:
+            _, i, v = heapq.heappop(heap)
+            min_vals[i] = v
+            min_indices.append(i)
 
         yield (min_group_key, min_vals)
 
-        for g in min_groups:
-            if g is not None:
-                latest[g[0]] = group_create_func(g[0], next(iterators[g[0]], None))
+        # Only advance after the yield, as members may be reused by their iterator (e.g. accumulate_iterator)
+        for i in min_indices:
+            if (v := next(iterators[i], None)):
+                heapq.heappush(heap, (sort_key(v), i, v))
+
+def nested_parallel_iterator(iterators, sort_key, debug=False):
+    '''Iterate over nested lists of sorted iterators with a single merge, yielding (group_key, members) nested the same way, with None for lists without the key'''
+    flat = []
+    def flatten(node):
+        # Each list covers a contiguous slice of the flattened iterators, so missing lists are detected without recursing
+        if not isinstance(node, list):
+            flat.append(node)
+            return len(flat) - 1
+        start = len(flat)
+        children = [flatten(n) for n in node]
+        return (start, len(flat), None if all(isinstance(c, int) for c in children) else children)
+    layout = flatten(iterators)
+
+    def unflatten(node, vals):
+        start, end, children = node
+        if not any(vals[start:end]): return None
+        if children is None: return vals[start:end]
+        return [vals[c] if isinstance(c, int) else unflatten(c, vals) for c in children]
+
+    for group_key, vals in parallel_iterator(flat, sort_key, debug=debug):
+        yield group_key, unflatten(layout, vals)
 
 @contextlib.contextmanager
-def parallel_matrix_context(dataset, mutator, debug=False):
-    '''Iterate over a dataset's matrices, yielding tuples of (gene name, (matrix name, sample names, gene name, expression values))'''
+def parallel_matrix_context(dataset, mutator, debug=False, fingerprint=''):
+    '''Open a dataset's matrices, yielding their sample names and sorted iterators of (gene name, expression values)'''
 
     with context_closer() as contexts:
         sorted_iters, sorted_headers = [], []
         for matrix in dataset['matrices']:
             # Iterate sorted (by first real column / gene ID)
-            contexts.append(iterate_csv_sorted(os.path.join(dataset['dir'], matrix['path']), mutator=mutator, delimiter=',', strip_numeric=True))
+            # NOTE: only the first matrix is published (see metadata.json)
+            contexts.append(iterate_matrix_sorted(os.path.join(dataset['dir'], matrix['path']), mutator=mutator, delimiter=',', strip_numeric=True, fingerprint=fingerprint, gzip_asset=matrix is dataset['matrices'][0]))
             headers, rows = contexts[-1].__enter__()
 
-            # Add extra info to rows (NOTE: nesting/parameter needed to avoid shared state)
-            def _iter(dataset, matrix, rows, headers):
-                for row in iterate_unique(rows, lambda x: x and x[0]): 
-                    yield (dataset, matrix, headers, row[0], row[1:])
-                    logging.debug(f'{matrix["name"]} yielded {row[0]}')
-            
-            sorted_iters.append(_iter(dataset, matrix, rows, headers))
+            sorted_iters.append(iterate_unique(rows, lambda x: x and x[0]))
             sorted_headers.append(headers)
 
-        # Iterator yields tuples of (gene name, (matrix name, sample names, gene name, expression values))
-        yield sorted_headers, parallel_iterator(sorted_iters, lambda v: v[3])
+        yield sorted_headers, sorted_iters
 
 @contextlib.contextmanager
-def parallel_transcript_iterator(dataset, transcript_to_gene):
-    '''Iterate over transcripts grouped by gene'''
+def parallel_transcript_iterator(dataset, transcript_to_gene, fingerprint=''):
+    '''Open a dataset's transcript matrices, yielding their headers and sorted iterators of transcripts grouped by gene'''
     def transcript_row_mutator(row):
         versionless = row[0].split('.', 1)[0]
         if annot := transcript_to_gene.get(versionless, None):
@@ -356,16 +1135,17 @@ def parallel_transcript_iterator(dataset, transcript_to_gene):
     with context_closer() as contexts:
         sorted_iters, sorted_headers = [], []
         for matrix in dataset.get('transcript_matrices', []):
-            contexts.append(iterate_csv_sorted(os.path.join(dataset['dir'], matrix['path']), strip_numeric=True, mutator=transcript_row_mutator))
+            contexts.append(iterate_matrix_sorted(os.path.join(dataset['dir'], matrix['path']), key_columns=2, strip_numeric=True, mutator=transcript_row_mutator, fingerprint='transcript' + fingerprint))
             headers, rows = contexts[-1].__enter__()
 
             sorted_iters.append(accumulate_iterator(rows, lambda row: row[0]))
             sorted_headers.append(headers)
 
-        yield sorted_headers, parallel_iterator(sorted_iters, lambda x: x[0])
+        yield sorted_headers, sorted_iters
 
 @contextlib.contextmanager
-def parallel_dataset_context(datasets, gene_to_gene, transcript_to_gene, debug=False):
+def parallel_dataset_context(datasets, gene_to_gene, transcript_to_gene, debug=False, fingerprint=''):
+    '''Merge all matrices of all datasets by gene, yielding (gene, [per dataset (varpart row, [matrix rows], [transcript groups]) or None])'''
     def gene_row_mutator(row):
         versionless = row[0].split('.', 1)[0]
         if annot := gene_to_gene.get(versionless, None):
@@ -374,30 +1154,175 @@ def parallel_dataset_context(datasets, gene_to_gene, transcript_to_gene, debug=F
             raise AnnotationException(f'failed to annotate\tgene\t{row[0]}')
 
     with context_closer() as contexts:
-        firsts, yields = [], []
+        firsts, nested = [], []
         for d in datasets:
-            # Get (headers, iterator) for each matrix set
-            contexts.append(parallel_matrix_context(d, gene_row_mutator, debug=debug))
-            matrix_iterator = contexts[-1].__enter__()
+            # Get (headers, iterators) for each matrix set
+            contexts.append(parallel_matrix_context(d, gene_row_mutator, debug=debug, fingerprint='gene' + fingerprint))
+            matrix_iterators = contexts[-1].__enter__()
 
             # Get (headers, iterator) for variance partition
             variance_iterator = [None, iter([])]
             if varpart_path := d.get('variancePartition', None):
-                contexts.append(iterate_csv_sorted(os.path.join(d['dir'], varpart_path), mutator=gene_row_mutator, strip_numeric=True))
+                contexts.append(iterate_matrix_sorted(os.path.join(d['dir'], varpart_path), mutator=gene_row_mutator, strip_numeric=True, fingerprint='gene' + fingerprint))
                 variance_iterator = contexts[-1].__enter__()
 
-            # Get (headers, iterator) for transcript matrix
-            transcript_iterator = [None, iter([])]
+            # Get (headers, iterators) for transcript matrices
+            transcript_iterators = [None, []]
             if 'transcript_matrices' in d:
-                contexts.append(parallel_transcript_iterator(d, transcript_to_gene))
-                transcript_iterator = contexts[-1].__enter__()
+                contexts.append(parallel_transcript_iterator(d, transcript_to_gene, fingerprint=fingerprint))
+                transcript_iterators = contexts[-1].__enter__()
+
+            firsts.append([variance_iterator[0], matrix_iterators[0], transcript_iterators[0]])
+            nested.append([variance_iterator[1], matrix_iterators[1], transcript_iterators[1]])
+
+        # A single heap over every matrix of every dataset, rather than nested merges
+        yield firsts, nested_parallel_iterator(nested, lambda kv: kv[0], debug=debug)
+
+def get_segment_path(dataset: Dict, fingerprint: str=''):
+    '''Content-addressed cache location for a dataset's encoded segment, keyed on all of its input files and settings'''
+    paths = [dataset['meta'], *(m['path'] for m in dataset['matrices']), *(t['path'] for t in dataset.get('transcript_matrices', []))]
+    paths.extend(p for p in [dataset.get('annot', None), dataset.get('variancePartition', None)] if p)
+    settings = json.dumps([{k: v for k, v in dataset.items() if not k.startswith('_')}, LOG2_OFFSET, CATEGORY_LIMIT], sort_keys=True, default=str)
+    return get_cache_path([os.path.join(dataset['dir'], p) for p in paths], 'segment', settings + fingerprint, name=dataset['id'])
+
+def write_segment(segment_path: str, dataset: Dict, headers: List, iterator: Iterable, metadata_columns: Tuple, workers: int=0, encoding: str='float32', neighbours: int=0, summaries: bool=False):
+    '''Encode every gene of a single dataset into compressed rows with per-gene ranges, log means, encoding errors and optionally box plot summaries and top co-expressed (complete) rows, independent of other datasets'''
+    matrices, transcript_matrices = dataset['matrices'], dataset.get('transcript_matrices', [])
+    varpart_headers = headers[0]
+
+    # Ranges are accumulated as flat int64 (start, end) arrays and flags as bytes, rather than grown as lists of tuples, and gene IDs a block at a time
+    gene_blocks, genes, has_matrix, complete = [], [], array.array('B'), array.array('B')
+    varpart_ranges, transcript_ranges = array.array('q'), [array.array('q') for _ in transcript_matrices]
+    matrix_ranges, pvalue_ranges, summary_ranges = [[array.array('q') for _ in matrices] for _ in range(3)]
+    logs, logs_filter = [[[] for _ in matrices] for _ in range(2)]
+    matrix_blocks, errors = [[] for _ in matrices], np.zeros((len(matrices), 2))
+    null_transcripts = [None] * len(transcript_matrices)
+
+    with write_compressed_ranges(os.path.join(segment_path, 'rows.bin')) as (writer, _):
+        def write_ranges(ranges, compressed_rows):
+            for r in compressed_rows:
+                ranges.extend(writer(r, compressed=True))
+
+        def write_matrix_block(mi, result):
+            '''Write an encoded block of gene rows and keep their log means for zscores'''
+            rows, block_logs, block_logs_filter, block_errors, timings = result
+            errors[mi] = np.fmax(errors[mi], block_errors)
+            for name, seconds in timings.items():
+                report_time(name, seconds)
+            for pvalue_row, row, summary_row in rows:
+                pvalue_ranges[mi].extend(writer(pvalue_row, compressed=True))
+                matrix_ranges[mi].extend(writer(row, compressed=True))
+                if summaries:
+                    summary_ranges[mi].extend(writer(summary_row, compressed=True))
+            logs[mi].append(block_logs)
+            logs_filter[mi].append(block_logs_filter)
+
+        def submit_matrix_block(mi):
+            _, reorder, logs_filter_enum, _ = matrices[mi]['_internal']
+            if not matrix_blocks[mi]: return
+            filter_indices = logs_filter_enum[1] if logs_filter_enum else []
+            submit(functools.partial(write_matrix_block, mi), encode_matrix_block, dataset['id'], np.stack(matrix_blocks[mi]), reorder, filter_indices, encoding, summaries)
+            matrix_blocks[mi].clear()
+
+        # Loop over all genes, encoding matrix blocks in worker processes if requested
+        with ordered_block_writer(workers, init_block_worker, ({dataset['id']: metadata_columns},)) as (submit, put):
+            for gene, ((varpart, matrix_group, transcripts),) in iterator:
+                genes.append(gene)
+                if len(genes) >= MATRIX_BLOCK_SIZE:
+                    gene_blocks.append(np.array(genes, dtype='U'))
+                    genes.clear()
+                has_matrix.append(matrix_group is not None)
+
+                # Drop anything that doesn't appear in all matrices so we don't need to manage a second index
+                complete.append(bool(matrix_group) and all(matrix_group))
+                if not complete[-1]: continue
 
-            firsts.append([variance_iterator[0], matrix_iterator[0], transcript_iterator[0]])
-            yields.append(parallel_iterator([variance_iterator[1], matrix_iterator[1], transcript_iterator[1]], lambda kv: kv[0]))
-
-        yield firsts, parallel_iterator(yields, lambda kv: kv[0], debug=debug)
-
-def parse_metadata(dataset, order_entries: Dict[str, List[str]], category_limit: int | None = 50):
+                if varpart_headers:
+                    row = data_pb2.RowData()
+                    row.values.extend(varpart[1].tolist() if varpart else [0.0] * len(varpart_headers))
+                    put(functools.partial(write_ranges, varpart_ranges), [compress_row(row.SerializeToString())])
+
+                # Buffer raw rows so re-ordering, pvalues and encoding happen a block at a time
+                for mi, (_, values) in enumerate(matrix_group):
+                    matrix_blocks[mi].append(values)
+                    if len(matrix_blocks[mi]) >= MATRIX_BLOCK_SIZE:
+                        submit_matrix_block(mi)
+
+                for ti, (transcript_matrix, accumulated) in enumerate(zip(transcript_matrices, transcripts or null_transcripts)):
+                    _, _, reorder = transcript_matrix['_internal']
+                    table = data_pb2.TableData()
+                    if accumulated is not None: 
+                        # Reorder all transcripts of the gene at once
+                        _, t_list = accumulated
+                        table.float_values.extend(apply_reorder_array(np.stack([values for _, _, values in t_list]), reorder).ravel().tolist())
+                        table.string_values.extend(transcript_id for _, transcript_id, _ in t_list)
+                    put(functools.partial(write_ranges, transcript_ranges[ti]), [compress_row(table.SerializeToString())])
+
+            # Flush partially filled matrix blocks
+            for mi in range(len(matrices)):
+                submit_matrix_block(mi)
+
+    logs_filter_enum = matrices[0]['_internal'][2]
+    n, categories = sum(complete), len(logs_filter_enum[0][1]) if logs_filter_enum else 0
+    stacked_ranges = lambda streams: np.array([np.frombuffer(ranges, dtype='i8') for ranges in streams], dtype='i8').reshape(len(streams), n, 2)
+    matrix_ranges = stacked_ranges(matrix_ranges)
+
+    # Summaries and neighbours are only kept with segments built with them
+    optional_arrays = {'summary_ranges': stacked_ranges(summary_ranges)} if summaries else {}
+
+    # Neighbours by the first (published) matrix, kept with the segment as they only depend on its rows
+    if neighbours:
+        with report_stage('neighbours'):
+            neighbour_rows, neighbour_correlations = calc_segment_neighbours(os.path.join(segment_path, 'rows.bin'), matrix_ranges[0], neighbours)
+        optional_arrays.update(neighbour_rows=neighbour_rows, neighbour_correlations=neighbour_correlations)
+
+    with io.open(os.path.join(segment_path, 'headers.json'), 'w') as f:
+        json.dump(headers, f)
+    np.savez(os.path.join(segment_path, 'segment.npz'),
+        genes=np.concatenate([np.empty(0, dtype='U1'), *gene_blocks, np.array(genes, dtype='U')]),
+        has_matrix=np.frombuffer(has_matrix, dtype=bool), complete=np.frombuffer(complete, dtype=bool),
+        varpart_ranges=np.frombuffer(varpart_ranges, dtype='i8').reshape(-1, 2),
+        matrix_ranges=matrix_ranges,
+        pvalue_ranges=stacked_ranges(pvalue_ranges),
+        transcript_ranges=stacked_ranges(transcript_ranges),
+        logs=np.array([np.concatenate([np.empty(0), *blocks]) for blocks in logs], dtype='f8').reshape(len(matrices), n),
+        logs_filter=np.array([np.concatenate([np.empty((0, categories)), *blocks]) for blocks in logs_filter], dtype='f8').reshape(len(matrices), n, categories),
+        errors=errors, **optional_arrays)
+
+def load_segment(segment_path: str):
+    '''Load a dataset segment's per-gene arrays, along with a lookup from gene to (row, complete row) and its memory-mapped rows'''
+    with np.load(os.path.join(segment_path, 'segment.npz')) as f:
+        segment = dict(f)
+    segment['lookup'] = {g: (i, j) for i, g, j in zip(itertools.count(), segment['genes'].tolist(), (np.cumsum(segment['complete']) - 1).tolist())}
+    segment['rows'] = np.memmap(os.path.join(segment_path, 'rows.bin'), dtype=np.uint8, mode='r') if os.path.getsize(os.path.join(segment_path, 'rows.bin')) else np.empty(0, dtype=np.uint8)
+    return segment
+
+def get_segment_transcoders(segment: Dict, level: int=None, dictionary: bool=False, samples: int=1024):
+    '''Per-stream functions re-compressing a segment's zlib rows at another level or with a shared dictionary (None when rows can be copied as is), along with attributes for their range datasets'''
+    transcoders = {}
+    for name in [name for name in ['varpart_ranges', 'matrix_ranges', 'pvalue_ranges', 'summary_ranges', 'transcript_ranges'] if name in segment]:
+        for i, ranges in enumerate([segment[name]] if name == 'varpart_ranges' else segment[name]):
+            attrs = {}
+            if level is None and not dictionary:
+                transcoders[name, i] = (None, attrs)
+                continue
+
+            # Train a shared dictionary per stream from evenly spaced rows
+            shared = None
+            if dictionary and len(ranges):
+                picks = np.unique(np.linspace(0, len(ranges) - 1, min(len(ranges), samples)).astype(int))
+                shared = train_row_dictionary([zlib.decompress(segment['rows'][s:e].tobytes()) for s, e in ranges[picks].tolist()])
+                if shared: attrs['dictionary'] = np.frombuffer(shared, dtype=np.uint8)
+
+            compress, _ = get_row_codec(level, shared)
+            transcoders[name, i] = ((lambda binary, compress=compress: compress(zlib.decompress(binary))), attrs)
+
+    # Neighbour rows are only encoded while merging (as rows of written genes), at the default level
+    if 'neighbour_rows' in segment:
+        transcoders['neighbour_ranges', 0] = (None, {})
+    return transcoders
+
+def parse_metadata(dataset, order_entries: Dict[str, List[str]], category_limit: int | None = 50, workers: int=0):
     column_types = {}
     if annot := dataset.get('annot', None):
         with iterate_csv(os.path.join(dataset['dir'], annot), delimiter=',', strip_numeric=True, csv_kwargs={}) as reader:
@@ -407,23 +1332,31 @@ def parse_metadata(dataset, order_entries: Dict[str, List[str]], category_limit:
                     column_types[row[1]] = row[3]
 
     # Iterate sorted (by first real column i.e. sample name)
-    with iterate_csv_sorted(os.path.join(dataset['dir'], dataset['meta']), delimiter=',', strip_numeric=True) as reader:
+    meta_path = os.path.join(dataset['dir'], dataset['meta'])
+    with iterate_csv_sorted(meta_path, delimiter=',', strip_numeric=True) as reader:
         top_headers, rows = reader
-        row_list = list(rows)
-        side_headers = [r[0] for r in row_list]
 
-        top_headers_enum = list(enumerate(top_headers))
+        # Transpose once into columns (sample names first), which zip would silently cut to the shortest row
+        rows, width = list(rows), len(top_headers) + 1
+        if (short := next((row for row in rows if len(row) < width), None)) is not None:
+            raise ValueError(f'{meta_path}\tsample {short[0] if short else ""} has {len(short)} columns, expected {width}')
+        row_columns = list(zip(*rows))
+        side_headers = list(row_columns[0]) if row_columns else []
+        value_columns = row_columns[1:len(top_headers) + 1] if row_columns else [()] * len(top_headers)
+
         filter_factors_enum = None
         if customFilter := dataset.get('customFilter', None):
             h = customFilter['column']
             i = top_headers.index(h)
-            categories, factors = np.unique([r[1+i] for r in row_list], return_inverse=True)
+            categories, factors = np.unique(value_columns[i], return_inverse=True)
             filter_factors_enum = (h, [str(c) for c in categories], factors)
-            
-        # Parse columns into separate typed np arrays
+
+        # Parse columns into separate typed np arrays, in worker processes if requested
+        with concurrent.futures.ProcessPoolExecutor(workers) if workers and len(value_columns) > 1 else contextlib.nullcontext() as executor:
+            typed_columns = list(executor.map(convert_to_serializable, value_columns, chunksize=max(1, len(value_columns) // (4 * workers))) if executor else map(convert_to_serializable, value_columns))
+
         def columns():
-            for i, h in top_headers_enum:
-                column = convert_to_serializable([r[1+i] for r in row_list])
+            for h, column in zip(top_headers, typed_columns):
                 attrs = {}
                 if column.dtype.type is not np.bytes_ or (category_limit is None or count_unique(column, category_limit) < category_limit):
                     order_entry = next((o for o in order_entries if o['variable'] == h), None)
@@ -458,23 +1391,53 @@ def write_metadata_columns(hdf5_f, columns: Iterable[Tuple[str, np.ndarray, Dict
             if t is None: column_types[i] = 'Uncategorized'
         sample_root.attrs['type'] = column_types
 
+INTEGER_CELL, NUMBER_CELL = r'[+-]?[0-9]+', r'[+-]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?'
+INTEGER_COLUMN = re.compile(rf'(?:{INTEGER_CELL}\n)*{INTEGER_CELL}')
+
+# Cells (lines of a column joined by newlines) that int() or float() parse as is, and those they might still parse (surrounding whitespace, digits separated by underscores, non-ASCII digits, nan/inf)
+NUMERIC_CELLS = re.compile(rf'^(?:({INTEGER_CELL})|({NUMBER_CELL})|([^\S\n].*|.*[^\S\n]|.*[0-9]_[0-9].*|.*[^\x00-\x7f].*|[+-]?(?i:nan|inf|infinity)))$', re.M)
+
+def parse_cell(value: str):
+    '''int() or else float() of a cell, or the cell itself if neither parses it'''
+    for f in [int, float]:
+        try: return f(value)
+        except ValueError: continue
+    return value
+
 def convert_to_serializable(values: Iterable, force_string=False, na_values=['NA', '']):
     '''HDF5 does not support unicode, but otherwise try to use numpy auto-typing'''
-    arr = None
+    values, arr = list(values), None
 
     if not force_string:
-        converters = [int, float]
-        for i in range(len(values)):
-            if values[i] in na_values: 
+        # Type whole columns with a single regex match where possible, otherwise only try cells that could be numbers
+        joined, na_cell = '\n'.join(values), '|'.join(map(re.escape, na_values))
+        if joined.count('\n') != len(values) - 1:
+            values = [np.nan if v in na_values else parse_cell(v) for v in values]
+            arr = np.array(values)
+        elif INTEGER_COLUMN.fullmatch(joined):
+            arr = np.array(list(map(int, values)))
+        elif re.fullmatch(rf'(?:(?:{NUMBER_CELL}|{na_cell})\n)*(?:{NUMBER_CELL}|{na_cell})', joined):
+            arr = np.array([np.nan if v in na_values else float(v) for v in values])
+
+            # Integer cells such as -0 are parsed by int() first
+            for i in np.flatnonzero(arr == 0):
+                arr[i] = parse_cell(values[i])
+        else:
+            na = {i for i, v in enumerate(values) if v in na_values}
+            matches = list(NUMERIC_CELLS.finditer(joined))
+            line_starts = np.cumsum([0, *(len(v) + 1 for v in values)])
+            rows = np.searchsorted(line_starts, [m.start() for m in matches]).tolist()
+            converters = {1: int, 2: float, 3: parse_cell}
+            for i, m in zip(rows, matches):
+                if i not in na: values[i] = converters[m.lastindex](values[i])
+            for i in na:
                 values[i] = np.nan
-            else:
-                for f in converters:
-                    try: values[i] = f(values[i])
-                    except ValueError: continue
-                    else: break
-        arr = np.array(values)
-        
-    if force_string or arr.dtype.char == 'U':
+
+            # Any other cell is a string, making it a string column
+            if len(na.union(rows)) == len(values):
+                arr = np.array(values)
+
+    if force_string or arr is None or arr.dtype.char == 'U':
         values = ['Unknown' if v is np.nan else str(v) for v in values]
         max_len = 0 if not values else max(map(len, values))
         arr = np.array([v.encode() for v in values], dtype=f'S{max_len}')
@@ -484,6 +1447,42 @@ def write_string_dataset(hdf5_f, name: str, values: Iterable[str]):
     '''Write a string dataset with correct encoding'''
     hdf5_f.create_dataset(name, data=convert_to_serializable(values, force_string=True), compression='gzip', compression_opts=9)
 
+def copy_attrs(src, dst):
+    '''Copy attributes keeping their stored types (e.g. variable length strings)'''
+    for key in src.attrs:
+        dst.attrs.create(key, src.attrs[key], dtype=src.attrs.get_id(key).dtype)
+
+def shard_output(folder: str, name: str='out.hdf5', header_keys: Tuple[str]=('zscores',)):
+    '''Move the metadata of each dataset (all but header_keys, which the results table needs) from an output into a file per dataset, keeping the rest as the header.
+    Paths are unchanged, so /metadata/<id>/<key> is read from the header or the shard listed for it in the returned manifest'''
+    path, stem = os.path.join(folder, name), os.path.splitext(name)[0]
+    manifest = {'header': name, 'shards': {}}
+    with h5py.File(path, 'r') as src, h5py.File(path + '.tmp', 'w') as header:
+        copy_attrs(src, header)
+        for key in src:
+            if key not in ('metadata', 'groups'):
+                src.copy(src[key], header, key)
+
+        for d_id, meta_root in src['metadata'].items():
+            shard_name = f'{stem}.{d_id}.hdf5'
+            copy_attrs(meta_root, header_root := header.create_group(meta_root.name))
+            with h5py.File(os.path.join(folder, shard_name), 'w') as shard:
+                shard_root = shard.create_group(meta_root.name)
+                for key, obj in meta_root.items():
+                    src.copy(obj, header_root if key in header_keys else shard_root, key)
+                keys = list(shard_root.keys())
+            manifest['shards'][d_id] = {'file': shard_name, 'bytes': os.path.getsize(os.path.join(folder, shard_name)), 'keys': keys}
+
+        # Groups hard-link datasets in the header as they did in the single file
+        if 'groups' in src:
+            copy_attrs(src['groups'], pg_root := header.create_group('groups'))
+            for pg_id, p_pg_root in src['groups'].items():
+                copy_attrs(p_pg_root, header_pg_root := pg_root.create_group(pg_id))
+                for d_id in p_pg_root:
+                    header_pg_root[d_id] = header['metadata'][d_id]
+    os.replace(path + '.tmp', path)
+    return manifest
+
 def test_parallel_iteration():
     '''Basic sanity check for parallel iteration'''
     first = [1, 2, 3, 4]
@@ -501,6 +1500,13 @@ def test_parallel_iteration():
     assert len(result[2]) == 2
     assert result[1][1] == [2, 2]
 
+    result = list(nested_parallel_iterator([[iter([2, 3]), iter([3])], iter([1, 3]), []], lambda x: x))
+    assert result == [(1, [None, 1, None]), (2, [[2, None], None, None]), (3, [[3, 3], 3, None])]
+
+    # Members must stay valid until the next step, even when their iterator reuses them
+    result = [(k, [(v[0], [*v[1]]) if v else None for v in vs]) for k, vs in parallel_iterator([accumulate_iterator(iter([1, 1, 2]), lambda x: x), iter([(2, [2])])], lambda x: x[0])]
+    assert result == [(1, [(1, [1, 1]), None]), (2, [(2, [2]), (2, [2])])]
+
 def test_accumulate_iteration():
     test = [1, 1, 5, 5, 3, 3]
     result = [(k,[*v]) for k,v in accumulate_iterator(iter(test), lambda x: x)]
@@ -535,6 +1541,35 @@ def test_reorder_missing():
     fixed = apply_reorder_indices(given, buffer, steps)
     assert fixed == ['b', 'a', 'c']
 
+def test_reorder_array():
+    '''Array reordering of rows and blocks should match apply_reorder_indices, with NaN for missing or out of range elements'''
+    target = ['z', 'b', 'c', 'a', 'y']
+    given = ['b', 'a', 'c', 'z', 'y']
+    block = np.arange(8, dtype='f4').reshape(2, 4)
+    reorder = get_reorder_array(target, given)
+    for row in block:
+        expected = apply_reorder_indices(row.tolist(), [None] * len(target), get_reorder_indices(target, given))
+        assert np.array_equal(apply_reorder_array(row, reorder), np.array(expected, dtype='f4'), equal_nan=True)
+    fixed = apply_reorder_array(block, reorder, dtype='f8')
+    assert fixed.dtype == np.float64 and np.array_equal(fixed, [[3, 0, 2, 1, np.nan], [7, 4, 6, 5, np.nan]], equal_nan=True)
+    assert apply_reorder_array(np.array(['b', 'a']), get_reorder_array(['a', 'x', 'b'], ['b', 'a']), dtype='U1', fill='').tolist() == ['a', '', 'b']
+    assert apply_reorder_array(np.empty((2, 0)), reorder).shape == (2, 5)
+
+def test_dictionary_ranges():
+    '''Rows compressed with a shared dictionary should be independently readable given the same dictionary'''
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        path, rows = os.path.join(tmpdirname, 'binary.bin'), []
+        for i in range(200):
+            row = data_pb2.RowData()
+            row.values.extend(range(i, i + 100))
+            rows.append(row.SerializeToString())
+        dictionary = train_row_dictionary(rows[::2], size=4096)
+        compress, _ = get_row_codec(dictionary=dictionary)
+        with write_compressed_ranges(path) as (writer, _):
+            ranges = [writer(compress(r), compressed=True) for r in rows]
+        with read_compressed_ranges(path, dictionary) as reader:
+            assert all(reader(*r, 100) == row for r, row in zip(ranges, rows))
+
 def test_compressed_ranges():
     '''Basic sanity check for compressed ranges'''
     with tempfile.TemporaryDirectory() as tmpdirname:
@@ -554,12 +1589,386 @@ def test_compressed_ranges():
                 for i, v in enumerate(row.values):
                     assert v == data[i]
 
+def test_gene_record():
+    '''Gene-major records should split back into their rows, which stay readable by their own ranges'''
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        path, parts = os.path.join(tmpdirname, 'binary.bin'), [(3, compress_row(b'a' * 10)), (0, compress_row(b'')), (7, compress_row(b'c'))]
+        with write_compressed_ranges(path) as (writer, teller):
+            writer(b'padding', compressed=True)
+            record_start = teller()
+            writer(gene_record_header(parts), compressed=True)
+            ranges = [writer(binary, compressed=True) for _, binary in parts]
+            record = (record_start, teller())
+        with open(path, 'rb') as f:
+            binary = f.read()
+        assert split_gene_record(binary[slice(*record)]) == dict(parts)
+        assert [binary[slice(*r)] for r in ranges] == [b for _, b in parts]
+        assert split_gene_record(gene_record_header([])) == {}
+
+def test_matrix_store():
+    '''Sanity check for sorted binary matrix stores'''
+    def mutator(row):
+        if row[0] == 'bad': raise AnnotationException('failed to annotate')
+        row[0] = row[0].split('.', 1)[0]
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        path, store_path = os.path.join(tmpdirname, 'matrix.csv'), os.path.join(tmpdirname, 'store')
+        with open(path, 'w') as f:
+            f.write('ID,s1,s2\nc.1,1,2\nbad,0,0\na,3.5,4\nb,5,6,7\nd,8\n')
+        write_matrix_store(path, store_path, mutator=mutator)
+        headers, keys, values = load_matrix_store(store_path)
+        assert headers == ['s1', 's2']
+        assert keys.tolist() == [['a'], ['b'], ['c'], ['d']]
+        assert values.dtype == np.float32 and values[:3].tolist() == [[3.5, 4], [5, 6], [1, 2]]
+        assert values[3, 0] == 8 and np.isnan(values[3, 1])
+
+def test_cache():
+    '''Cache entries should be reused until their source or fingerprint changes, and evicted least recently used first'''
+    with tempfile.TemporaryDirectory() as tmpdirname, patch(f'{__name__}.CACHE_DIR', os.path.join(tmpdirname, 'cache')), patch(f'{__name__}.LOCAL_TMP', tmpdirname):
+        path = os.path.join(tmpdirname, 'matrix.csv')
+        with open(path, 'w') as f: f.write('ID,s1\nb,1\na,2\n')
+        assert get_cache_path(path, 'kind', 'x') == get_cache_path(path, 'kind', 'x')
+        assert get_cache_path(path, 'kind', 'x') != get_cache_path(path, 'kind', 'y')
+        stores = lambda: set(n for n in os.listdir(CACHE_DIR) if n.endswith('.sorted_store'))
+
+        with iterate_matrix_sorted(path, fingerprint='x') as (_, reader):
+            assert [k for k, _ in reader] == ['a', 'b']
+        first = stores()
+        with iterate_matrix_sorted(path, fingerprint='x') as (_, reader):
+            assert [k for k, _ in reader] == ['a', 'b']
+        assert stores() == first and len(first) == 1
+
+        with open(path, 'w') as f: f.write('ID,s1\nc,1\n')
+        with iterate_matrix_sorted(path, fingerprint='x') as (_, reader):
+            assert [k for k, _ in reader] == ['c']
+        second = stores() - first
+        assert len(second) == 1
+
+        evict_cache(sum(os.path.getsize(os.path.join(CACHE_DIR, *second, n)) for n in os.listdir(os.path.join(CACHE_DIR, *second))))
+        assert stores() == second
+        evict_cache(0)
+        assert os.listdir(CACHE_DIR) == ['manifest.json']
+
+def test_annotation_index():
+    '''Compiled annotation tables should resolve IDs, aliases and transcripts to shared gene rows'''
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        gtf_path, info_path, alias_path = (os.path.join(tmpdirname, p) for p in ['a.gtf', 'gene_info', 'alias.tsv'])
+        with open(gtf_path, 'w') as f:
+            f.write('#!genome-build GRCh38\n1\tensembl\tgene\t10\t20\t.\t-\t.\tgene_id "ENSG1"; gene_name "ABC";\n')
+            f.write('1\tensembl\ttranscript\t10\t20\t.\t-\t.\tgene_id "ENSG1"; transcript_id "ENST1"; gene_name "ABC";\n')
+            f.write('1\tensembl\texon\t10\t20\t.\t-\t.\tgene_id "ENSG1"; transcript_id "ENST2"; gene_name "ABC";\n')
+            f.write('KI270728.1\tensembl\tgene\t1\t2\t.\t+\t.\tgene_id "ENSG2"; gene_name "DEF";\n')
+            f.write('2\tensembl\tgene\t1\t2\t.\t+\t.\tgene_id "ENSG3"; gene_name "Lower-case";\n')
+            f.write('1\tensembl\ttranscript\t10\t20\t.\t-\t.\tgene_id "ENSG9"; transcript_id "ENST9";\n')
+        with open(info_path, 'w') as f:
+            f.write('#tax_id\tGeneID\tSymbol\tLocusTag\tSynonyms\tdbXrefs\tchromosome\tmap_location\tdescription\n9606\t1\tABC\t-\t-\tEnsembl:ENSG1\t1\t1p\tsome gene\n')
+        with open(alias_path, 'w') as f:
+            f.write('HGNC ID\tApproved symbol\tStatus\tPrevious symbols\tAlias symbols\tEnsembl gene ID\nHGNC:1\tABC\tApproved\tOLD1\tXYZ, ABC2\tENSG1\n')
+
+        # Chunks split mid-line should parse the same in worker processes
+        records = list(iterate_gtf(gtf_path))
+        assert [r[0] for r in records] == ['gene', 'transcript', 'gene', 'gene', 'transcript'] and records[4][-3:] == ('ENSG9', None, 'ENST9')
+        assert list(iterate_gtf(gtf_path, workers=2, chunk_size=7)) == records
+
+        index_path = os.path.join(tmpdirname, 'index')
+        compile_annotation_index(info_path, gtf_path, alias_path, index_path)
+        index = load_annotation_index(index_path)
+        assert index['gene_keys'].tolist() == ['ABC', 'ABC2', 'ENSG1', 'OLD1', 'XYZ']
+        assert find_annotation_rows(index['gene_keys'], index['gene_rows'], ['XYZ', 'ENSG1', 'NOPE', 'ZZZ']).tolist() == [0, 0, -1, -1]
+        assert find_annotation_rows(index['transcript_keys'], index['transcript_rows'], ['ENST1', 'ENST9']).tolist() == [0, -1]
+        assert index['genes'].tolist() == [['ENSG1', 'ABC', '1', '-']] and index['descriptions'].tolist() == [b'Some gene']
+
+def test_segment_path():
+    '''Dataset segments should only be invalidated by changes to their own inputs'''
+    with tempfile.TemporaryDirectory() as tmpdirname, patch(f'{__name__}.CACHE_DIR', os.path.join(tmpdirname, 'cache')):
+        for p in ['meta.csv', 'a.csv', 'b.csv']:
+            with open(os.path.join(tmpdirname, p), 'w') as f: f.write('ID,s1\ng,1\n')
+        d1 = {'id': 'D1', 'dir': tmpdirname, 'meta': 'meta.csv', 'matrices': [{'name': 'A', 'path': 'a.csv'}], '_internal': []}
+        d2 = {'id': 'D2', 'dir': tmpdirname, 'meta': 'meta.csv', 'matrices': [{'name': 'B', 'path': 'b.csv'}]}
+        before = get_segment_path(d1), get_segment_path(d2)
+        assert before == (get_segment_path(d1), get_segment_path(d2))
+        assert before[0] != get_segment_path(d1, 'other annotation')
+
+        with open(os.path.join(tmpdirname, 'b.csv'), 'w') as f: f.write('ID,s1\ng,2\n')
+        assert get_segment_path(d1) == before[0] and get_segment_path(d2) != before[1]
+
+def test_row_encoding():
+    '''Quantized rows should decode close to their float32 values'''
+    values = np.array([0, 1e-3, 0.5, 3, 1234.5, 60000, -2, np.nan], dtype='f4')
+    for encoding, rtol, atol in [('float32', 0, 0), ('float16', 1e-3, 1e-6), ('uint16', 1e-3, 1e-3)]:
+        row = data_pb2.RowData()
+        row.ParseFromString(encode_row_values(values, encoding).SerializeToString())
+        decoded = decode_row_values(row)
+        assert np.allclose(decoded, values, rtol=rtol, atol=atol, equal_nan=True), (encoding, decoded)
+        assert decoded[0] == 0
+        assert bool(row.values) == (encoding == 'float32')
+
+    # Rows outside float16 range fall back to float32
+    assert list(encode_row_values(np.array([1e6], dtype='f4'), 'float16').values) == [1e6]
+
+def test_sort_external():
+    '''Spilled runs should merge into the same order as an in-memory sort, and tee'd input should gzip losslessly'''
+    rows = [[f'g{i * 7 % 10}', str(i)] for i in range(10)]
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        for run_rows in [3, 100]:
+            with sort_external(iter([r[:] for r in rows]), tmpdirname, run_rows) as sorted_rows:
+                assert list(sorted_rows) == sorted(rows)
+
+        path, gzip_path = os.path.join(tmpdirname, 'matrix.csv'), os.path.join(tmpdirname, 'matrix.csv.gz')
+        with open(path, 'w') as f:
+            f.write('ID,s1\n' + ''.join(f'{k},{v}\n' for k, v in rows))
+        with iterate_csv(path, tee_gzip=gzip_path) as (headers, reader):
+            assert headers == ['s1'] and next(reader) == rows[0]
+        with gzip.open(gzip_path, 'rb') as f, open(path, 'rb') as g:
+            assert f.read() == g.read()
+
+def test_run_report():
+    '''Stage times and counters (including replayed warnings) should be reported, and nothing recorded outside of a report'''
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        report_path = os.path.join(tmpdirname, 'report.json')
+        with run_report(report_path):
+            with report_stage('sort'): pass
+            report_time('pvalues', 0.5, 2)
+            report_count('cache', 'sorted_store hit')
+            logging.warning('a.csv\tfailed to annotate\tgene\tENSG0')
+            logging.warning('a.csv\tfailed to annotate\ttranscript\tENST0')
+            logging.warning('pipeline\tonly in DS1\tgene\tENSG1')
+        with io.open(report_path, 'r') as f:
+            report = json.load(f)
+        assert report['stages']['sort']['calls'] == 1 and report['stages']['pvalues'] == {'seconds': 0.5, 'calls': 2}
+        assert report['cache'] == {'sorted_store hit': 1} and report['annotation_failures'] == {'gene': 1, 'transcript': 1}
+        assert report['warnings'] == {'failed to annotate': 2, 'below MIN_HITS': 1}
+        report_count('cache', 'sorted_store hit')
+        assert not _run_report
+
+def test_deploy_cloudfront():
+    '''Deploys should only upload changed files, resuming interrupted multipart uploads (needs moto for a local S3), keeping an ETag per deployed file'''
+    import pytest
+    mock_aws = pytest.importorskip('moto').mock_aws
+    with tempfile.TemporaryDirectory() as tmpdirname, patch(f'{__name__}.CACHE_DIR', os.path.join(tmpdirname, 'cache')):
+        chunk_size, paths = 5242880, [os.path.join(tmpdirname, p) for p in ['out.hdf5', 'expression.bin']]
+        with open(paths[0], 'wb') as f: f.write(b'small')
+        with open(paths[1], 'wb') as f: f.write(np.random.default_rng(0).bytes(2 * chunk_size + 10))
+
+        with mock_aws(), run_report(os.path.join(tmpdirname, 'report.json')) as report:
+            s3 = boto3.client('s3', region_name='us-east-1')
+            s3.create_bucket(Bucket='test-bucket')
+
+            # An interrupted deploy uploaded the first part only
+            upload_id = s3.create_multipart_upload(Bucket='test-bucket', Key='bithub/expression.bin', CacheControl='max-age=3600')['UploadId']
+            with open(paths[1], 'rb') as f:
+                s3.upload_part(Bucket='test-bucket', Key='bithub/expression.bin', UploadId=upload_id, PartNumber=1, Body=f.read(chunk_size))
+
+            urls = manage_deploy_cloudfront(paths, 'example.org', 'test-bucket', chunk_size=chunk_size)
+            assert urls == {'out.hdf5': 'https://example.org/bithub/out.hdf5', 'expression.bin': 'https://example.org/bithub/expression.bin'}
+            assert report['deploy'] == {'unchanged': 0, 'parts resumed': 1, 'uploaded': 2, 'bytes uploaded': chunk_size + 10 + 5}
+            for p in paths:
+                head = s3.head_object(Bucket='test-bucket', Key='bithub/' + os.path.basename(p))
+                assert head['ETag'].strip('"') == calc_s3_etag(p, chunk_size, chunk_size) and head['CacheControl'] == 'max-age=3600'
+            assert not s3.list_multipart_uploads(Bucket='test-bucket').get('Uploads', [])
+
+            # ETags of unchanged files come from the manifest
+            with patch('hashlib.md5', side_effect=AssertionError('re-hashed')):
+                manage_deploy_cloudfront(paths, 'example.org', 'test-bucket', chunk_size=chunk_size)
+            assert report['deploy']['unchanged'] == 2 and report['deploy']['uploaded'] == 2
+
+            # Changed files replace their ETag, removed ones are forgotten once the cache is evicted
+            with open(paths[0], 'wb') as f: f.write(b'changed')
+            manage_deploy_cloudfront(paths, 'example.org', 'test-bucket', chunk_size=chunk_size)
+            assert report['deploy']['uploaded'] == 3
+        os.remove(paths[1])
+        evict_cache()
+        with cache_manifest() as manifest:
+            assert list(manifest['etags']) == [os.path.abspath(paths[0])]
+
+def test_ordered_block_writer():
+    '''Pooled and inline results should be handled in submission order'''
+    for workers in [0, 2]:
+        results = []
+        with ordered_block_writer(workers) as (submit, put):
+            for i in range(20):
+                submit(results.append, pow, i, 2)
+                put(results.append, -i)
+        assert results == [v for i in range(20) for v in (i * i, -i)]
+
+def test_pvalues_block():
+    '''Check vectorized pvalues against scalar scipy calls, including omitted and degenerate rows'''
+    rng = np.random.default_rng(0)
+    block = rng.integers(0, 6, size=(40, 30)).astype('f8')
+    block[1] = 3.0
+    block[2, 5:] = 0.0
+    block[3, ::4] = np.nan
+    block[4, 2:] = 1.0
+    block[5, [0, 1]] = np.nan
+    numeric, numeric_nan = rng.normal(size=30), rng.integers(0, 4, size=30).astype('f8')
+    numeric_nan[::7] = np.nan
+    categories = np.array([b'a', b'b', b'c'], dtype='S6')[rng.integers(0, 3, size=30)]
+    groups = [np.where(categories == c)[0] for c in set(categories)]
+    columns = [('n', numeric, None, {}, None), ('nn', numeric_nan, None, {}, None), ('c', categories, groups, {}, None), 
+               ('one', categories, [np.arange(30)], {}, None), ('const', np.ones(30), None, {}, None)]
+    
+    result = calc_pvalues_block(block, columns)
+    assert result.shape == (40, 10)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for i, row in enumerate(block):
+            expected = [*spearmanr(row, numeric, nan_policy='omit'), *spearmanr(row, numeric_nan, nan_policy='omit'),
+                        *f_oneway(*[row[g] for g in groups], nan_policy='omit'), np.nan, np.nan, np.nan, np.nan]
+            assert np.allclose(result[i], np.array(expected, dtype='f8'), rtol=1e-6, equal_nan=True), (i, result[i], expected)
+
+def test_log_means():
+    '''Check vectorized log means and z-scores against the per value computation they replaced, with missing values, constant rows and empty groups'''
+    rng = np.random.default_rng(0)
+    block = rng.lognormal(size=(20, 12))
+    block[1, ::3], block[2] = np.nan, 5.0
+    block[3] = -block[3]
+    filter_indices = [np.array([0, 1, 2]), np.array([], dtype=int), np.arange(12), np.array([3])]
+
+    logs, logs_filter = calc_log_means(block, filter_indices)
+    assert logs.shape == (20,) and logs_filter.shape == (20, 4)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for i, row in enumerate(block):
+            logged = [math.log2(abs(v) + LOG2_OFFSET) for v in row]
+            assert np.allclose(logs[i], np.mean(logged), equal_nan=True), (i, logs[i])
+            expected = [np.mean([logged[j] for j in indices]) for indices in filter_indices]
+            assert np.allclose(logs_filter[i], expected, equal_nan=True), (i, logs_filter[i], expected)
+    assert calc_log_means(block, [])[1].shape == (20, 0)
+
+    # Z-scores of each matrix's log means, including a constant matrix
+    matrices = np.stack([logs, logs[::-1], np.full(20, 2.0)])
+    zscores = calc_zscore(matrices)
+    for logs_row, zscores_row in zip(matrices, zscores):
+        log_mean, log_sd = np.mean(logs_row), np.std(logs_row) or 0.0000000001
+        assert np.allclose(zscores_row, np.array([(x - log_mean) / log_sd for x in logs_row], dtype='f4'), equal_nan=True)
+    assert not zscores[2].any() and calc_zscore(logs).shape == (20,)
+
+def test_convert_to_serializable():
+    '''Check column typing against per-cell int/float parsing, including NA and cells Python accepts but are kept as strings'''
+    def reference(values, na_values=['NA', '']):
+        values = [np.nan if v in na_values else parse_cell(v) for v in values]
+        arr = np.array(values)
+        if arr.dtype.char == 'U':
+            values = ['Unknown' if v is np.nan else str(v) for v in values]
+            arr = np.array([v.encode() for v in values], dtype=f'S{max(map(len, values))}')
+        return arr
+
+    columns = [['1', '-2', '+3'], ['1', 'NA', '-0'], ['1.5', '', '2e3', '.5'], ['-0', '0.0', '1'], ['Sample_1', 'Sample_2'],
+               [' 4', '5'], ['1_000', '2'], ['nan', '1'], ['inf', 'x'], ['a', 'NA', '3'], ['1', '2\n3'], ['1', '١']]
+    for column in columns:
+        result, expected = convert_to_serializable(column), reference(column)
+        assert result.dtype == expected.dtype and result.tobytes() == expected.tobytes(), (column, result, expected)
+    assert convert_to_serializable(['1', '-'], na_values=['-']).dtype.kind == 'f'
+    assert convert_to_serializable(['1', '2'], force_string=True).tolist() == [b'1', b'2']
+
+def test_parse_metadata():
+    '''Check metadata columns are typed and ordered by sample, and that rows with missing cells are rejected'''
+    with tempfile.TemporaryDirectory() as tmpdirname, patch(f'{__name__}.CACHE_DIR', tmpdirname), patch(f'{__name__}.LOCAL_TMP', tmpdirname):
+        with open(os.path.join(tmpdirname, 'meta.csv'), 'w') as f:
+            f.write('Sample,Age,Sex\ns2,40,F\ns1,31,M\n')
+        top_headers, side_headers, _, columns = parse_metadata({'dir': tmpdirname, 'meta': 'meta.csv'}, [])
+        assert top_headers == ['Age', 'Sex'] and side_headers == ['s1', 's2']
+        assert [(h, column.tolist()) for h, column, *_ in columns] == [('Age', [31, 40]), ('Sex', [b'M', b'F'])]
+
+        with open(os.path.join(tmpdirname, 'ragged.csv'), 'w') as f:
+            f.write('Sample,Age,Sex\ns1,31,M\ns3,40\n')
+        try:
+            parse_metadata({'dir': tmpdirname, 'meta': 'ragged.csv'}, [])
+            assert False, 'ragged rows should raise'
+        except ValueError as e:
+            assert 'ragged.csv' in str(e) and 'sample s3 has 2 columns, expected 3' in str(e)
+
+def test_neighbours():
+    '''Check blocked top k neighbours against full correlation matrices, with missing values, constant rows and k beyond the number of rows'''
+    rng = np.random.default_rng(0)
+    logged = rng.normal(size=(40, 12)).astype('f4')
+    logged[3], logged[7, 2] = 1.0, np.nan
+    with warnings.catch_warnings():
+        # The constant row has no correlation
+        warnings.simplefilter('ignore', RuntimeWarning)
+        expected = np.corrcoef(np.where(np.isnan(logged), np.nanmean(logged, axis=1, keepdims=True), logged))
+    np.fill_diagonal(expected, -np.inf)
+    expected[:, 3] = -np.inf
+    for k, block_size in [(5, 7), (5, 1024), (50, 16)]:
+        rows, correlations = calc_neighbours(logged, k, block_size)
+        assert rows.shape == (40, k) and (rows[3] == -1).all() and np.isnan(correlations[3]).all()
+        for i in set(range(40)) - {3}:
+            top = np.argsort(-expected[i], kind='stable')[:min(k, 38)]
+            assert rows[i, :len(top)].tolist() == top.tolist() and (rows[i, len(top):] == -1).all(), (i, rows[i], top)
+            assert np.allclose(correlations[i, :len(top)], expected[i, top], atol=1e-5)
+    assert calc_neighbours(logged[:1], 5)[0].tolist() == [[-1] * 5]
+
+def test_search_index():
+    '''Check exact and prefix search index lookups over IDs, symbols and aliases of written genes only'''
+    a, b, c = ['ENSG1', 'BDNF', '11'], ['ENSG2', 'BDNF-AS', '11'], ['ENSG3', 'TP53', '17']
+    gene_to_gene = {'ENSG1': a, 'BDNF': a, 'ENSG2': b, 'BDNF-AS': b, 'bdnfos': b, 'ENSG3': c, 'TP53': c, 'P53': c}
+    keys, rows, kinds = build_search_index(gene_to_gene, {'ENSG1': 0, 'ENSG2': 1})
+    assert keys.tolist() == sorted(keys.tolist()) and b'TP53' not in keys.tolist()
+    assert dict(zip(keys.tolist(), kinds.tolist())) == {b'ENSG1': 0, b'BDNF': 1, b'ENSG2': 0, b'BDNF-AS': 1, b'BDNFOS': 2}
+    assert search_index_rows(keys, rows, 'bdnf').tolist() == [0]
+    assert sorted(search_index_rows(keys, rows, ' bdnf', prefix=True).tolist()) == [0, 1, 1]
+    assert search_index_rows(keys, rows, 'BDNFO', prefix=True).tolist() == [1]
+    assert search_index_rows(keys, rows, 'p53', prefix=True).tolist() == [] and search_index_rows(keys, rows, 'ZZZ').tolist() == []
+
+def test_summary_block():
+    '''Check vectorized box plot statistics against per row numpy percentiles, with missing values, empty and single sample groups'''
+    rng = np.random.default_rng(0)
+    block = rng.lognormal(size=(20, 30))
+    block[1, ::3], block[2, :10], block[3] = np.nan, np.nan, np.nan
+    block[4, 0] = 100.0
+    categories = np.array([b'a', b'b', b'c'], dtype='S6')[rng.integers(0, 3, size=30)]
+    categories[:10], categories[10] = b'a', b'single'
+    groups = [np.where(categories == c)[0] for c in sorted(set(categories))]
+    columns = [('n', rng.normal(size=30), None, {}, None), ('c', categories, groups, {}, None)]
+
+    assert summary_layout(columns) == (['c'], [['a', 'b', 'c', 'single']])
+    counts, result = calc_summary_block(block, columns)
+    assert counts.shape == (20, 4) and counts.dtype.kind == 'i' and result.shape == (20, 4 * len(SUMMARY_STATS))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for i, row in enumerate(block):
+            for g, indices in enumerate(groups):
+                values = row[indices][~np.isnan(row[indices])]
+                q1, median, q3 = np.percentile(values, [25, 50, 75]) if len(values) else [np.nan] * 3
+                within = values[(values >= q1 - 1.5 * (q3 - q1)) & (values <= q3 + 1.5 * (q3 - q1))]
+                expected = [values.mean() if len(values) else np.nan, median, q1, q3, within.min() if len(values) else np.nan, within.max() if len(values) else np.nan]
+                assert counts[i, g] == len(values) and np.allclose(result[i, g * 6:(g + 1) * 6], expected, equal_nan=True), (i, g, result[i, g * 6:(g + 1) * 6], expected)
+    assert result[4, 5] < 100.0 and [a.shape for a in calc_summary_block(block, columns[:1])] == [(20, 0), (20, 0)]
+
+def test_shard_output():
+    '''Check that sharding keeps every path, attribute and group hard link, and that the header only keeps the table data'''
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        path = os.path.join(tmpdirname, 'out.hdf5')
+        with h5py.File(path, 'w') as root:
+            root.attrs.create('remote', [['/metadata/D1/matrices/A', '/data/D1', 'RowData']])
+            write_string_dataset(root, 'data/Ensembl ID', ['ENSG1', 'ENSG2'])
+            for d_id in ['D1', 'D2']:
+                root[f'metadata/{d_id}/zscores/All'] = np.arange(2, dtype='f4')
+                write_string_dataset(root, f'metadata/{d_id}/sample_names', ['s1', 's2', 's3'])
+                root[f'metadata/{d_id}/samples/Age'] = np.array([1, 2, 3])
+                root[f'metadata/{d_id}/samples'].attrs.create('order', ['Age'])
+            root['metadata/D1/matrices/A'] = np.array([[0, 10], [10, 20]])
+            root['metadata/D1/matrices'].attrs.create('order', ['A'])
+            root.create_group('groups').attrs.create('order', ['Bulk'])
+            root['groups'].create_group('Bulk')['D1'] = root['metadata/D1']
+
+        manifest = shard_output(tmpdirname)
+        assert manifest['header'] == 'out.hdf5' and list(manifest['shards']) == ['D1', 'D2']
+        assert sorted(manifest['shards']['D1']['keys']) == ['matrices', 'sample_names', 'samples'] and manifest['shards']['D2']['keys'] == ['sample_names', 'samples']
+        with h5py.File(path, 'r') as header, h5py.File(os.path.join(tmpdirname, manifest['shards']['D1']['file']), 'r') as shard:
+            assert [tuple(r) for r in header.attrs['remote']] == [('/metadata/D1/matrices/A', '/data/D1', 'RowData')]
+            assert list(header['metadata/D1']) == ['zscores'] and header['data/Ensembl ID'][()].tolist() == [b'ENSG1', b'ENSG2']
+            assert header['groups/Bulk/D1'] == header['metadata/D1'] and list(header['groups'].attrs['order']) == ['Bulk']
+            assert list(shard['metadata/D1/matrices'].attrs['order']) == ['A'] and shard['metadata/D1/matrices/A'][()].tolist() == [[0, 10], [10, 20]]
+            assert shard['metadata/D1/samples/Age'][()].tolist() == [1, 2, 3] and list(shard['metadata/D1/samples'].attrs['order']) == ['Age']
+            assert 'zscores' not in shard['metadata/D1'] and manifest['shards']['D1']['bytes'] == os.path.getsize(shard.filename)
+
 def run():
     if len(sys.argv) != 2 or sys.argv[1] in ('-h', '--help'): 
         print("Error: First argument should be input.yaml path, see example")
         exit(1)
         
-    with patch('builtins.open', open_with_progress):
+    with patch('builtins.open', open_with_progress), context_closer() as contexts:
         test_parallel_iteration()
         test_accumulate_iteration()
         test_reorder()
@@ -591,195 +2000,271 @@ def run():
                             filemode='w',
                             format='%(asctime)s,bithub,%(levelname)s\t%(message)s',
                             datefmt='%H:%M:%S',
-                            level=logging.INFO)
+                            level=logging.INFO,
+                            force=True)
+
+        # Stage timings and counters are reported next to the log, e.g. report.json alongside warnings.log
+        contexts.append(run_report(os.path.join(OUTPUT_FOLDER, f'report{("." + str(log_num)) if log_num else ""}.json'), inputObj.get('profiler', None)))
+        contexts[-1].__enter__()
         
         def deploy(paths):
-            return manage_deploy_local(paths) if inputObj['deploy_local'] else manage_deploy_cloudfront(paths, inputObj['deploy_url'])
+            with report_stage('deploy'):
+                return manage_deploy_local(paths) if inputObj['deploy_local'] else manage_deploy_cloudfront(paths, inputObj['deploy_url'], inputObj.get('deploy_bucket', 'bithub-bucket'))
 
         if inputObj.get('deploy_only', False):
             deploy([os.path.join(OUTPUT_FOLDER, p) for p in os.listdir(OUTPUT_FOLDER)])
             exit(0)
 
         # Load gene mappings/annotations into memory
-        gene_to_gene, transcript_to_transcript, transcript_to_gene = get_ncbi_annotator(inputObj.get('ncbi_gene_info', None), inputObj.get('ncbi_gtf'), inputObj.get('genenames_alias', None))
+        with report_stage('annotation'):
+            gene_to_gene, transcript_to_transcript, transcript_to_gene, annotator_fingerprint = get_ncbi_annotator(inputObj.get('ncbi_gene_info', None), inputObj.get('ncbi_gtf'), inputObj.get('genenames_alias', None), inputObj.get('workers', 0))
         all_ranges = []
 
         with h5py.File(os.path.join(OUTPUT_FOLDER, 'out.hdf5'), 'w') as root, open(os.path.join(OUTPUT_FOLDER, 'errors.tsv'), 'w') as f_err:
-            with context_closer() as contexts:
-                contexts.append(write_compressed_ranges(EXPRESSION_PATH))
-                writer, teller = contexts[-1].__enter__()
-                last_range_end = 0
-
-                # Iterate over all annotated genes in all datasets in alphanumeric order
-                annots_written = []
-                with parallel_dataset_context(inputObj['datasets'], gene_to_gene, transcript_to_gene) as ret:
-                    first, iterator = ret
-                    all_metadata_columns = {}
-
-                    meta_root = root.create_group('metadata')
-                    for dataset, headers in zip(inputObj['datasets'], first):
-
-                        variance_headers, matrix_headers, transcript_headers = headers
-                        dataset['_internal'] = ([], [0], [], variance_headers)
-
-                        # Get sample order from metadata first column
-                        orders = [o for o in inputObj['customMetadataCategoryOrders'] if dataset['id'] in o['datasets']]
-                        top_headers, side_headers, filter_factors_enum, columns = parse_metadata(dataset, orders, CATEGORY_LIMIT)
-                        
-                        samples_from_metadata = list(iterate_unique(side_headers))
-
-                        data_meta_root = meta_root.create_group(dataset['id'])
-
-                        # Write display-related settings
-                        extra_attrs = {}
-                        if custom_filter := dataset.get('customFilter', None):
-                            extra_attrs['customFilterCategory'] = filter_factors_enum[1]
-                            if name_filter := custom_filter.get('name', None):
-                                extra_attrs['customFilterName'] = name_filter.strip()
-                            if order_filter := custom_filter.get('column', None):
-                                extra_attrs['customFilterColumn'] = order_filter.strip()
-                        if column_default := dataset.get('default', None):
-                            extra_attrs['customDefaultColumn'] = column_default
-
-                        # Determine minimal sample set to write
-                        samples_from_matrices = set()
-                        for samples in matrix_headers:
-                            samples_from_matrices.update(samples)
-                        sample_whitelist = samples_from_matrices.intersection(samples_from_metadata)
-                        sample_whitelist_ordered = list(sorted(sample_whitelist))
-                        
-                        # Store sample metadata in memory for pvalue calculations
-                        column_indices = list(filter(lambda x: x is not None, get_reorder_indices(sample_whitelist_ordered, side_headers)))
-                        def filter_metadata(columns):
-                            new_array = columns[1][column_indices]
-                            new_groups = [np.where(new_array == c)[0] for c in set(new_array)] if new_array.dtype.type is np.bytes_ else None
-                            return (columns[0], new_array, new_groups, columns[3], columns[4])
-                        all_metadata_columns[dataset['id']] = (list(map(filter_metadata, columns)), extra_attrs)
-                        
-                        # Write sample names
-                        with contextlib.suppress(Exception):
-                            write_string_dataset(data_meta_root, 'sample_names', sample_whitelist_ordered)
-                        dataset['_internal_sample_count'] = len(sample_whitelist)
-                        dataset['_null_transcripts'] = [None] * len(dataset.get('transcript_matrices', []))
-                        
-                        for matrix, samples in zip(dataset['matrices'], matrix_headers):
-                            ranges, logs, pvalue_ranges = [], [], []
-                            # Initialize re-order buffer
-                            reorder_indices = get_reorder_indices(sample_whitelist_ordered, samples)
-                            reorder_buffer = [None] * len(sample_whitelist_ordered)
-
-                            # Create fixed filter indices
-                            logs_filter_enum = None
-                            if filter_factors_enum:
-                                filter_name, filter_categories, filter_factors = filter_factors_enum
-                                filter_indices = [[] for _ in filter_categories]
-                                for i, fv in enumerate(apply_reorder_indices(filter_factors, reorder_buffer, reorder_indices)):
-                                    if fv is not None: filter_indices[fv].append(i)
-                                logs_filter_enum = (filter_factors_enum, filter_indices, [[] for _ in filter_factors_enum[1]])
-
-                            matrix['_internal'] = (ranges, reorder_indices, reorder_buffer, logs, logs_filter_enum, pvalue_ranges)
-
-                        if not (transcript_matrices := dataset.get('transcript_matrices', None)): continue
-                        
-                        for transcript, headers in zip(transcript_matrices, transcript_headers):
-                            order_entry = next((o for o in orders if o['variable'] == transcript.get('variable', None)), None)
-                            categories = []
-                            if order_entry: categories = [k for k in order_entry['order'] if k in headers]
-                            else: categories = headers[1:]
-                            
-                            reorder_indices = get_reorder_indices(categories, headers[1:])
-                            reorder_buffer = [None] * len(categories)
-
-                            transcript['_internal'] = ([], categories, reorder_indices, reorder_buffer)
-
-                    # Loop over all genes
-                    VARPART_INDICES, MATRIX_INDICES, TRANSCRIPT_INDICES = (1, 0), (1, 1, 1), (1, 2, 1)
-                    for gene, combined in itertools.islice(iterator, GENE_LIMIT):
-
-                        # N.B. verify using json.dump with default - combining parallel primitives leads to lots of nested keys
-                        varparts_per_dataset = tuple(safe_access_nested(c, VARPART_INDICES, None) for c in combined)
-                        m_groups_per_dataset = tuple(safe_access_nested(c, MATRIX_INDICES, None) for c in combined)
-                        t_groups_per_dataset = tuple(safe_access_nested(c, TRANSCRIPT_INDICES, None) for c in combined)                   
-
-                        if not (annot := gene_to_gene.get(gene, None)):
-                            raise AnnotationException(f'unexpected gene {gene} - annotation/sorted cache likely outdated')
-                        
-                        if MIN_HITS > (len(m_groups_per_dataset) - m_groups_per_dataset.count(None)): 
-                            which_ds = [inputObj['datasets'][mi]['id'] for mi, m in enumerate(m_groups_per_dataset) if m is not None]
-                            logging.warning(f'pipeline\tonly in {",".join(which_ds)}\tgene\t{gene}')
-                            continue
-
-                        annots_written.append(annot)
-                        total_written += 1
-                        for dataset, varpart, matrices, transcripts in zip(inputObj['datasets'], varparts_per_dataset, m_groups_per_dataset, t_groups_per_dataset):
-                            # Maintain sparse lookup indices for each dataset
-                            indices, curent_index, varpart_ranges, varpart_headers = dataset['_internal']
-                            indices.append(curent_index[0] if matrices else -1)
-                            
-                            # Drop anything that doesn't appear in all matrices so we don't need to manage a second index
-                            if not matrices or not all(matrices): continue
-
-                            curent_index[0] += 1
-                            if varpart_headers:
-                                row = data_pb2.RowData()
-                                row.values.extend([float(v) for v in varpart[1:]] if varpart else [0.0] * len(varpart_headers))
-                                varpart_ranges.append(writer(row.SerializeToString()))
-
-                            for m in matrices:
-                                if m is None: continue
-                                dataset, matrix, samples, gene, values = m
-                                ranges, reorder_indices, reorder_buffer, logs, logs_filter_enum, pvalue_ranges = matrix['_internal']
-
-                                # Write re-orderd matrix row and save range (input, buffer, steps)
-                                fixed = apply_reorder_indices([float(v) for v in values], reorder_buffer, reorder_indices)
-                                
-                                # Calculate pvalues for each column against expression data
-                                pvalues = []
-                                for header, array, groups, attrs, col_type in all_metadata_columns[dataset['id']][0]:
-                                    if not groups:
-                                        pvalues.extend(spearmanr(fixed, array, nan_policy='omit'))
-                                    elif len(groups) == 1:
-                                        pvalues.extend([float('nan'), float('nan')])
-                                    else:
-                                        pvalues.extend(f_oneway(*[[fixed[i] for i in g] for g in groups], nan_policy='omit'))
-                                pvalue_row = data_pb2.RowData()
-                                pvalue_row.values.extend(pvalues)
-                                pvalue_ranges.append(writer(pvalue_row.SerializeToString()))
-                                
-                                row = data_pb2.RowData()
-                                row.values.extend(fixed)
-                                ranges.append(writer(row.SerializeToString()))
-
-                                # Get logs for zscore calc
-                                fixed_logged = [math.log2(abs(v) + LOG2_OFFSET) for v in fixed]
-                                logs.append(np.mean(fixed_logged))
-                                
-                                # Determine region subset
-                                if logs_filter_enum:
-                                    _, filter_indices, logs_filter = logs_filter_enum
-                                    for i in range(len(filter_indices)):
-                                        logs_filter[i].append(np.mean([fixed_logged[j] for j in filter_indices[i]]))
-                                        
-                            if 'transcript_matrices' in dataset:
-                                for transcript_matrix, accumulated in zip(dataset['transcript_matrices'], transcripts or dataset['_null_transcripts']):
-                                    ranges, categories, reorder_indices, reorder_buffer = transcript_matrix['_internal']
-                                    table = data_pb2.TableData()
-                                    if accumulated is not None: 
-                                        _, t_list = accumulated
-                                        for t in t_list:
-                                            _, transcript_id, *values = t
-                                            fixed = apply_reorder_indices([float(v) for v in values], reorder_buffer, reorder_indices)
-                                            table.float_values.extend(fixed)
-                                            table.string_values.append(transcript_id)
-                                    ranges.append(writer(table.SerializeToString()))
+            all_metadata_columns = {}
+            meta_root = root.create_group('metadata')
+
+            def prepare_dataset(dataset, headers):
+                '''Parse sample metadata and set up re-ordering of matrix columns to the sample order'''
+                variance_headers, matrix_headers, transcript_headers = headers
+                dataset['_internal'] = ([], [0], [], variance_headers)
+
+                # Get sample order from metadata first column
+                orders = [o for o in inputObj['customMetadataCategoryOrders'] if dataset['id'] in o['datasets']]
+                with report_stage('metadata'):
+                    top_headers, side_headers, filter_factors_enum, columns = parse_metadata(dataset, orders, CATEGORY_LIMIT, inputObj.get('workers', 0) or 0)
+                
+                samples_from_metadata = list(iterate_unique(side_headers))
+
+                data_meta_root = meta_root.create_group(dataset['id'])
+
+                # Write display-related settings
+                extra_attrs = {}
+                if custom_filter := dataset.get('customFilter', None):
+                    extra_attrs['customFilterCategory'] = filter_factors_enum[1]
+                    if name_filter := custom_filter.get('name', None):
+                        extra_attrs['customFilterName'] = name_filter.strip()
+                    if order_filter := custom_filter.get('column', None):
+                        extra_attrs['customFilterColumn'] = order_filter.strip()
+                if column_default := dataset.get('default', None):
+                    extra_attrs['customDefaultColumn'] = column_default
+
+                # Determine minimal sample set to write
+                samples_from_matrices = set()
+                for samples in matrix_headers:
+                    samples_from_matrices.update(samples)
+                sample_whitelist = samples_from_matrices.intersection(samples_from_metadata)
+                sample_whitelist_ordered = list(sorted(sample_whitelist))
+                
+                # Store sample metadata in memory for pvalue calculations
+                column_indices = list(filter(lambda x: x is not None, get_reorder_indices(sample_whitelist_ordered, side_headers)))
+                def filter_metadata(columns):
+                    new_array = columns[1][column_indices]
+                    new_groups = [np.where(new_array == c)[0] for c in sorted(set(new_array))] if new_array.dtype.type is np.bytes_ else None
+                    return (columns[0], new_array, new_groups, columns[3], columns[4])
+                all_metadata_columns[dataset['id']] = (list(map(filter_metadata, columns)), extra_attrs)
+                
+                # Write sample names
+                with contextlib.suppress(Exception):
+                    write_string_dataset(data_meta_root, 'sample_names', sample_whitelist_ordered)
+                dataset['_internal_sample_count'] = len(sample_whitelist)
+                
+                for matrix, samples in zip(dataset['matrices'], matrix_headers):
+                    # Precompute the gather of matrix columns into sample order
+                    reorder = get_reorder_array(sample_whitelist_ordered, samples)
+
+                    # Create fixed filter indices
+                    logs_filter_enum = None
+                    if filter_factors_enum:
+                        filter_name, filter_categories, filter_factors = filter_factors_enum
+                        fixed_factors = apply_reorder_array(filter_factors, reorder, dtype=np.intp, fill=-1)
+                        filter_indices = [np.where(fixed_factors == c)[0] for c in range(len(filter_categories))]
+                        logs_filter_enum = (filter_factors_enum, filter_indices)
+
+                    matrix['_internal'] = ([], reorder, logs_filter_enum, [])
+
+                if not (transcript_matrices := dataset.get('transcript_matrices', None)): return
+                
+                for transcript, headers in zip(transcript_matrices, transcript_headers):
+                    order_entry = next((o for o in orders if o['variable'] == transcript.get('variable', None)), None)
+                    categories = []
+                    if order_entry: categories = [k for k in order_entry['order'] if k in headers]
+                    else: categories = headers[1:]
                     
-                    # Write metadata columns and their pvalues
-                    for dataset_id, [columns, extra_attrs] in all_metadata_columns.items():
-                        try:
+                    transcript['_internal'] = ([], categories, get_reorder_array(categories, headers[1:]))
+
+            # Encode each dataset into a segment, reusing those whose inputs are unchanged since a previous run
+            segments, reused = [], []
+            for dataset in inputObj['datasets']:
+                orders = [o for o in inputObj['customMetadataCategoryOrders'] if dataset['id'] in o['datasets']]
+                encoding = dataset.get('encoding', inputObj.get('encoding', 'float32'))
+                neighbours, summaries = inputObj.get('neighbours', 0) or 0, bool(inputObj.get('summaries', False))
+                segment_path = get_segment_path(dataset, annotator_fingerprint + json.dumps(orders, default=str) + encoding + (f'neighbours{neighbours}' if neighbours else '') + ('summaries' if summaries else ''))
+                start = time.perf_counter()
+                if os.path.exists(segment_path):
+                    replay_warnings(os.path.join(segment_path, 'warnings.log'))
+                    with io.open(os.path.join(segment_path, 'headers.json'), 'r') as f:
+                        prepare_dataset(dataset, json.load(f))
+                    reused.append(dataset['id'])
+                else:
+                    with tempfile.TemporaryDirectory(dir=os.path.abspath(LOCAL_TMP)) as tmpdirname:
+                        build_path = os.path.join(tmpdirname, os.path.basename(segment_path))
+                        os.makedirs(build_path)
+                        with capture_warnings(os.path.join(build_path, 'warnings.log')):
+                            with parallel_dataset_context([dataset], gene_to_gene, transcript_to_gene, fingerprint=annotator_fingerprint) as ret:
+                                (headers,), iterator = ret
+                                prepare_dataset(dataset, headers)
+                                write_segment(build_path, dataset, headers, iterator, all_metadata_columns[dataset['id']], inputObj.get('workers', 0) or 0, encoding, neighbours, summaries)
+                        store_cache_entry(build_path, segment_path)
+                segments.append(load_segment(segment_path))
+
+                # Genes/s covers annotation, sorting, statistics and encoding of the dataset (or just loading it when reused)
+                elapsed = time.perf_counter() - start
+                report_time('segments', elapsed)
+                _run_report['datasets'][dataset['id']] = {'reused': dataset['id'] in reused, 'seconds': elapsed, 'genes': len(segments[-1]['genes']), 'genes_per_sec': len(segments[-1]['genes']) / elapsed}
+
+                # Report precision lost to quantized encodings
+                if encoding != 'float32':
+                    for matrix, (max_abs, max_rel) in zip(dataset['matrices'], segments[-1]['errors']):
+                        logging.info(f'{dataset["id"]}\t{matrix["name"]}\t{encoding}\tmax absolute error\t{max_abs:.3g}\tmax relative error\t{max_rel:.3g}')
+
+            logging.info(f'reused segments for {",".join(reused) or "no datasets"}')
+
+            # Rows are re-compressed if another level or shared dictionaries are configured
+            compression = inputObj.get('compression', None) or {}
+            for segment in segments:
+                with report_stage('transcoders'):
+                    segment['transcoders'] = get_segment_transcoders(segment, compression.get('level', None), compression.get('dictionary', False))
+
+            # Range datasets each row belongs to, in the order rows of a gene are written
+            gene_streams = {}
+            for di, dataset in enumerate(inputObj['datasets']):
+                if dataset['_internal'][3]:
+                    gene_streams[di, 'varpart_ranges', 0] = f'/metadata/{dataset["id"]}/variance_partition'
+                for mi, matrix in enumerate(dataset['matrices']):
+                    gene_streams[di, 'pvalue_ranges', mi] = f'/metadata/{dataset["id"]}/matrices/{matrix["name"]}_pvalues'
+                    gene_streams[di, 'matrix_ranges', mi] = f'/metadata/{dataset["id"]}/matrices/{matrix["name"]}'
+                    if 'summary_ranges' in segments[di]:
+                        gene_streams[di, 'summary_ranges', mi] = f'/metadata/{dataset["id"]}/matrices/{matrix["name"]}_summary'
+                for ti, transcript_matrix in enumerate(dataset.get('transcript_matrices', [])):
+                    gene_streams[di, 'transcript_ranges', ti] = f'/metadata/{dataset["id"]}/transcripts/{transcript_matrix["name"]}'
+                if 'neighbour_rows' in segments[di]:
+                    gene_streams[di, 'neighbour_ranges', 0] = f'/metadata/{dataset["id"]}/neighbours'
+            stream_index = {key: k for k, key in enumerate(gene_streams)}
+
+            # Rows no view of the site reads yet are written after a gene's record (and left out of remote), so gene requests don't fetch them
+            detached_streams = {stream_index[key] for key in gene_streams if key[1] in ('summary_ranges', 'neighbour_ranges')}
+
+            # Merge segments over all annotated genes in alphanumeric order, copying only rows of written genes.
+            # Rows of a gene are always contiguous, the gene layout also prefixes them with a header so each gene is a self-describing record
+            gene_major = inputObj.get('layout', 'interleaved') == 'gene'
+            with report_stage('merge'), write_compressed_ranges(EXPRESSION_PATH) as (writer, teller):
+                last_range_end, parts = 0, []
+                def copy_row(ranges, row, di, stream, i, j):
+                    segment = segments[di]
+                    start, end = (segment[stream] if stream == 'varpart_ranges' else segment[stream][i])[j]
+                    binary, transcode = segment['rows'][start:end].tobytes(), segment['transcoders'][stream, i][0]
+                    parts.append((ranges, row, stream_index[di, stream, i], transcode(binary) if transcode else binary))
+
+                all_genes = sorted(set().union(*(s['lookup'] for s in segments)))
+                max_written = len(all_genes) if GENE_LIMIT is None else min(len(all_genes), GENE_LIMIT)
+
+                # Genes with a matrix in at least MIN_HITS datasets are written in order, so their rows (which neighbours refer to) are known up front
+                gene_positions = {g: i for i, g in enumerate(all_genes)}
+                hit_counts = np.zeros(len(all_genes), dtype=np.int32)
+                for segment in segments:
+                    hit_counts[[gene_positions[g] for g, (i, _) in segment['lookup'].items() if segment['has_matrix'][i]]] += 1
+                written = hit_counts >= MIN_HITS
+                written[max_written:] = False
+                written_rows = np.where(written, np.cumsum(written) - 1, -1)
+                for segment in segments:
+                    if 'neighbour_rows' in segment:
+                        segment['written_rows'] = written_rows[[gene_positions[g] for g in segment['genes'][segment['complete']].tolist()]]
+
+                # Accumulators are preallocated for every gene and filled in at their row (written gene, or dataset row), rather than grown as lists of tuples
+                written_genes, gene_ranges = np.empty(max_written, dtype=np.int32), np.empty((max_written, 2), dtype='i8')
+                for dataset, segment in zip(inputObj['datasets'], segments):
+                    _, curent_index, _, variance_headers = dataset['_internal']
+                    dataset['_internal'] = (np.full(max_written, -1, dtype='i8'), curent_index, np.empty((max_written, 2), dtype='i8'), variance_headers)
+                    for matrix in dataset['matrices']:
+                        _, reorder, logs_filter_enum, _ = matrix['_internal']
+                        matrix['_internal'] = (np.empty((max_written, 2), dtype='i8'), reorder, logs_filter_enum, np.empty((max_written, 2), dtype='i8'))
+                        matrix['_internal_summary_ranges'] = np.empty((max_written, 2), dtype='i8')
+                    for transcript_matrix in dataset.get('transcript_matrices', []):
+                        _, categories, reorder = transcript_matrix['_internal']
+                        transcript_matrix['_internal'] = (np.empty((max_written, 2), dtype='i8'), categories, reorder)
+
+                    # Log means (matrices x genes, and x regions) of written genes, filled in at their dataset row
+                    dataset['_internal_logs'] = (np.full((len(dataset['matrices']), max_written), np.nan), np.full((len(dataset['matrices']), max_written, segment['logs_filter'].shape[2]), np.nan))
+                    dataset['_internal_neighbour_ranges'] = np.empty((max_written, 2), dtype='i8')
+
+                for gene_row, gene in enumerate(itertools.islice(all_genes, GENE_LIMIT)):
+                    hits = [s['lookup'].get(gene, None) for s in segments]
+                    hits = [h if h is not None and s['has_matrix'][h[0]] else None for s, h in zip(segments, hits)]
+
+                    if gene not in gene_to_gene:
+                        raise AnnotationException(f'unexpected gene {gene} - annotation/sorted cache likely outdated')
+                
+                    if not written[gene_row]: 
+                        which_ds = [inputObj['datasets'][mi]['id'] for mi, h in enumerate(hits) if h is not None]
+                        logging.warning(f'pipeline\tonly in {",".join(which_ds)}\tgene\t{gene}')
+                        continue
+
+                    written_genes[total_written] = gene_row
+                    for di, (dataset, segment, hit) in enumerate(zip(inputObj['datasets'], segments, hits)):
+                        # Maintain sparse lookup indices for each dataset
+                        indices, curent_index, varpart_ranges, varpart_headers = dataset['_internal']
+                        if hit: indices[total_written] = row = curent_index[0]
+                        if not hit or not segment['complete'][hit[0]]: continue
+
+                        j = hit[1]
+                        logs, logs_filter = dataset['_internal_logs']
+                        logs[:, row] = segment['logs'][:, j]
+                        logs_filter[:, row] = segment['logs_filter'][:, j]
+                        curent_index[0] += 1
+                        if varpart_headers:
+                            copy_row(varpart_ranges, row, di, 'varpart_ranges', 0, j)
+
+                        for mi, matrix in enumerate(dataset['matrices']):
+                            ranges, _, _, pvalue_ranges = matrix['_internal']
+                            copy_row(pvalue_ranges, row, di, 'pvalue_ranges', mi, j)
+                            copy_row(ranges, row, di, 'matrix_ranges', mi, j)
+                            if 'summary_ranges' in segment:
+                                copy_row(matrix['_internal_summary_ranges'], row, di, 'summary_ranges', mi, j)
+
+                        for ti, transcript_matrix in enumerate(dataset.get('transcript_matrices', [])):
+                            copy_row(transcript_matrix['_internal'][0], row, di, 'transcript_ranges', ti, j)
+
+                        # Neighbours refer to segment rows, so are re-encoded as rows of written genes (dropping those not written)
+                        if 'neighbour_rows' in segment:
+                            neighbour_rows = segment['neighbour_rows'][j]
+                            neighbour_genes = np.where(neighbour_rows >= 0, segment['written_rows'][neighbour_rows], -1)
+                            keep = neighbour_genes >= 0
+                            neighbour_row = data_pb2.NeighbourData(genes=neighbour_genes[keep].tolist(), correlations=segment['neighbour_correlations'][j][keep].tolist())
+                            parts.append((dataset['_internal_neighbour_ranges'], row, stream_index[di, 'neighbour_ranges', 0], compress_row(neighbour_row.SerializeToString())))
+
+                    # Ranges of each row stay valid within a record, so either layout can be read per stream
+                    gene_start = teller()
+                    record = [part for part in parts if part[2] not in detached_streams]
+                    if gene_major:
+                        writer(gene_record_header([(stream, binary) for _, _, stream, binary in record]), compressed=True)
+                    for ranges, row, _, binary in record:
+                        ranges[row] = writer(binary, compressed=True)
+                    gene_ranges[total_written] = gene_start, teller()
+                    for ranges, row, stream, binary in parts:
+                        if stream in detached_streams:
+                            ranges[row] = writer(binary, compressed=True)
+                    total_written += 1
+                    parts.clear()
+
+                # Write metadata columns and their pvalues
+                for dataset_id, [columns, extra_attrs] in all_metadata_columns.items():
+                    try:
+                        with report_stage('write metadata'):
                             write_metadata_columns(meta_root[dataset_id], columns, extra_attrs)
-                        except ValueError as e:
-                            print("Error writing metadata for " + dataset_id)
-                            raise
+                    except ValueError as e:
+                        print("Error writing metadata for " + dataset_id)
+                        raise
                         
                 all_ranges.append((last_range_end, teller()))
 
@@ -789,6 +2274,7 @@ def run():
             remote_range_datasets = []
 
             # Finally, write main table and matrix compressed ranges
+            start = time.perf_counter()
             data_root = root.create_group('data')
             
             display_settings = [
@@ -805,12 +2291,24 @@ def run():
             def boolean_to_indices(values):
                 return [i for i, v in enumerate(values) if v]
 
-            write_string_dataset(data_root, 'Ensembl ID', [a[0] for a in annots_written])
-            write_string_dataset(data_root, 'Gene Symbol', [a[1] for a in annots_written])
-            write_string_dataset(data_root, 'Gene Description', [a[6] for a in annots_written])
-            write_string_dataset(data_root, 'chr', [a[2] for a in annots_written])
-            data_root.create_dataset('hg38 start', data=[a[3] for a in annots_written], compression='gzip', compression_opts=9)
-            data_root.create_dataset('hg38 end', data=[a[4] for a in annots_written], compression='gzip', compression_opts=9)
+            def annotation_column(k):
+                return [gene_to_gene[all_genes[i]][k] for i in written_genes[:total_written].tolist()]
+
+            write_string_dataset(data_root, 'Ensembl ID', annotation_column(0))
+            write_string_dataset(data_root, 'Gene Symbol', annotation_column(1))
+            write_string_dataset(data_root, 'Gene Description', annotation_column(6))
+            write_string_dataset(data_root, 'chr', annotation_column(2))
+            data_root.create_dataset('hg38 start', data=annotation_column(3), compression='gzip', compression_opts=9)
+            data_root.create_dataset('hg38 end', data=annotation_column(4), compression='gzip', compression_opts=9)
+
+            # Sorted keys (including aliases and previous symbols) of written genes, so lookups are binary searches rather than column scans
+            with report_stage('search index'):
+                keys, rows, kinds = build_search_index(gene_to_gene, {all_genes[i]: r for r, i in enumerate(written_genes[:total_written].tolist())})
+                search_root = root.create_group('search')
+                search_root.create_dataset('keys', data=keys, compression='gzip', compression_opts=9)
+                search_root.create_dataset('rows', data=rows, compression='gzip', compression_opts=9)
+                search_root.create_dataset('kinds', data=kinds, compression='gzip', compression_opts=9)
+                search_root.attrs.create('kinds', ['Ensembl ID', 'Gene Symbol', 'Alias'])
 
             url_root = root.create_group('urls')
             for d in inputObj['datasets']:
@@ -818,7 +2316,7 @@ def run():
 
                 # Add main lookup indices to data table
                 indices, *_ = d['_internal']
-                data_root.create_dataset(d['id'], data=indices, compression='gzip', compression_opts=9)
+                data_root.create_dataset(d['id'], data=indices[:total_written], compression='gzip', compression_opts=9)
 
                 # Write url (NOTE: individual URLs no longer supported)
                 curr_url_root = url_root.create_dataset(d['id'], data=h5py.Empty('S1'))
@@ -842,66 +2340,120 @@ def run():
                 for d_id in pg['datasets']:
                     with contextlib.suppress(KeyError):
                         p_pg_root[d_id] = root['metadata'][d_id]
+            report_time('write tables', time.perf_counter() - start)
 
             asset_urls = deploy([EXPRESSION_PATH])
             expression_url = asset_urls.get(os.path.basename(EXPRESSION_PATH), '')
 
-            for d in inputObj['datasets']:
+            def write_codec_attrs(ds, segment, stream, i):
+                for k, v in segment['transcoders'][stream, i][1].items():
+                    ds.attrs.create(k, v)
+                ranges = ds[()].reshape(-1, 2)
+                report_count('bytes_written', ds.name, int((ranges[:, 1] - ranges[:, 0]).sum()))
+
+            start = time.perf_counter()
+            for d, segment in zip(inputObj['datasets'], segments):
+                # Rows of the dataset that were filled in during the merge
+                count = d['_internal'][1][0]
                 meta_root = root['metadata'][d['id']]
                 matrix_meta_root = meta_root.create_group('matrices')
                 matrix_meta_root.attrs.create('order', [m['name'] for m in d['matrices']])
-                all_logs = {}
-                [filter_name, filter_categories] = ['', []]
-                for matrix in d['matrices']:
-                    name, shape = matrix['name'], (len(annots_written), d['_internal_sample_count'])
-                    ranges, _, _, logs, logs_filter_enum, pvalue_ranges = matrix['_internal']
+                for mi, matrix in enumerate(d['matrices']):
+                    name, shape = matrix['name'], (total_written, d['_internal_sample_count'])
+                    ranges, _, _, pvalue_ranges = matrix['_internal']
+                    ranges, pvalue_ranges = ranges[:count], pvalue_ranges[:count]
         
                     curr_matrix_meta_root = matrix_meta_root.create_dataset(name, data=ranges, compression='gzip', compression_opts=9)
                     curr_matrix_meta_root.attrs.create('path', expression_url)
                     curr_matrix_meta_root.attrs.create('shape', shape)
+                    write_codec_attrs(curr_matrix_meta_root, segment, 'matrix_ranges', mi)
                     remote_range_datasets.append([curr_matrix_meta_root.name, '/data/' + d['id'], 'RowData'])
                     
                     curr_matrix_pvalue_root = matrix_meta_root.create_dataset(name + '_pvalues', data=pvalue_ranges, compression='gzip', compression_opts=9)
+                    write_codec_attrs(curr_matrix_pvalue_root, segment, 'pvalue_ranges', mi)
                     remote_range_datasets.append([curr_matrix_pvalue_root.name, '/data/' + d['id'], 'RowData'])
 
-                    all_logs.setdefault('All', []).append(logs)
-                    if logs_filter_enum:
-                        [filter_name, filter_categories, filter_factors], filter_indices, logs_filter = logs_filter_enum
-                        for i in range(len(filter_categories)): 
-                            if logs_filter[i]:
-                                all_logs.setdefault(filter_categories[i].replace('/', '-'), []).append(logs_filter[i])
+                    # Box plot statistics of each category of each categorical column, so overviews don't need whole rows (not in remote until a view reads them)
+                    if 'summary_ranges' not in segment: continue
+                    curr_matrix_summary_root = matrix_meta_root.create_dataset(name + '_summary', data=matrix['_internal_summary_ranges'][:count], compression='gzip', compression_opts=9)
+                    summary_columns, summary_labels = summary_layout(all_metadata_columns[d['id']][0])
+                    curr_matrix_summary_root.attrs.create('columns', summary_columns)
+                    curr_matrix_summary_root.attrs.create('categoryCounts', [len(labels) for labels in summary_labels])
+                    curr_matrix_summary_root.attrs.create('categories', list(itertools.chain.from_iterable(summary_labels)))
+                    curr_matrix_summary_root.attrs.create('stats', SUMMARY_STATS)
+                    write_codec_attrs(curr_matrix_summary_root, segment, 'summary_ranges', mi)
+                    curr_matrix_summary_root.attrs.create('type', 'SummaryData')
+
+                # Log means of written rows (matrices x genes) overall and per region
+                logs, logs_filter = d['_internal_logs']
+                all_logs = {'All': logs[:, :count]}
+                [filter_name, filter_categories] = ['', []]
+                if (logs_filter_enum := d['matrices'][0]['_internal'][2]):
+                    filter_name, filter_categories, _ = logs_filter_enum[0]
+                    for i, category in enumerate(filter_categories if count else []):
+                        all_logs.setdefault(category.replace('/', '-'), logs_filter[:, :count, i])
 
                 zscore_meta_root = meta_root.create_group('zscores')
                 zscore_meta_root.attrs.create('customFilterCategory', list(all_logs.keys()))
                 zscore_meta_root.attrs.create('customFilterName', filter_name)
-                for log_name, log_list in all_logs.items():
-                    zscores_2d = [calc_zscore(logs) for logs in log_list]
-                    zscores = [np.mean([zscores_2d[j][i] for j in range(len(zscores_2d))]) for i in range(len(zscores_2d[0]))]
+                for log_name, log_array in all_logs.items():
+                    # Mean of each matrix's z-scores
+                    with report_stage('zscores'):
+                        zscores = calc_zscore(log_array).mean(axis=0)
                     zscore_meta_root.create_dataset(log_name, data=zscores, compression='gzip', compression_opts=9)
 
                 if (transcript_matrices := d.get('transcript_matrices', None)):
                     transcript_meta_root = meta_root.create_group('transcripts')
                     transcript_meta_root.attrs.create('order', [t['name'] for t in d['transcript_matrices']])
-                    for transcript_matrix in d.get('transcript_matrices', []):
-                        ranges, categories, _, _ = transcript_matrix['_internal']
-                        curr_transcript_meta_root = transcript_meta_root.create_dataset(transcript_matrix['name'], data=ranges, compression='gzip', compression_opts=9)
+                    for ti, transcript_matrix in enumerate(d.get('transcript_matrices', [])):
+                        ranges, categories, _ = transcript_matrix['_internal']
+                        curr_transcript_meta_root = transcript_meta_root.create_dataset(transcript_matrix['name'], data=ranges[:count], compression='gzip', compression_opts=9)
                         curr_transcript_meta_root.attrs.create('categories', categories)
+                        write_codec_attrs(curr_transcript_meta_root, segment, 'transcript_ranges', ti)
                         remote_range_datasets.append([curr_transcript_meta_root.name, '/data/' + d['id'], 'TableData'])
 
+                if 'neighbour_rows' in segment:
+                    neighbours_ds = meta_root.create_dataset('neighbours', data=d['_internal_neighbour_ranges'][:count], compression='gzip', compression_opts=9)
+                    write_codec_attrs(neighbours_ds, segment, 'neighbour_ranges', 0)
+                    # Query-only for now (no view of the site fetches them), so not in remote and the row type is kept with the ranges
+                    neighbours_ds.attrs.create('type', 'NeighbourData')
+
                 indices, _, varpart_ranges, varpart_headers = d['_internal']
-                reverse_indices = [i for i, x in enumerate(indices) if x != -1]
+                reverse_indices = np.flatnonzero(indices[:total_written] != -1)
                 meta_root.create_dataset('index', data=reverse_indices, compression='gzip', compression_opts=9)
                 
                 if varpart_headers:
-                    var_ds = meta_root.create_dataset('variance_partition', data=varpart_ranges, compression="gzip", compression_opts=9)
+                    var_ds = meta_root.create_dataset('variance_partition', data=varpart_ranges[:count], compression="gzip", compression_opts=9)
                     var_ds.attrs.create("heading", varpart_headers)
+                    write_codec_attrs(var_ds, segment, 'varpart_ranges', 0)
 
                     remote_range_datasets.append([var_ds.name, '/data/' + d['id'], 'RowData'])
 
             root.attrs.create('remote', remote_range_datasets)
 
+            # Per-gene offsets of records in the gene layout, whose header refers to range datasets by their index in streams
+            if gene_major:
+                gene_ranges_ds = root.create_dataset('gene_ranges', data=gene_ranges[:total_written], compression='gzip', compression_opts=9)
+                gene_ranges_ds.attrs.create('path', expression_url)
+                gene_ranges_ds.attrs.create('streams', list(gene_streams.values()))
+            report_time('write ranges', time.perf_counter() - start)
+
         # Upload remaining files to release
+        start = time.perf_counter()
         asset_paths = [os.path.join(OUTPUT_FOLDER, 'out.hdf5')]
+
+        # Sharded layout: out.hdf5 only keeps what the results table needs, a dataset's metadata is fetched when it is viewed (see manifest.json)
+        sharded = inputObj.get('hdf5_layout', 'single') == 'sharded'
+        if sharded:
+            with report_stage('shard'):
+                manifest = shard_output(OUTPUT_FOLDER)
+            shard_urls = deploy([os.path.join(OUTPUT_FOLDER, s['file']) for s in manifest['shards'].values()])
+            for s in manifest['shards'].values():
+                s['url'] = shard_urls.get(s['file'], '')
+            with open(os.path.join(OUTPUT_FOLDER, 'manifest.json'), 'w') as f:
+                json.dump(manifest, f, indent=2)
+            asset_paths.append(os.path.join(OUTPUT_FOLDER, 'manifest.json'))
+
         for d in inputObj['datasets']: 
             m = d['matrices'][0]
             meta_path = os.path.join(d['dir'], d['meta'])
@@ -910,7 +2462,8 @@ def run():
 
             asset_paths.extend([os.path.join(OUTPUT_FOLDER, d['meta']), matrix_dst])
             shutil.copy2(meta_path, OUTPUT_FOLDER)
-            os.system(f'gzip -c {matrix_path} > {matrix_dst}')
+            publish_gzip_asset(matrix_path, matrix_dst)
+        report_time('assets', time.perf_counter() - start)
         
         asset_urls = deploy(asset_paths)
 
@@ -919,6 +2472,7 @@ def run():
             meta_json = {
                 "data_url": asset_urls.get('out.hdf5', ''),
                 "bin_url": expression_url,
+                **({"manifest_url": asset_urls.get('manifest.json', '')} if sharded else {}),
                 "count": total_written,
                 "last_updated": datetime.date.today().strftime("%B %Y"),
                 "meta_files": []
@@ -933,5 +2487,8 @@ def run():
                 })
             json.dump(meta_json, f, indent=2)
 
+        with report_stage('evict cache'):
+            evict_cache(inputObj.get('cache_max_bytes', None))
+
 if __name__ == '__main__':
     run()
\ No newline at end of file
@@ -0,0 +1,278 @@
+import os, io, json, mmap, argparse, itertools, threading, contextlib, collections, concurrent.futures, urllib.parse, urllib.request, urllib.error, http.client, http.server
+import numpy as np, h5py
+import data_pb2
+
+from typing import List, Tuple
+from main import context_closer, get_row_codec, train_row_dictionary, decode_row_values, write_compressed_ranges, build_search_index, shard_output
+
+# Gap (bytes) below which neighbouring rows are read as one range, as reading a few wasted KB is cheaper than another read or request
+QUERY_MERGE_GAP = 16384
+
+def coalesce_ranges(ranges: List[Tuple[int, int]], merge_gap: int=QUERY_MERGE_GAP):
+    '''Group [start, end) ranges into spans read at once, returning (span start, span end, indices of the ranges within it) in file order'''
+    spans = []
+    for i in sorted(range(len(ranges)), key=lambda i: ranges[i][0]):
+        start, end = ranges[i]
+        if spans and start <= spans[-1][1] + merge_gap:
+            spans[-1][1] = max(spans[-1][1], end)
+            spans[-1][2].append(i)
+        else:
+            spans.append([start, end, [i]])
+    return [tuple(s) for s in spans]
+
+@contextlib.contextmanager
+def open_local_ranges(path: str):
+    '''Read byte ranges of a local file through a shared memory map'''
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield lambda start, end: b''
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            yield lambda start, end: m[start:end]
+
+@contextlib.contextmanager
+def open_http_ranges(url: str, timeout: float=60):
+    '''Read byte ranges of a URL with single range requests (all S3/CloudFront support), over a keep-alive connection per thread'''
+    parts = urllib.parse.urlsplit(url)
+    connection_type = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+    target = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+    local, connections = threading.local(), []
+
+    def read_range(start, end):
+        if end <= start: return b''
+        for attempt in range(2):
+            if getattr(local, 'connection', None) is None:
+                local.connection = connection_type(parts.netloc, timeout=timeout)
+                connections.append(local.connection)
+            try:
+                local.connection.request('GET', target, headers={'Range': f'bytes={start}-{end-1}'})
+                response = local.connection.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, ConnectionError):
+                # The server may close kept-alive connections, so retry once on a new one
+                local.connection.close()
+                local.connection = None
+                if attempt: raise
+                continue
+            if response.status != 206 or len(body) != end - start:
+                raise IOError(f'{url}\texpected 206 with {end - start} bytes for bytes={start}-{end-1}, got {response.status} with {len(body)}')
+            return body
+
+    try:
+        yield read_range
+    finally:
+        for c in connections: c.close()
+
+def read_url(url: str, timeout: float=60):
+    '''Whole content of a URL'''
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return response.read()
+
+def decode_row(binary: bytes, row_type: str='RowData'):
+    '''Values of a serialized RowData as float32, a TableData as (transcript ids, transcripts x samples float32 values), a NeighbourData as (rows in /data, correlations)
+    or a SummaryData as (values per category, categories x stats float32 values)'''
+    if row_type == 'RowData':
+        row = data_pb2.RowData()
+        row.ParseFromString(binary)
+        return decode_row_values(row)
+    if row_type == 'NeighbourData':
+        neighbours = data_pb2.NeighbourData()
+        neighbours.ParseFromString(binary)
+        return np.array(neighbours.genes, dtype=np.int64), np.array(neighbours.correlations, dtype='f4')
+    if row_type == 'SummaryData':
+        summary = data_pb2.SummaryData()
+        summary.ParseFromString(binary)
+        return np.array(summary.counts, dtype=np.int64), np.array(summary.stats, dtype='f4').reshape(len(summary.counts), -1 if len(summary.counts) else 0)
+    table = data_pb2.TableData()
+    table.ParseFromString(binary)
+    ids = np.array(table.string_values)
+    return ids, np.array(table.float_values, dtype='f4').reshape(len(ids), -1 if len(ids) else 0)
+
+@contextlib.contextmanager
+def read_output(location: str, workers: int=4, cache_rows: int=4096, merge_gap: int=QUERY_MERGE_GAP):
+    '''Open a built output folder (read through mmap), or the URL of a served output folder or its metadata.json (read with range requests).
+    Yields (get, fetch_rows, find_genes): get(path) returns the h5py object at a path of out.hdf5, opening the dataset shard holding it in the sharded layout.
+    fetch_rows(path, rows) returns decoded rows (see decode_row, None for rows < 0) of a range dataset in /metadata,
+    read in coalesced spans which are decompressed on worker threads, through a LRU cache of decoded rows.
+    find_genes(genes, dataset=None) returns rows of genes (Ensembl IDs, or case insensitive symbols and aliases) in /data, or in the range datasets of a dataset, -1 where missing'''
+    with context_closer() as contexts:
+        if urllib.parse.urlsplit(location).scheme in ('http', 'https'):
+            if location.endswith('.json'):
+                meta_json = json.loads(read_url(location))
+                data_url, bin_url, manifest_url = meta_json['data_url'], meta_json['bin_url'], meta_json.get('manifest_url', None)
+            else:
+                data_url, bin_url, manifest_url = [location.rstrip('/') + '/' + name for name in ('out.hdf5', 'expression.bin', 'manifest.json')]
+            root = h5py.File(io.BytesIO(read_url(data_url)), 'r')
+            contexts.append(ranges_context := open_http_ranges(bin_url))
+            try:
+                manifest = json.loads(read_url(manifest_url)) if manifest_url else None
+            except urllib.error.HTTPError as e:
+                if e.code != 404: raise
+                manifest = None
+            open_shard = lambda shard: h5py.File(io.BytesIO(read_url(shard.get('url', None) or urllib.parse.urljoin(manifest_url, shard['file']))), 'r')
+        else:
+            root = h5py.File(os.path.join(location, 'out.hdf5'), 'r')
+            contexts.append(ranges_context := open_local_ranges(os.path.join(location, 'expression.bin')))
+            manifest = None
+            if os.path.exists(manifest_path := os.path.join(location, 'manifest.json')):
+                with open(manifest_path) as f: manifest = json.load(f)
+            open_shard = lambda shard: h5py.File(os.path.join(location, shard['file']), 'r')
+        contexts.append(root)
+        read_range = ranges_context.__enter__()
+
+        # Files of the dataset shards opened so far
+        shards, shard_lock = {}, threading.Lock()
+        def get(path: str):
+            parts = path.strip('/').split('/')
+            shard = manifest['shards'].get(parts[1], None) if manifest and len(parts) > 2 and parts[0] == 'metadata' else None
+            if not shard or parts[2] not in shard['keys']:
+                return root[path]
+            with shard_lock:
+                if parts[1] not in shards:
+                    contexts.append(shards.setdefault(parts[1], open_shard(shard)))
+            return shards[parts[1]][path]
+
+        executor = concurrent.futures.ThreadPoolExecutor(workers) if workers else None
+        if executor: contexts.append(executor)
+
+        # Range datasets (ranges, decompressor given their dictionary attribute, row type)
+        row_types = {name: row_type for name, _, row_type in root.attrs['remote']}
+        range_datasets = {}
+        def get_range_dataset(path):
+            if path not in range_datasets:
+                ds = get(path)
+                range_datasets[path] = (ds[()].reshape(-1, 2), get_row_codec(dictionary=ds.attrs['dictionary'].tobytes() if 'dictionary' in ds.attrs else None)[1], row_types.get(ds.name, ds.attrs.get('type', 'RowData')))
+            return range_datasets[path]
+
+        def decode_span(path, span_start, span_end, requested):
+            ranges, decompress, row_type = get_range_dataset(path)
+            span = read_range(span_start, span_end)
+            return [(row, decode_row(decompress(span[ranges[row][0] - span_start:ranges[row][1] - span_start]), row_type)) for row in requested]
+
+        cache, cache_lock = collections.OrderedDict(), threading.Lock()
+        def fetch_rows(path: str, rows: List[int]):
+            ranges = get_range_dataset(path)[0]
+            rows = [int(row) for row in rows]
+            found = {}
+            with cache_lock:
+                for row in rows:
+                    if (path, row) in cache:
+                        cache.move_to_end((path, row))
+                        found[row] = cache[path, row]
+
+            # Read each missing row once, merging rows that are close in the file
+            missing = sorted({row for row in rows if row >= 0 and row not in found})
+            spans = coalesce_ranges([tuple(ranges[row]) for row in missing], merge_gap)
+            tasks = [(path, start, end, [missing[i] for i in indices]) for start, end, indices in spans]
+            for decoded in (executor.map(decode_span, *zip(*tasks)) if executor and len(tasks) > 1 else itertools.starmap(decode_span, tasks)):
+                found.update(decoded)
+
+            with cache_lock:
+                for row in missing:
+                    cache[path, row] = found[row]
+                    cache.move_to_end((path, row))
+                while len(cache) > cache_rows:
+                    cache.popitem(last=False)
+            return [found.get(row, None) for row in rows]
+
+        lookup, dataset_indices = {}, {}
+        def find_genes(genes: List[str], dataset: str=None):
+            if not lookup:
+                # Aliases are only in the search index of newer outputs, so IDs and symbols take precedence over them
+                if 'search' in root:
+                    keys, rows, kinds = (root['search'][name][()] for name in ['keys', 'rows', 'kinds'])
+                    for i in np.argsort(-kinds.astype(np.int8), kind='stable').tolist():
+                        lookup[keys[i].decode()] = int(rows[i])
+                for column in ['Gene Symbol', 'Ensembl ID']:
+                    lookup.update((v.decode().upper(), i) for i, v in enumerate(root['data'][column][()]))
+            rows = np.array([lookup.get(g.strip().upper(), -1) for g in genes], dtype=np.int64)
+            if dataset is None: return rows
+            if dataset not in dataset_indices:
+                dataset_indices[dataset] = np.append(root['data'][dataset][()], -1)
+            return dataset_indices[dataset][rows]
+
+        yield get, fetch_rows, find_genes
+
+def fetch_expression(output, genes: List[str], dataset: str, matrix: str=None):
+    '''Genes x samples expression of a dataset matrix (by default its first) of an output opened by read_output, with NaN rows for genes missing from the dataset, and its sample names'''
+    get, fetch_rows, find_genes = output
+    matrix = matrix or get(f'/metadata/{dataset}/matrices').attrs['order'][0]
+    sample_names = [s.decode() for s in get(f'/metadata/{dataset}/sample_names')[()]]
+    values = np.full((len(genes), len(sample_names)), np.nan, dtype='f4')
+    for i, row in enumerate(fetch_rows(f'/metadata/{dataset}/matrices/{matrix}', find_genes(genes, dataset))):
+        if row is not None: values[i] = row
+    return values, sample_names
+
+def test_read_output():
+    '''Query a small output, single and sharded, locally and through serve.py, checking coalescing, missing genes, zlib dictionaries and the row cache'''
+    import tempfile, serve
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as folder:
+        expected, ranges = rng.normal(size=(5, 4)).astype('f4'), []
+        # Transcripts are compressed with a zlib dictionary, as compression: dictionary: True writes them
+        table = data_pb2.TableData(float_values=[1, 2, 3, 4], string_values=['ENST1', 'ENST2'])
+        dictionary = train_row_dictionary([data_pb2.TableData(string_values=['ENST1', 'ENST2', 'ENST3']).SerializeToString()])
+        with write_compressed_ranges(os.path.join(folder, 'expression.bin')) as (writer, _):
+            for values in expected:
+                ranges.append(writer(data_pb2.RowData(values=values.tolist()).SerializeToString()))
+                writer(b'padding' * 1000, compressed=True)
+            table_range = writer(get_row_codec(dictionary=dictionary)[0](table.SerializeToString()), compressed=True)
+
+        with h5py.File(os.path.join(folder, 'out.hdf5'), 'w') as root:
+            root['data/Ensembl ID'] = np.array([f'ENSG{i}' for i in range(6)], dtype='S')
+            root['data/Gene Symbol'] = np.array([f'SYM{i}' for i in range(6)], dtype='S')
+            root['data/DS'] = [4, 3, -1, 2, 1, 0]
+            root['metadata/DS/sample_names'] = np.array(list('abcd'), dtype='S')
+            root['metadata/DS/matrices/A'] = np.array(ranges)
+            root['metadata/DS/matrices'].attrs['order'] = ['A']
+            root['metadata/DS/transcripts/TX'] = np.array([table_range])
+            root['metadata/DS/transcripts/TX'].attrs['dictionary'] = np.frombuffer(dictionary, dtype=np.uint8)
+            gene_to_gene = {f'ENSG{i}': [f'ENSG{i}', f'SYM{i}'] for i in range(6)}
+            for name, table in zip(['keys', 'rows', 'kinds'], build_search_index({**gene_to_gene, 'old4': gene_to_gene['ENSG4']}, {f'ENSG{i}': i for i in range(6)})):
+                root[f'search/{name}'] = table
+            root.attrs['remote'] = [['/metadata/DS/matrices/A', '/data/DS', 'RowData'], ['/metadata/DS/transcripts/TX', '/data/DS', 'TableData']]
+
+        genes = ['sym1', 'ENSG2', 'ENSG0', 'missing', 'SYM1', 'Old4']
+        rows = [expected[3], None, expected[4], None, expected[3], expected[1]]
+        handler = lambda *args, **kwargs: serve.CORSRequestHandler(*args, directory=folder, **kwargs)
+        with http.server.ThreadingHTTPServer(('localhost', 0), handler) as httpd:
+            threading.Thread(target=httpd.serve_forever, daemon=True).start()
+            url = f'http://localhost:{httpd.server_address[1]}'
+            for layout, (location, workers, merge_gap) in itertools.product(['single', 'sharded'], [(folder, 0, 0), (folder, 2, QUERY_MERGE_GAP), (url, 2, 0), (url + '/', 0, QUERY_MERGE_GAP)]):
+                if layout == 'sharded' and not os.path.exists(os.path.join(folder, 'manifest.json')):
+                    with open(os.path.join(folder, 'manifest.json'), 'w') as f:
+                        json.dump(shard_output(folder), f)
+                with read_output(location, workers, merge_gap=merge_gap) as output:
+                    get, fetch_rows, find_genes = output
+                    assert ('sample_names' in get('/metadata/DS')) == (layout == 'single')
+                    assert find_genes(genes).tolist() == [1, 2, 0, -1, 1, 4]
+                    values, sample_names = fetch_expression(output, genes, 'DS')
+                    assert sample_names == list('abcd')
+                    for v, e in zip(values, rows):
+                        assert np.array_equal(v, e) if e is not None else np.isnan(v).all()
+                    ids, tx_values = fetch_rows('/metadata/DS/transcripts/TX', [0])[0]
+                    assert ids.tolist() == ['ENST1', 'ENST2'] and tx_values.tolist() == [[1, 2], [3, 4]]
+
+                    # Cached rows are served without reading again
+                    if layout == 'sharded' and location.endswith('/'):
+                        httpd.shutdown()
+                        assert np.array_equal(fetch_rows('/metadata/DS/matrices/A', [3])[0], expected[3])
+
+        assert coalesce_ranges([(100, 200), (0, 50), (55, 90), (500, 600)], merge_gap=5) == [(0, 90, [1, 2]), (100, 200, [0]), (500, 600, [3])]
+
+def query(args):
+    '''Write genes x samples expression of a dataset as TSV'''
+    with read_output(args.location, args.workers) as output:
+        values, sample_names = fetch_expression(output, args.genes, args.dataset, args.matrix)
+    print('\t'.join(['gene', *sample_names]))
+    for gene, row in zip(args.genes, values):
+        print('\t'.join([gene, *map(str, row.tolist())]))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Read expression of genes from a built output folder, or a served one (its URL or metadata.json URL)')
+    parser.add_argument('location')
+    parser.add_argument('dataset')
+    parser.add_argument('genes', nargs='+', help='Ensembl IDs or gene symbols')
+    parser.add_argument('--matrix', default=None, help='matrix name (default is the first of the dataset)')
+    parser.add_argument('--workers', type=int, default=4)
+    query(parser.parse_args())
@@ -1,14 +1,164 @@
-import os, sys, http.server, RangeHTTPServer
+import os, io, uuid, argparse, http.server
+
+# Gap (bytes) below which neighbouring ranges are sent as one part, roughly the size of a multipart part header
+RANGE_MERGE_GAP = 80
+
+def parse_ranges(header: str, size: int, merge_gap: int=RANGE_MERGE_GAP):
+    '''Parse a Range header into sorted [start, end) ranges within size, coalescing overlapping or nearby ones ([] if none are satisfiable, None if the header should be ignored)'''
+    unit, _, specs = header.partition('=')
+    if unit.strip() != 'bytes': return None
+    ranges = []
+    try:
+        for spec in specs.split(','):
+            first, sep, last = spec.strip().partition('-')
+            if not sep: return None
+            if first:
+                start, end = int(first), int(last) + 1 if last else size
+                if last and end <= start: return None
+            else:
+                start, end = max(size - int(last), 0), size
+            if start < size:
+                ranges.append([start, min(end, size)])
+    except ValueError:
+        return None
+
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + merge_gap:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [tuple(r) for r in merged]
 
 # Serve output folder with range requests/cors support for testing purposes
-class CORSRequestHandler(RangeHTTPServer.RangeRequestHandler):
-    def end_headers (self):
+class CORSRequestHandler(http.server.SimpleHTTPRequestHandler):
+    # Keep connections alive between the many small range requests of a gene
+    protocol_version = 'HTTP/1.1'
+    # Headers and the sendfile body are separate writes, so avoid delayed ACK stalls
+    disable_nagle_algorithm = True
+
+    def end_headers(self):
         self.send_header('Access-Control-Allow-Origin', '*')
-        RangeHTTPServer.RangeRequestHandler.end_headers(self)
-        
-def start_server():
-    httpd = http.server.HTTPServer(('localhost', 5501), CORSRequestHandler)
-    httpd.serve_forever()
+        self.send_header('Access-Control-Expose-Headers', 'Content-Range, Content-Length')
+        super().end_headers()
+
+    def do_OPTIONS(self):
+        # Preflight of multi-range requests (only single ranges are CORS-safelisted)
+        self.send_response(http.HTTPStatus.NO_CONTENT)
+        self.send_header('Access-Control-Allow-Methods', 'GET, HEAD, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Range')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def send_head(self):
+        '''As SimpleHTTPRequestHandler, answering Range requests with a single part or multipart/byteranges'''
+        self.parts = None
+        path = self.translate_path(self.path)
+        if 'Range' not in self.headers or os.path.isdir(path):
+            return super().send_head()
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            self.send_error(http.HTTPStatus.NOT_FOUND, 'File not found')
+            return None
+
+        size = os.fstat(f.fileno()).st_size
+        ranges = parse_ranges(self.headers['Range'], size)
+        if ranges is None:
+            f.close()
+            return super().send_head()
+        if not ranges:
+            f.close()
+            self.send_response(http.HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+            self.send_header('Content-Range', f'bytes */{size}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+
+        content_type = self.guess_type(path)
+        self.send_response(http.HTTPStatus.PARTIAL_CONTENT)
+        if len(ranges) == 1:
+            (start, end), = ranges
+            self.parts = [(b'', start, end)]
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Range', f'bytes {start}-{end-1}/{size}')
+        else:
+            boundary = uuid.uuid4().hex
+            self.parts = [(f'\r\n--{boundary}\r\nContent-Type: {content_type}\r\nContent-Range: bytes {start}-{end-1}/{size}\r\n\r\n'.encode(), start, end) for start, end in ranges]
+            self.parts.append((f'\r\n--{boundary}--\r\n'.encode(), 0, 0))
+            self.send_header('Content-Type', f'multipart/byteranges; boundary={boundary}')
+        self.send_header('Content-Length', str(sum(len(header) + end - start for header, start, end in self.parts)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        return f
+
+    def copyfile(self, source, outputfile):
+        '''Send the requested parts (or the whole file) with sendfile where the platform supports it, skipping Python buffers'''
+        if not isinstance(source, io.BufferedReader):
+            return super().copyfile(source, outputfile)
+        for header, start, end in self.parts or [(b'', 0, None)]:
+            outputfile.write(header)
+            if end is None or end > start:
+                self.connection.sendfile(source, start, None if end is None else end - start)
+
+def start_server(directory: str=None, host: str='localhost', port: int=5501):
+    handler = lambda *args, **kwargs: CORSRequestHandler(*args, directory=directory, **kwargs)
+    with http.server.ThreadingHTTPServer((host, port), handler) as httpd:
+        httpd.serve_forever()
+
+def test_parse_ranges():
+    '''Check suffix, open and clipped ranges, coalescing of overlapping, adjacent and nearby ranges, and unsatisfiable or malformed headers'''
+    assert parse_ranges('bytes=0-9', 100) == [(0, 10)] and parse_ranges('bytes=95-', 100) == [(95, 100)] and parse_ranges('bytes=90-200', 100) == [(90, 100)]
+    assert parse_ranges('bytes=-10', 100) == [(90, 100)] and parse_ranges('bytes=-200', 100) == [(0, 100)]
+    assert parse_ranges('bytes=5-14,0-9', 1000, 0) == [(0, 15)] and parse_ranges('bytes=0-9,10-19', 1000, 0) == [(0, 20)]
+    assert parse_ranges('bytes=0-9,50-59', 1000) == [(0, 60)] and parse_ranges('bytes=500-509, 0-9', 1000) == [(0, 10), (500, 510)]
+    assert parse_ranges('bytes=0-9,-10', 1000, 0) == [(0, 10), (990, 1000)]
+    assert parse_ranges('bytes=100-', 100) == [] and parse_ranges('bytes=100-200,300-', 100) == [] and parse_ranges('bytes=100-,0-0', 100) == [(0, 1)]
+    for header in ['items=0-9', 'bytes=abc', 'bytes=5-2', 'bytes=1', 'bytes=0-9,x-']:
+        assert parse_ranges(header, 100) is None, header
+
+def test_range_responses():
+    '''Check single part, multipart/byteranges, unsatisfiable and ignored Range requests against a served file'''
+    import tempfile, threading, http.client
+    content = bytes(range(256)) * 4
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        with open(os.path.join(tmpdirname, 'expression.bin'), 'wb') as f: f.write(content)
+        handler = lambda *args, **kwargs: CORSRequestHandler(*args, directory=tmpdirname, **kwargs)
+        with http.server.ThreadingHTTPServer(('localhost', 0), handler) as httpd:
+            threading.Thread(target=httpd.serve_forever, daemon=True).start()
+            connection = http.client.HTTPConnection('localhost', httpd.server_address[1])
+            def get(range_header):
+                connection.request('GET', '/expression.bin', headers={'Range': range_header} if range_header else {})
+                response = connection.getresponse()
+                body = response.read()
+                assert int(response.getheader('Content-Length')) == len(body)
+                return response, body
+
+            response, body = get('bytes=-10')
+            assert response.status == 206 and body == content[-10:] and response.getheader('Content-Range') == 'bytes 1014-1023/1024'
+
+            # Nearby ranges are one part, others are separate parts in order
+            response, body = get('bytes=600-609,0-9,20-29')
+            boundary = response.getheader('Content-Type').partition('boundary=')[2]
+            assert response.status == 206 and response.getheader('Content-Type').startswith('multipart/byteranges; ')
+            parts = body.split(f'\r\n--{boundary}'.encode())
+            assert parts[0] == b'' and parts[-1] == b'--\r\n' and len(parts) == 4
+            for part, (start, end) in zip(parts[1:-1], [(0, 30), (600, 610)]):
+                headers, _, payload = part.partition(b'\r\n\r\n')
+                assert headers.split(b'\r\n')[1:] == [b'Content-Type: application/octet-stream', f'Content-Range: bytes {start}-{end-1}/1024'.encode()] and payload == content[start:end]
+
+            response, body = get('bytes=2000-')
+            assert response.status == 416 and body == b'' and response.getheader('Content-Range') == 'bytes */1024'
+            for range_header in ['bytes=5-2', 'lines=0-1', None]:
+                response, body = get(range_header)
+                assert response.status == 200 and body == content, range_header
+            connection.close()
+            httpd.shutdown()
 
 if __name__ == '__main__':
-    start_server()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Serve a folder (default the current one) with range request and CORS support, as used by deploy_local')
+    parser.add_argument('directory', nargs='?', default=None)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5501)
+    args = parser.parse_args()
+    start_server(args.directory, args.host, args.port)